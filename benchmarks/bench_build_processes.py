@@ -0,0 +1,78 @@
+"""Compare building messages on one thread with building them in a RenderPool.
+
+    python benchmarks/bench_build_processes.py [rows] [processes]
+
+Each message is a long personalized markdown body plus a shared attachment,
+serialized to bytes exactly as a campaign sends it.
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bulk_email.campaign import RENDER_BATCH, Campaign
+from bulk_email.mime import attachment_part
+from bulk_email.pipeline import _build_all
+from bulk_email.recipients import CsvRecipients
+from bulk_email.render_pool import RenderPool
+from bulk_email.template import CompiledTemplate, compile_markdown
+
+COLUMNS = ["Name", "Email"] + [f"col{i}" for i in range(28)]
+BODY = """Dear {{Name}},
+
+We are **delighted** to invite you to _{{col1}}_ at {{col2}}.
+
+- Date: {{col3}}
+- Venue: {{col4}}
+- Dress code: ~~casual~~ smart
+
+> Please reply by {{col5}}.
+
+[RSVP here](https://example.com/rsvp?id={{col6}})
+""" * 20
+
+
+def make_campaign(rows):
+    header = ",".join(COLUMNS)
+    lines = [",".join([f"Person {i}", f"p{i}@example.com"] + [f"value {i}-{col}" for col in COLUMNS[2:]])
+             for i in range(rows)]
+    recipients = CsvRecipients("\n".join([header] + lines).encode())
+    template = CompiledTemplate(f"<html><body>{compile_markdown(BODY, COLUMNS)}</body></html>", COLUMNS)
+    brochure = attachment_part(os.urandom(200_000), "brochure.pdf", subtype="pdf")
+    campaign = Campaign(recipients, template, "Invitation", "events@example.com",
+                        name_col="Name", email_col="Email", shared_parts=[brochure])
+    return campaign, [row for row in recipients]
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else (os.cpu_count() or 1)
+    campaign, data = make_campaign(rows)
+
+    start = time.perf_counter()
+    size = sum(len(campaign.build(row, row["Email"])[2]) for row in data)
+    single = time.perf_counter() - start
+
+    with RenderPool(campaign, processes) as pool:
+        # Start the workers before timing so only steady-state building is measured
+        warmup = [pool.executor.submit(pool.build_for(data[0], data[0]["Email"])) for _ in range(processes)]
+        for future in warmup:
+            future.result()
+        start = time.perf_counter()
+        # Batched like SendPipeline's build stage does it
+        futures = [pool.executor.submit(_build_all, [pool.build_for(row, row["Email"])
+                                                     for row in data[i:i + RENDER_BATCH]])
+                   for i in range(0, rows, RENDER_BATCH)]
+        pooled_size = sum(len(campaign.assemble(parts)[2])
+                          for future in futures for ok, parts in future.result())
+        pooled = time.perf_counter() - start
+
+    assert size == pooled_size
+    print(f"{rows} messages, {size / rows / 1024:.0f} KiB each, {os.cpu_count()} cores")
+    print(f"single thread:      {single:.3f}s ({rows / single:.0f} messages/s)")
+    print(f"{processes:2d} processes:       {pooled:.3f}s ({rows / pooled:.0f} messages/s)")
+    print(f"speedup:            {single / pooled:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Compare per-row placeholder replacement with compiled template rendering.
+
+    python benchmarks/bench_render.py [rows] [columns]
+
+The per-row side is the send loop as it was before templates were
+compiled, with the regex converter of that time: ``bulk_email.markdown``
+has been rewritten since, so timing it here would not measure the old path.
+"""
+import os
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bulk_email.markdown import markdown_to_html
+from bulk_email.template import CompiledTemplate, compile_markdown
+
+SALUTATION = "Dear {{col0}},"
+BODY = """We are **delighted** to invite you to _{{col1}}_ at {{col2}}.
+
+- Date: {{col3}}
+- Venue: {{col4}}
+- Dress code: ~~casual~~ smart
+
+> Please reply by {{col5}}.
+
+[RSVP here](https://example.com/rsvp?id={{col6}})
+""" * 3
+SIGNATURE = "— Your ASC Family"
+PAGE = """<html><body><div>{salutation}</div><div>{body}</div><div>{signature}</div></body></html>"""
+
+
+def legacy_markdown_to_html(text):
+    """``bulk_email.markdown.markdown_to_html`` as it was before the single-pass rewrite."""
+    # Bold + Italic (***text***)
+    text = re.sub(r'\*\*\*(.*?)\*\*\*', r'<strong><em>\1</em></strong>', text)
+    # Bold (**text**)
+    text = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', text)
+    # Italic (_text_)
+    text = re.sub(r'_(.*?)_', r'<em>\1</em>', text)
+    # Strikethrough (~~text~~)
+    text = re.sub(r'~~(.*?)~~', r'<del>\1</del>', text)
+    # Monospace (`text`)
+    text = re.sub(r'`(.*?)`', r'<code>\1</code>', text)
+    # Horizontal Rule (---)
+    text = re.sub(r'^---$', r'<hr>', text, flags=re.MULTILINE)
+    # Blockquote (> text)
+    text = re.sub(r'^> (.*)$', r'<blockquote>\1</blockquote>', text, flags=re.MULTILINE)
+    # Links ([text](url))
+    text = re.sub(r'\[([^\]]+)\]\(([^)]+)\)', r'<a href="\2">\1</a>', text)
+    # Images (![alt](url))
+    text = re.sub(r'!\[([^\]]*)\]\(([^)]+)\)', r'<img src="\2" alt="\1" style="max-width: 100%;">', text)
+    # Unordered list (- item)
+    text = re.sub(r'^- (.*)$', r'<ul><li>\1</li></ul>', text, flags=re.MULTILINE)
+    # Ordered list (1. item)
+    text = re.sub(r'^\d+\. (.*)$', r'<ol><li>\1</li></ol>', text, flags=re.MULTILINE)
+    # Line breaks
+    text = re.sub(r'\n', r'<br>', text)
+    return text
+
+
+def legacy_render(row, columns, convert=legacy_markdown_to_html):
+    def apply_placeholders(text):
+        for col in columns:
+            placeholder = f"{{{{{col}}}}}"
+            value = str(row.get(col, ''))
+            text = text.replace(placeholder, value)
+        return convert(text)
+
+    return PAGE.format(
+        salutation=apply_placeholders(SALUTATION),
+        body=apply_placeholders(BODY),
+        signature=apply_placeholders(SIGNATURE),
+    )
+
+
+def compiled(columns):
+    return CompiledTemplate(PAGE.format(
+        salutation=compile_markdown(SALUTATION, columns),
+        body=compile_markdown(BODY, columns),
+        signature=compile_markdown(SIGNATURE, columns),
+    ), columns)
+
+
+def main():
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    width = int(sys.argv[2]) if len(sys.argv) > 2 else 30
+    columns = [f"col{i}" for i in range(width)]
+    data = [{col: f"value {i}-{col}" for col in columns} for i in range(rows)]
+
+    # The compiled template gives what replacing, then converting, does with today's converter
+    assert legacy_render(data[0], columns, markdown_to_html) == compiled(columns).render(data[0])
+
+    start = time.perf_counter()
+    for row in data:
+        legacy_render(row, columns)
+    legacy = time.perf_counter() - start
+
+    start = time.perf_counter()
+    template = compiled(columns)
+    for row in data:
+        template.render(row)
+    fast = time.perf_counter() - start
+
+    print(f"{rows} rows x {width} columns")
+    print(f"legacy:   {legacy:.3f}s ({legacy / rows * 1e6:.1f} us/message)")
+    print(f"compiled: {fast:.3f}s ({fast / rows * 1e6:.1f} us/message)")
+    print(f"speedup:  {legacy / fast:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,251 @@
+"""Send synthetic recipient lists through each sending mode against a local SMTP sink.
+
+    python benchmarks/bench_send.py [--rows 1000 10000 100000] [--modes script engine ...]
+                                    [--rtt 0.005] [--latency 0] [--throttle 0.01] [--disconnect-every 200]
+                                    [--save results.jsonl] [--compare results.jsonl]
+
+Modes mirror the front ends:
+
+    script     one SMTPConnection, an EmailMessage and a PDF read per row (scripts/)
+    engine     Campaign on 4 threaded connections (the CLI default)
+    staged     Campaign(staged=True) with a send journal, as part-3.py runs it
+    streamlit  one staged connection, Cc and a per-row PDF (send_email_streamlit.py)
+    processes  staged, rendering in one process per core
+    bcc        a template without placeholders in Bcc batches
+
+Each mode and list size runs in a fresh child process with its own
+``SmtpSink``, so CPU time and peak RSS are that run's alone; the sink's
+own CPU is measured separately and left out. Latency is the time each
+delivered message spent on the send path. With ``--compare`` the exit
+status is 1 if any run is slower than the saved one by more than
+``--tolerance`` in messages/s or p99 latency.
+"""
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from email.message import EmailMessage
+
+from smtp_sink import SmtpSink
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bulk_email import SMTPConnection, limiter_for
+from bulk_email.campaign import Campaign
+from bulk_email.mime import image_part
+from bulk_email.recipients import CsvRecipients, iter_clean_chunks
+from bulk_email.retry import RetryPolicy
+from bulk_email.template import CompiledTemplate, compile_markdown
+
+MODES = ("script", "engine", "staged", "streamlit", "processes", "bcc")
+SENDER = "bench@example.com"
+SUBJECT = "Benchmark"
+COLUMNS = ["Name", "Email", "PDFPath", "Nominator", "NominatorEmail", "Event", "Venue", "Date"]
+BODY = """Dear {{Name}},
+
+You were nominated by **{{Nominator}}** for _{{Event}}_.
+
+- Venue: {{Venue}}
+- Date: {{Date}}
+
+> Please find your certificate attached.
+
+[Details](https://example.com/events?id={{Email}})
+"""
+STATIC_BODY = "Dear member,\n\nOur **annual meeting** is next week. [Details](https://example.com/agm)\n"
+PDF_FILES = 50
+# Stands in for the header logo every campaign message shares; only its size matters
+LOGO = b"\x89PNG\r\n\x1a\n" + bytes(20 * 1024)
+
+
+def make_inputs(workdir, rows, pdf_kb):
+    pdfs = []
+    for i in range(PDF_FILES):
+        path = os.path.join(workdir, f"certificate{i}")
+        with open(path + ".pdf", "wb") as f:
+            f.write(b"%PDF-1.4\n" + os.urandom(pdf_kb * 1024))
+        pdfs.append(path)
+    csv_path = os.path.join(workdir, "recipients.csv")
+    with open(csv_path, "w") as f:
+        f.write(",".join(COLUMNS) + "\n")
+        for i in range(rows):
+            f.write(f"Person {i},person{i}@example.com,{pdfs[i % PDF_FILES]},Nominator {i % 97},"
+                    f"nominator{i % 97}@example.com,Awards Night,Main Hall,2026-11-{i % 28 + 1:02d}\n")
+    return csv_path
+
+
+class StreamlitLike(Campaign):
+    """What ``NominationCampaign`` does per row, without importing Streamlit."""
+
+    def cc_for(self, row):
+        return ["office@example.com", row["NominatorEmail"]]
+
+    def attachment_paths(self, row):
+        return [row["PDFPath"] + ".pdf"]
+
+
+def run_script(sink, csv_path, args):
+    recipients = CsvRecipients(csv_path)
+    limiter = limiter_for(sink.host)
+    latencies, failed = [], 0
+    with SMTPConnection(sink.host, sink.port, SENDER, "pw", starttls=False, recycle_after=200) as server:
+        for clean, rejects in iter_clean_chunks(recipients, "Email"):
+            failed += len(rejects)
+            for row in clean.to_dict("records"):
+                start = time.perf_counter()
+                msg = EmailMessage()
+                msg["From"], msg["To"], msg["Subject"] = SENDER, row["Email"], SUBJECT
+                msg.set_content(f"Dear {row['Name']},\n\nPlease find your certificate attached.\n")
+                with open(row["PDFPath"] + ".pdf", "rb") as pdf:
+                    msg.add_attachment(pdf.read(), maintype="application", subtype="pdf",
+                                       filename=os.path.basename(row["PDFPath"]) + ".pdf")
+                try:
+                    limiter.call(server.send_message, msg)
+                except Exception:
+                    failed += 1
+                    continue
+                latencies.append(time.perf_counter() - start)
+    return latencies, failed, 0
+
+
+def run_campaign(sink, csv_path, args, mode):
+    recipients = CsvRecipients(csv_path)
+    options = dict(connections=args.connections, shared_parts=[image_part(LOGO, cid="logo", subtype="png")])
+    cls = Campaign
+    body = BODY
+    if mode == "staged":
+        options.update(staged=True, journal_path=os.path.join(os.path.dirname(csv_path), "journal.sqlite3"))
+    elif mode == "streamlit":
+        cls = StreamlitLike
+        options.update(connections=1, staged=True, dedupe=False)
+    elif mode == "processes":
+        options.update(processes=os.cpu_count() or 1)
+    elif mode == "bcc":
+        body = STATIC_BODY
+        options.update(bcc_batch=args.bcc_batch)
+    template = CompiledTemplate(f"<html><body>{compile_markdown(body, COLUMNS)}</body></html>", COLUMNS)
+    campaign = cls(recipients, template, SUBJECT, SENDER, "pw", name_col="Name", email_col="Email",
+                   host=sink.host, port=sink.port, starttls=False,
+                   retry_policy=RetryPolicy(max_attempts=4, base_delay=args.retry_delay), **options)
+    if mode == "streamlit":
+        campaign.check_attachments()
+    with campaign:
+        latencies = [result.elapsed for result in campaign.results() if result.ok]
+    return latencies, len(campaign.report.failed), campaign.report.retried
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def cpu_seconds(usage):
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_child(args):
+    """One mode, one list size; prints a JSON line with the measurements."""
+    mode, rows = args.child, args.rows[0]
+    with tempfile.TemporaryDirectory(prefix="bench_send_") as workdir:
+        csv_path = make_inputs(workdir, rows, args.pdf_kb)
+        sink = SmtpSink(rtt=args.rtt, latency=args.latency, throttle=args.throttle,
+                        disconnect_every=args.disconnect_every).start()
+        before = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+        start = time.perf_counter()
+        if mode == "script":
+            latencies, failed, retried = run_script(sink, csv_path, args)
+        else:
+            latencies, failed, retried = run_campaign(sink, csv_path, args, mode)
+        seconds = time.perf_counter() - start
+        sink.wait_idle()
+        after = resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+        sink.stop()
+    cpu = sum(cpu_seconds(a) - cpu_seconds(b) for a, b in zip(after, before)) - sink.cpu
+    print(json.dumps({
+        "mode": mode, "rows": rows, "sent": len(latencies), "failed": failed, "retried": retried,
+        "seconds": round(seconds, 3), "msgs_per_s": round(len(latencies) / seconds, 1) if seconds else 0.0,
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2),
+        "cpu_s": round(cpu, 2), "sink_cpu_s": round(sink.cpu, 2),
+        # ru_maxrss is in KiB on Linux; render workers report as children
+        "peak_rss_mb": round(max(after[0].ru_maxrss, after[1].ru_maxrss) / 1024, 1),
+        "throttled": sink.throttled, "dropped": sink.disconnects,
+    }))
+
+
+def child_command(args, mode, rows):
+    command = [sys.executable, os.path.abspath(__file__), "--child", mode, "--rows", str(rows)]
+    for name in ("rtt", "latency", "throttle", "disconnect_every", "connections", "bcc_batch",
+                 "retry_delay", "pdf_kb"):
+        command += ["--" + name.replace("_", "-"), str(getattr(args, name))]
+    return command
+
+
+def regressions(results, baseline, tolerance):
+    saved = {(run["mode"], run["rows"]): run for run in baseline}
+    found = []
+    for run in results:
+        old = saved.get((run["mode"], run["rows"]))
+        if old is None:
+            continue
+        if run["msgs_per_s"] < old["msgs_per_s"] * (1 - tolerance):
+            found.append(f"{run['mode']} x{run['rows']}: {run['msgs_per_s']} msgs/s, was {old['msgs_per_s']}")
+        if run["p99_ms"] > old["p99_ms"] * (1 + tolerance):
+            found.append(f"{run['mode']} x{run['rows']}: p99 {run['p99_ms']} ms, was {old['p99_ms']}")
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=list(MODES))
+    parser.add_argument("--rtt", type=float, default=0.002, help="sink seconds per round trip")
+    parser.add_argument("--latency", type=float, default=0.0, help="sink seconds per accepted message")
+    parser.add_argument("--throttle", type=float, default=0.0, help="fraction of messages answered 451")
+    parser.add_argument("--disconnect-every", type=int, default=0, help="sink drops sessions after N messages")
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument("--bcc-batch", type=int, default=100)
+    parser.add_argument("--retry-delay", type=float, default=0.5)
+    parser.add_argument("--pdf-kb", type=int, default=100, help="size of the per-row PDF attachments")
+    parser.add_argument("--save", metavar="FILE", help="write the results as JSON lines")
+    parser.add_argument("--compare", metavar="FILE", help="saved results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.15)
+    parser.add_argument("--child", choices=MODES, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        return run_child(args)
+
+    print(f"{'mode':10} {'rows':>7} {'sent':>7} {'failed':>6} {'retried':>7} {'msgs/s':>8} "
+          f"{'p50 ms':>8} {'p99 ms':>8} {'cpu s':>7} {'rss MB':>7}")
+    results = []
+    for rows in args.rows:
+        for mode in args.modes:
+            output = subprocess.run(child_command(args, mode, rows), capture_output=True, text=True)
+            if output.returncode:
+                print(f"{mode:10} {rows:>7} failed:\n{output.stderr}")
+                continue
+            run = json.loads(output.stdout.strip().splitlines()[-1])
+            results.append(run)
+            print(f"{mode:10} {rows:>7} {run['sent']:>7} {run['failed']:>6} {run['retried']:>7} "
+                  f"{run['msgs_per_s']:>8} {run['p50_ms']:>8} {run['p99_ms']:>8} {run['cpu_s']:>7} "
+                  f"{run['peak_rss_mb']:>7}", flush=True)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            f.writelines(json.dumps(run) + "\n" for run in results)
+    if args.compare:
+        with open(args.compare) as f:
+            found = regressions(results, [json.loads(line) for line in f if line.strip()], args.tolerance)
+        for line in found:
+            print("REGRESSION", line)
+        return 1 if found else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
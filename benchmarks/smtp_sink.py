@@ -0,0 +1,296 @@
+"""A local SMTP server that accepts and discards everything, for benchmarks.
+
+    python benchmarks/smtp_sink.py [--port 2525] [--rtt 0.02] [--throttle 0.01] [--disconnect-every 50]
+                                   [--defer ashesi.edu.gh=20]
+
+Point a campaign at it with ``--host 127.0.0.1 --port 2525 --no-starttls``.
+It advertises PIPELINING, SIZE and AUTH (any credentials are accepted) but
+not STARTTLS, and can make itself slow or unreliable the way Office 365 is:
+
+* ``rtt``: seconds added before each batch of replies, i.e. once per
+  round trip, so pipelined commands share one delay as on a real link;
+* ``latency``: extra seconds before accepting each message body;
+* ``throttle``: fraction of messages answered ``451 4.7.500 Server busy``;
+* ``disconnect_every``: drop the connection without a reply at the
+  MAIL FROM after that many messages on it;
+* ``defer``: ``{domain: per_second}``; RCPTs to that domain beyond that
+  rate are answered ``450 4.2.1 ... try again later``, the way a school
+  mail server that limits each sending relay does.
+
+Used in-process by ``bench_send.py``:
+
+    with SmtpSink(rtt=0.01) as sink:
+        ...send to sink.host, sink.port...
+    print(sink.messages, sink.cpu)
+
+``delivered`` counts accepted messages per recipient address, so tests
+can check that nobody got a message twice.
+"""
+import argparse
+import collections
+import random
+import socket
+import socketserver
+import threading
+import time
+
+MAX_LINE = 64 * 1024
+
+
+def _address(line):
+    """The lower-cased address in a ``RCPT TO:<...>`` line."""
+    address = line.partition(b":")[2].strip().split(b" ")[0].strip(b"<>")
+    return address.decode("ascii", "replace").lower()
+
+
+class _Session(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = bytearray()
+        self.replies = []
+
+    def handle(self):
+        sink = self.server.sink
+        started = time.thread_time()
+        with sink.lock:
+            sink.connections += 1
+            sink.active += 1
+        try:
+            self.reply("220 sink ESMTP ready")
+            self.flush()
+            self.converse(sink)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with sink.lock:
+                sink.cpu += time.thread_time() - started
+                sink.active -= 1
+
+    def converse(self, sink):
+        sent_here = 0
+        mail = False
+        recipients = []
+        while True:
+            line = self.readline()
+            if line is None:
+                return
+            verb = line[:4].upper()
+            if verb in (b"EHLO", b"HELO"):
+                self.reply("250-sink", "250-PIPELINING", f"250-SIZE {sink.max_size}", "250 AUTH PLAIN LOGIN")
+            elif verb == b"AUTH":
+                self.reply("235 2.7.0 Authentication successful")
+            elif verb == b"MAIL":
+                if sink.disconnect_every and sent_here >= sink.disconnect_every:
+                    with sink.lock:
+                        sink.disconnects += 1
+                    return
+                mail, recipients = True, []
+                self.reply("250 2.1.0 Sender OK")
+            elif verb == b"RCPT":
+                if mail and self.deferred(sink, line):
+                    self.reply("450 4.2.1 Recipient deferred. Please try again later.")
+                elif mail:
+                    recipients.append(_address(line))
+                    self.reply("250 2.1.5 Recipient OK")
+                else:
+                    self.reply("503 5.5.1 Need MAIL first")
+            elif verb == b"DATA" and not recipients:
+                self.reply("554 5.5.1 No valid recipients")
+            elif verb == b"DATA":
+                self.reply("354 Start mail input; end with <CRLF>.<CRLF>")
+                self.flush()
+                size = self.read_body()
+                if size is None:
+                    return
+                mail = False
+                if self.accept(sink, recipients, size):
+                    sent_here += 1
+            elif verb == b"RSET":
+                mail = False
+                self.reply("250 2.0.0 Reset")
+            elif verb == b"NOOP":
+                self.reply("250 2.0.0 OK")
+            elif verb == b"QUIT":
+                self.reply("221 2.0.0 Bye")
+                self.flush()
+                return
+            else:
+                self.reply("502 5.5.2 Command not implemented")
+            # Replies go out once the client has nothing more queued up
+            if b"\n" not in self.buffer:
+                self.flush()
+
+    def deferred(self, sink, line):
+        if not sink.defer:
+            return False
+        domain = _address(line).rpartition("@")[2]
+        rate = sink.defer.get(domain)
+        if not rate:
+            return False
+        with sink.lock:
+            # A one-second token bucket per domain
+            now = time.monotonic()
+            tokens, updated = sink.domain_tokens.get(domain, (rate, now))
+            tokens = min(rate, tokens + (now - updated) * rate)
+            if tokens < 1:
+                sink.domain_tokens[domain] = (tokens, now)
+                sink.deferred[domain] = sink.deferred.get(domain, 0) + 1
+                return True
+            sink.domain_tokens[domain] = (tokens - 1, now)
+        return False
+
+    def accept(self, sink, recipients, size):
+        if sink.latency:
+            time.sleep(sink.latency)
+        with sink.lock:
+            if sink.throttle and sink.random.random() < sink.throttle:
+                sink.throttled += 1
+                self.reply("451 4.7.500 Server busy. Please try again later.")
+                return False
+            sink.messages += 1
+            sink.recipients += len(recipients)
+            sink.delivered.update(recipients)
+            sink.bytes += size
+        self.reply("250 2.0.0 Queued")
+        return True
+
+    def reply(self, *lines):
+        self.replies.extend(lines)
+
+    def flush(self):
+        if self.replies:
+            if self.server.sink.rtt:
+                time.sleep(self.server.sink.rtt)
+            self.request.sendall("".join(line + "\r\n" for line in self.replies).encode("ascii"))
+            self.replies = []
+
+    def fill(self):
+        data = self.request.recv(256 * 1024)
+        if not data:
+            return False
+        self.buffer += data
+        return True
+
+    def readline(self):
+        while True:
+            end = self.buffer.find(b"\n")
+            if end >= 0:
+                line = bytes(self.buffer[:end + 1])
+                del self.buffer[:end + 1]
+                return line.rstrip(b"\r\n")
+            if len(self.buffer) > MAX_LINE or not self.fill():
+                return None
+
+    def read_body(self):
+        """Discard the message up to the lone dot; return its size in bytes."""
+        size = 0
+        if self.buffer.startswith(b".\r\n"):
+            del self.buffer[:3]
+            return size
+        while True:
+            end = self.buffer.find(b"\r\n.\r\n")
+            if end >= 0:
+                size += end + 2
+                del self.buffer[:end + 5]
+                return size
+            # Keep a tail that may be the start of the terminator
+            keep = 4
+            if len(self.buffer) > keep:
+                size += len(self.buffer) - keep
+                del self.buffer[:-keep]
+            if not self.fill():
+                return None
+            if size == 0 and self.buffer.startswith(b".\r\n"):
+                del self.buffer[:3]
+                return size
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+
+class SmtpSink:
+    """Threaded fake SMTP server; counters are totals since ``start``."""
+
+    def __init__(self, host="127.0.0.1", port=0, rtt=0.0, latency=0.0, throttle=0.0,
+                 disconnect_every=0, defer=None, max_size=150 * 1024 * 1024, seed=0):
+        self.rtt = rtt
+        self.latency = latency
+        self.throttle = throttle
+        self.disconnect_every = disconnect_every
+        self.defer = {domain.lower(): fraction for domain, fraction in (defer or {}).items()}
+        self.max_size = max_size
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.recipients = 0
+        self.bytes = 0
+        self.throttled = 0
+        self.disconnects = 0
+        self.deferred = {}
+        self.delivered = collections.Counter()
+        self.domain_tokens = {}
+        self.connections = 0
+        self.active = 0
+        self.cpu = 0.0
+        self._server = _Server((host, port), _Session)
+        self._server.sink = self
+        self.host, self.port = self._server.server_address[:2]
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, name="smtp-sink", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def wait_idle(self, timeout=5.0):
+        """Wait for clients to hang up, so ``cpu`` includes every session."""
+        deadline = time.monotonic() + timeout
+        while self.active and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def summary(self):
+        return (f"{self.messages} messages, {self.recipients} recipients, {self.bytes / 1e6:.1f} MB, "
+                f"{self.throttled} throttled, {sum(self.deferred.values())} deferred, {self.disconnects} dropped, "
+                f"{self.connections} connections")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake SMTP server that discards all mail.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=2525)
+    parser.add_argument("--rtt", type=float, default=0.0, help="seconds per round trip")
+    parser.add_argument("--latency", type=float, default=0.0, help="extra seconds per accepted message")
+    parser.add_argument("--throttle", type=float, default=0.0, help="fraction of messages answered 451")
+    parser.add_argument("--disconnect-every", type=int, default=0, help="drop each connection after N messages")
+    parser.add_argument("--defer", action="append", default=[], metavar="DOMAIN=RATE",
+                        help="answer RCPTs to DOMAIN beyond RATE per second with 450 (repeatable)")
+    args = parser.parse_args()
+    defer = {domain: float(fraction) for domain, _, fraction in (item.partition("=") for item in args.defer)}
+    sink = SmtpSink(args.host, args.port, rtt=args.rtt, latency=args.latency, throttle=args.throttle,
+                    disconnect_every=args.disconnect_every, defer=defer).start()
+    print(f"SMTP sink listening on {sink.host}:{sink.port}; Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(10)
+            print(sink.summary())
+    except KeyboardInterrupt:
+        sink.stop()
+        print(sink.summary())
+
+
+if __name__ == "__main__":
+    main()
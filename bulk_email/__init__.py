@@ -0,0 +1,45 @@
+"""Shared sending core used by the notebook cells, the Streamlit app and the scripts."""
+
+from .assets import Asset, AssetStore
+from .attachments import AttachmentLoader
+from .domains import DOMAIN_PROFILES, DomainScheduler
+from .engine import SendEngine, SendJob, SendResult
+from .metrics import Metrics
+from .pipeline import SendPipeline, StageStats
+from .preview import PreviewCache
+from .ratelimit import PROFILES, QuotaExceeded, RateLimiter, limiter_for
+from .scheduler import Scheduler, Windows, Worker
+from .senders import SenderAccount, SenderPool
+from .smtp import PipeliningSMTP, SMTPConnection, open_session
+from .spool import Spool, SpoolWriter
+from .uploads import UploadSpool
+
+__all__ = [
+    "Asset",
+    "AssetStore",
+    "AttachmentLoader",
+    "DOMAIN_PROFILES",
+    "DomainScheduler",
+    "Metrics",
+    "PROFILES",
+    "PipeliningSMTP",
+    "PreviewCache",
+    "QuotaExceeded",
+    "RateLimiter",
+    "SMTPConnection",
+    "Scheduler",
+    "SendEngine",
+    "SendJob",
+    "SendPipeline",
+    "SendResult",
+    "SenderAccount",
+    "SenderPool",
+    "Spool",
+    "SpoolWriter",
+    "StageStats",
+    "UploadSpool",
+    "Windows",
+    "Worker",
+    "limiter_for",
+    "open_session",
+]
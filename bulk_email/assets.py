@@ -0,0 +1,200 @@
+import base64
+import hashlib
+import mimetypes
+import os
+import threading
+from collections import OrderedDict
+
+from .mime import attachment_part, image_part
+
+# Leading bytes of the image types mail clients display inline
+IMAGE_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpeg"),
+    (b"GIF87a", "gif"),
+    (b"GIF89a", "gif"),
+)
+
+
+def sniff_image(data):
+    """Image subtype from the file's leading bytes, or ``None``."""
+    for signature, subtype in IMAGE_SIGNATURES:
+        if data.startswith(signature):
+            return subtype
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+class Asset:
+    """One file's bytes, identified by their SHA-256.
+
+    The MIME type is worked out once on load, and every encoding of the
+    asset (data URL, inline image part, attachment part) is computed on
+    first use and kept, so previews, test sends and the bulk run share them.
+    """
+
+    def __init__(self, digest, data, filename, content_type):
+        self.digest = digest
+        self.data = data
+        self.filename = filename
+        self.content_type = content_type
+        self.maintype, _, self.subtype = content_type.partition("/")
+        self._encoded = {}
+        self.size = len(data)
+        self.store = None
+
+    def _cached(self, key, encode):
+        value = self._encoded.get(key)
+        if value is None:
+            value = self._encoded[key] = encode()
+            store = self.store
+            if store is not None:
+                store._grew(self, len(value))
+            else:
+                self.size += len(value)
+        return value
+
+    def data_url(self):
+        """``data:`` URL for embedding the asset straight into HTML."""
+        return self._cached("data_url", lambda: (
+            f"data:{self.content_type};base64,{base64.b64encode(self.data).decode('ascii')}"))
+
+    def image_part(self, cid=None, filename=None, inline=True):
+        """Pre-serialized image part for a ``MessageSkeleton``."""
+        if self.maintype != "image":
+            raise ValueError(f"{self.filename or self.digest[:12]} is not an image")
+        return self._cached(("image", cid, filename, inline), lambda: image_part(
+            self.data, cid=cid, filename=filename, inline=inline, subtype=self.subtype))
+
+    def attachment_part(self, filename=None):
+        """Pre-serialized attachment part for a ``MessageSkeleton``."""
+        filename = filename or self.filename or self.digest[:12]
+        subtype = self.subtype if self.maintype == "application" else "octet-stream"
+        return self._cached(("attachment", filename), lambda: attachment_part(self.data, filename, subtype=subtype))
+
+
+class AssetStore:
+    """Size-bounded LRU of ``Asset``s keyed by content hash.
+
+    ``add`` takes bytes (an upload) and ``load`` a path. Identical content
+    is stored once, whatever it is called. ``load`` remembers each file's
+    size and mtime, so asking again for an unchanged file costs a ``stat``
+    instead of a read, and many recipients sharing one certificate touch
+    the disk once. When the assets and their cached encodings exceed
+    ``max_bytes`` the least recently used are dropped. Safe to share
+    between sender threads.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._assets = OrderedDict()
+        self._paths = {}
+        self.lock = threading.Lock()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __getstate__(self):
+        # Render worker processes get a copy of the cache, minus the lock
+        state = self.__dict__.copy()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._assets)
+
+    def __contains__(self, digest):
+        return digest in self._assets
+
+    def add(self, data, filename=None, content_type=None):
+        """Store ``data`` (bytes or any buffer) or find it already stored; return its ``Asset``."""
+        if not data:
+            raise ValueError(f"{filename or 'Asset'} is empty")
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            asset = self._assets.get(digest)
+            if asset is not None:
+                self._assets.move_to_end(digest)
+                self.hits += 1
+                return asset
+        asset = Asset(digest, bytes(data), filename, content_type or self._content_type(data, filename))
+        with self.lock:
+            if digest in self._assets:
+                return self._assets[digest]
+            self.misses += 1
+            asset.store = self
+            self._assets[digest] = asset
+            self.size += asset.size
+            self._evict()
+            return asset
+
+    def load(self, path):
+        """``add`` the file at ``path``, reading it only if it's new or has changed."""
+        stat = os.stat(path)
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self.lock:
+            digest = self._paths.get(key)
+            if digest in self._assets:
+                self._assets.move_to_end(digest)
+                self.hits += 1
+                return self._assets[digest]
+        with open(path, "rb") as f:
+            asset = self.add(f.read(), os.path.basename(path))
+        with self.lock:
+            self._paths[key] = asset.digest
+        return asset
+
+    def get(self, digest):
+        with self.lock:
+            asset = self._assets.get(digest)
+            if asset is not None:
+                self._assets.move_to_end(digest)
+            return asset
+
+    def clear(self):
+        with self.lock:
+            for asset in self._assets.values():
+                asset.store = None
+            self._assets.clear()
+            self._paths.clear()
+            self.size = 0
+
+    def _content_type(self, data, filename):
+        """Validate and type the content; images are typed by their bytes, not their name."""
+        head = bytes(data[:1024])
+        image = sniff_image(head)
+        guessed = mimetypes.guess_type(filename)[0] if filename else None
+        if image:
+            return f"image/{image}"
+        if guessed == "image/svg+xml" and b"<svg" in head:
+            return guessed
+        if guessed and guessed.startswith("image/"):
+            raise ValueError(f"{filename} is not a readable PNG, JPEG, GIF or WebP image")
+        if guessed == "application/pdf" and b"%PDF-" not in head:
+            raise ValueError(f"{filename} is not a PDF")
+        return guessed or "application/octet-stream"
+
+    def _grew(self, asset, nbytes):
+        with self.lock:
+            asset.size += nbytes
+            if asset.store is self:
+                self.size += nbytes
+                self._evict()
+
+    def _evict(self):
+        evicted = False
+        # The newest asset always stays, even if it alone is over budget
+        while self.size > self.max_bytes and len(self._assets) > 1:
+            _, asset = self._assets.popitem(last=False)
+            asset.store = None
+            self.size -= asset.size
+            self.evictions += 1
+            evicted = True
+        if evicted:
+            self._paths = {key: digest for key, digest in self._paths.items() if digest in self._assets}
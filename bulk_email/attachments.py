@@ -0,0 +1,87 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .assets import AssetStore
+
+
+def _file_size(path):
+    try:
+        return os.stat(path).st_size
+    except OSError:
+        return None
+
+
+class AttachmentLoader:
+    """Reads per-recipient attachments off the send path.
+
+    ``scan(paths)`` stats every distinct path in parallel before sending so
+    missing files are reported up front. During the run ``prefetch(path)``
+    is called as each recipient is queued: up to ``ahead`` files are loaded
+    and encoded into the ``AssetStore`` by background threads, and
+    ``get(path)`` hands the result over, usually without waiting on disk.
+    Files past the lookahead wait their turn in queue order.
+    """
+
+    def __init__(self, store=None, workers=8, ahead=16):
+        self.store = store if store is not None else AssetStore()
+        self.ahead = ahead
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="attachments")
+        self.lock = threading.Lock()
+        self._futures = {}
+        self._waiting = deque()
+        self.prefetched = 0
+        self.waited = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def scan(self, paths):
+        """Return ``(sizes, missing)``: ``{path: bytes}`` for files found, sorted missing paths."""
+        unique = list(dict.fromkeys(paths))
+        sizes = dict(zip(unique, self.pool.map(_file_size, unique)))
+        missing = sorted(path for path, size in sizes.items() if size is None)
+        return {path: size for path, size in sizes.items() if size is not None}, missing
+
+    def prefetch(self, path):
+        with self.lock:
+            if path in self._futures or path in self._waiting:
+                return
+            if len(self._futures) < self.ahead:
+                self._submit(path)
+            else:
+                self._waiting.append(path)
+
+    def get(self, path):
+        """The ``Asset`` for ``path``, from the prefetch if there was one."""
+        with self.lock:
+            future = self._futures.pop(path, None)
+            if future is None and path in self._waiting:
+                self._waiting.remove(path)
+            while self._waiting and len(self._futures) < self.ahead:
+                self._submit(self._waiting.popleft())
+        if future is None:
+            return self._load(path)
+        if not future.done():
+            self.waited += 1
+        return future.result()
+
+    def close(self):
+        with self.lock:
+            self._waiting.clear()
+            self._futures.clear()
+        self.pool.shutdown(cancel_futures=True)
+
+    def _submit(self, path):
+        self._futures[path] = self.pool.submit(self._load, path)
+        self.prefetched += 1
+
+    def _load(self, path):
+        asset = self.store.load(path)
+        # Encode here too, so the sender only splices finished bytes
+        asset.attachment_part()
+        return asset
@@ -0,0 +1,578 @@
+import collections
+import functools
+import hashlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .assets import AssetStore
+from .attachments import AttachmentLoader
+from .domains import DomainScheduler
+from .engine import SendEngine, SendJob, SendResult, describe_error
+from .journal import FAILED, QUEUED, SENT, SendJournal, campaign_id
+from .metrics import Metrics
+from .mime import MessageSkeleton, SpooledPart
+from .pipeline import SendPipeline
+from .ratelimit import RateLimiter, limiter_for
+from .recipients import detect_columns, iter_clean_chunks
+from .render_pool import RenderPool
+from .retry import RetryPolicy
+from .smtp import OFFICE365_HOST, OFFICE365_PORT, SMTPConnection
+from .spool import Spool, SpoolWriter
+
+# Rows sent to a render worker process per task
+RENDER_BATCH = 16
+
+
+def _parts_digest(parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        for block in part.chunks() if isinstance(part, SpooledPart) else (part,):
+            digest.update(block)
+        digest.update(b"\x1f")
+    return digest.hexdigest()
+
+
+class CampaignReport:
+    """Running totals for one campaign run."""
+
+    def __init__(self, total):
+        self.total = total
+        self.sent = 0
+        self.skipped = 0
+        self.retried = 0
+        self.failed = []
+        self.stopped = False
+        self.stages = {}
+        self.domains = []
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def completed(self):
+        return not self.stopped and self.sent + self.skipped == self.total
+
+
+class Campaign:
+    """One bulk send, independent of any UI.
+
+    ``recipients`` is a ``CsvRecipients`` stream and ``template`` anything with
+    ``render(row)`` (normally a ``CompiledTemplate``). Front ends build a
+    campaign, open it and iterate ``results()`` to drive their own progress
+    display:
+
+        with Campaign(recipients, template, subject, sender, password) as campaign:
+            for result in campaign.results():
+                ...
+        print(campaign.report.sent)
+
+    Subclasses can override ``render_html``, ``cc_for`` and
+    ``attachments_for`` for per-row content; ``self.assets`` (an
+    ``AssetStore``) loads and encodes each distinct file once, e.g.
+    ``[self.assets.load(row['PDFPath']).attachment_part()]``.
+
+    Per-row files are best named by ``attachment_paths(row)`` instead (or
+    the ``attachment_col`` column): ``check_attachments()`` then stats them
+    all in parallel before sending, and while sending the next ``prefetch``
+    files are read and encoded in the background (see ``AttachmentLoader``).
+
+    With ``staged`` the sends go through a ``SendPipeline`` so reading,
+    rendering and sending overlap; ``report.stages`` then holds per-stage
+    timings.
+
+    ``processes`` builds messages in that many worker processes (see
+    ``RenderPool``) for CPU-heavy templates; it implies ``staged``, and the
+    campaign, including any subclass, must be picklable.
+
+    ``metrics`` (a ``Metrics``, one is made if not given) times every stage:
+    CSV read, validation, render, MIME build, serialization, SMTP
+    connect/login, each SMTP reply and the whole send, and counts messages,
+    bytes and failures; ``metrics.table()`` feeds the front ends' dashboards.
+
+    With ``bcc_batch`` set, a template without placeholders is sent once per
+    group of that many recipients (capped at the server's RCPT limit), all
+    of them in the envelope only; per-row hooks are not used then.
+
+    ``senders`` (a ``SenderPool``) spreads the recipients over several
+    accounts instead of logging in as ``sender``, each with its own quota
+    and rate limits; ``host``, ``port`` and ``password`` are then unused and
+    ``max_rate`` caps the pool as a whole.
+
+    ``daily_quota`` replaces the host profile's per-day budget for this run
+    (e.g. with what a scheduled job has left of today's): the run stops,
+    like on any exhausted quota, before a message would go over it.
+
+    A campaign's journal id comes from the sender, the subject and a
+    digest of the template, the shared parts and the whole recipient file,
+    so resuming only ever skips recipients of the very same send. Give a
+    ``name`` to key it by sender and name alone instead, e.g. to resume
+    after fixing a typo in the template.
+
+    ``build_spool(path)`` renders every message to disk instead of sending
+    it, for ``SpoolCampaign`` to deliver later.
+
+    ``domain_limits`` (a dict in the ``DOMAIN_PROFILES`` form, ``{}`` for
+    the defaults) sends by recipient domain: domains take turns, each
+    within its own concurrency (``connections`` unless set) and rate
+    limits, and one that defers backs off alone while the others carry on
+    (see ``DomainScheduler``). ``report.domains`` then lists per-domain
+    sent and deferred counts.
+    """
+
+    def __init__(self, recipients, template, subject, sender, password=None, name_col=None,
+                 email_col=None, host=OFFICE365_HOST, port=OFFICE365_PORT, starttls=True,
+                 connections=4, max_rate=None, recycle_after=200, retry_policy=None,
+                 journal_path=None, resume=True, dedupe=True, shared_parts=(), bcc_batch=None,
+                 pipelining=True, staged=False, builders=2, processes=None, assets=None,
+                 attachment_col=None, prefetch=16, metrics=None, senders=None, daily_quota=None,
+                 domain_limits=None, name=None):
+        self.recipients = recipients
+        self.template = template
+        self.subject = subject
+        self.sender = sender
+        self.password = password
+        if name_col is None or email_col is None:
+            name_candidates, email_candidates = detect_columns(recipients.columns)
+            if name_col is None and name_candidates:
+                name_col = name_candidates[0]
+            if email_col is None:
+                if not email_candidates:
+                    raise ValueError("Couldn't detect the email column; pass email_col")
+                email_col = email_candidates[0]
+        self.name_col = name_col
+        self.email_col = email_col
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.pipelining = pipelining
+        self.staged = staged or bool(processes)
+        self.builders = builders
+        self.processes = processes
+        self.render_pool = None
+        self.connections = connections
+        self.max_rate = max_rate
+        self.recycle_after = recycle_after
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        self.journal_path = journal_path
+        self.resume = resume
+        self.dedupe = dedupe
+        if bcc_batch and getattr(template, 'fields', None):
+            raise ValueError("Bcc batches need a template without {{column}} placeholders")
+        self.bcc_batch = bcc_batch
+        self.batch_size = 1
+        self._shared_message = None
+        self.assets = assets if assets is not None else AssetStore()
+        self.attachment_col = attachment_col
+        self.prefetch = prefetch
+        self.loader = None
+        self.missing_attachments = set()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.senders = senders
+        self.daily_quota = daily_quota
+        self.domain_limits = domain_limits
+        self.domains = None
+        if senders is not None and senders.metrics is None:
+            senders.metrics = self.metrics
+        self.skeleton = MessageSkeleton(shared_parts, subtype='related' if shared_parts else 'alternative')
+        self.name = name
+        self._parts_digest = _parts_digest(shared_parts)
+        self._id = None
+        self.report = None
+        self.engine = None
+        self.journal = None
+        self.already_sent = set()
+
+    def __getstate__(self):
+        # Render workers only need what build() uses
+        state = self.__dict__.copy()
+        state.update(recipients=None, password=None, report=None, engine=None, journal=None,
+                     render_pool=None, loader=None, senders=None, domains=None, already_sent=set())
+        return state
+
+    @property
+    def id(self):
+        """Journal key: sender and ``name``, or sender, subject and a digest of the content."""
+        if self._id is None:
+            if self.name:
+                self._id = campaign_id(self.sender, self.name)
+            else:
+                self._id = campaign_id(self.sender, self.subject, self.content_digest())
+        return self._id
+
+    def content_digest(self):
+        """SHA-256 over the template, the shared parts and the recipient file."""
+        template = self.template
+        if hasattr(template, 'marked'):
+            template = f"{template.marked}\x1f{','.join(template.columns)}"
+        elif not isinstance(template, str):
+            # Nothing stable to hash; the template's type at least keeps it apart from others
+            template = type(template).__qualname__
+        digest = hashlib.sha256()
+        for part in (str(template), self._parts_digest, self.recipients.digest()):
+            digest.update(part.encode("utf-8") + b"\x1f")
+        return digest.hexdigest()
+
+    # --- Per-row content -------------------------------------------------
+
+    def render_html(self, row):
+        return self.template.render(row)
+
+    def cc_for(self, row):
+        return []
+
+    def attachment_paths(self, row):
+        if self.attachment_col is None:
+            return []
+        path = row[self.attachment_col]
+        return [path.strip()] if isinstance(path, str) and path.strip() else []
+
+    def attachments_for(self, row):
+        loader = self.loader
+        return [(loader.get(path) if loader is not None else self.assets.load(path)).attachment_part()
+                for path in self.attachment_paths(row)]
+
+    def build(self, row, recipient):
+        return self.assemble(self.build_parts(row, recipient))
+
+    def build_parts(self, row, recipient):
+        """``build`` minus the shared MIME parts, which ``assemble`` splices back in."""
+        start = time.perf_counter()
+        html = self.render_html(row)
+        rendered = time.perf_counter()
+        cc = self.cc_for(row)
+        headers = [("Subject", self.subject), ("From", self.sender), ("To", recipient)]
+        if cc:
+            headers.append(("Cc", ", ".join(cc)))
+        attachments = self.attachments_for(row)
+        built = time.perf_counter()
+        parts = self.skeleton.build_split(headers, html, attachments)
+        metrics = self.metrics
+        metrics.observe("render_seconds", rendered - start)
+        metrics.observe("mime_build_seconds", built - rendered)
+        metrics.observe("serialize_seconds", time.perf_counter() - built)
+        return self.sender, [recipient] + cc, parts
+
+    def assemble(self, envelope):
+        from_addr, to_addrs, (head, tail) = envelope
+        message = self.skeleton.join(head, tail)
+        self.metrics.count("message_bytes", len(message))
+        return from_addr, to_addrs, message
+
+    def build_batch(self, recipients):
+        """Same message for every address in ``recipients``; built once per campaign."""
+        if self._shared_message is None:
+            headers = [("Subject", self.subject), ("From", self.sender), ("To", self.sender)]
+            self._shared_message = self.skeleton.build(headers, self.template.render({}))
+        return self.sender, list(recipients), self._shared_message
+
+    # --- Running ---------------------------------------------------------
+
+    def connect(self):
+        if self.senders is not None:
+            return self.senders.connect(recycle_after=self.recycle_after, pipelining=self.pipelining,
+                                        metrics=self.metrics)
+        return SMTPConnection(self.host, self.port, self.sender, self.password,
+                              starttls=self.starttls, recycle_after=self.recycle_after,
+                              pipelining=self.pipelining, metrics=self.metrics).connect()
+
+    def check_attachments(self):
+        """Stat every row's ``attachment_paths`` in parallel; return the missing ones, sorted.
+
+        They are also kept in ``missing_attachments`` for subclasses that
+        prefer to send without a missing file.
+        """
+        if self.loader is None:
+            self.loader = AttachmentLoader(self.assets, ahead=self.prefetch)
+        _, missing = self.loader.scan(path for row in self.recipients for path in self.attachment_paths(row))
+        self.missing_attachments = set(missing)
+        return missing
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self):
+        """Open the journal and every SMTP session; login errors are raised here."""
+        self.report = CampaignReport(self.recipients.count())
+        self.metrics.start()
+        if self.journal_path:
+            self.journal = SendJournal(self.journal_path, self.id)
+            if self.resume:
+                self.already_sent = self.journal.delivered()
+        if self.senders is not None:
+            # Each account paces itself; this only applies max_rate and never backs off
+            limiter = RateLimiter(per_second=self.max_rate, per_day=self.daily_quota, burst=self.connections,
+                                  min_factor=1.0, pause=0.0)
+        else:
+            limiter = limiter_for(self.host, per_second=self.max_rate, per_day=self.daily_quota)
+        if self.domain_limits is not None:
+            self.domains = DomainScheduler(self.domain_limits, concurrency=self.connections, metrics=self.metrics)
+        if self.processes and not self.bcc_batch:
+            self.render_pool = RenderPool(self, self.processes)
+        elif self.loader is None and self.prefetch and not self.bcc_batch:
+            self.loader = AttachmentLoader(self.assets, ahead=self.prefetch)
+        if self.staged:
+            pool = self.render_pool
+            self.engine = SendPipeline(self.connect, connections=self.connections,
+                                       builders=pool.processes if pool else self.builders,
+                                       limiter=limiter, retry_policy=self.retry_policy,
+                                       build_executor=pool.executor if pool else None,
+                                       assemble=self.assemble if pool else None,
+                                       build_batch=RENDER_BATCH if pool else 1, domains=self.domains)
+        else:
+            self.engine = SendEngine(self.connect, connections=self.connections, limiter=limiter,
+                                     retry_policy=self.retry_policy, domains=self.domains)
+        try:
+            self.engine.open()
+            if self.bcc_batch:
+                self.batch_size = min(self.bcc_batch, self.engine.sessions[0].rcpt_limit())
+        except Exception:
+            self.close()
+            raise
+
+    def close(self):
+        if self.engine is not None:
+            self.engine.close()
+            self.report.retried = self.engine.retried
+            self.engine = None
+        if self.render_pool is not None:
+            self.render_pool.shutdown()
+            self.render_pool = None
+        if self.loader is not None:
+            self.loader.close()
+            self.loader = None
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.report is not None and self.report.finished is None:
+            self.report.finished = time.time()
+        self.metrics.close()
+
+    def _record(self, recipient, state, detail=None):
+        if self.journal is not None:
+            self.journal.record(recipient, state, detail)
+
+    def jobs(self):
+        """Cleaned, not-yet-sent rows as ``SendJob``s; rejects go straight to the report."""
+        name_col, email_col = self.name_col, self.email_col
+        batch = []
+        for clean, rejects in iter_clean_chunks(self.recipients, email_col, dedupe=self.dedupe,
+                                                metrics=self.metrics):
+            self.metrics.count("rows_rejected", len(rejects))
+            for row in rejects.to_dict('records'):
+                name = str(row[name_col]).strip() if name_col else ''
+                self.report.failed.append((name, str(row[email_col]).strip(), row['reason']))
+            for row in clean.to_dict('records'):
+                recipient = row[email_col]
+                if recipient in self.already_sent:
+                    self.report.skipped += 1
+                    continue
+                name = str(row[name_col]).strip() if name_col else recipient
+                if self.bcc_batch:
+                    batch.append((name, recipient))
+                    if len(batch) >= self.batch_size:
+                        yield self._batch_job(batch)
+                        batch = []
+                    continue
+                if self.render_pool is not None:
+                    build = self.render_pool.build_for(row, recipient)
+                    queued = functools.partial(self._record, recipient, QUEUED)
+                else:
+                    build = functools.partial(self.build, row, recipient)
+                    queued = functools.partial(self._queued, row, recipient)
+                yield self._job(name, recipient, build, queued)
+        if batch:
+            yield self._batch_job(batch)
+
+    def _job(self, name, recipient, build, queued):
+        """A ``SendJob`` whose ``queued`` (journal write, prefetch) runs as it's about to be sent."""
+        if self.domains is None:
+            # Jobs are pulled only a little ahead of sending
+            queued()
+            return SendJob(name, recipient, build)
+        # The domain scheduler reads far ahead; it calls this when it hands the job out
+        return SendJob(name, recipient, build, on_dispatch=queued)
+
+    def _queued(self, row, recipient):
+        self._record(recipient, QUEUED)
+        # Queued just ahead of sending, so this is the prefetch lookahead
+        if self.loader is not None:
+            for path in self.attachment_paths(row):
+                if path not in self.missing_attachments:
+                    self.loader.prefetch(path)
+
+    def _record_all(self, recipients, state):
+        for recipient in recipients:
+            self._record(recipient, state)
+
+    def _batch_job(self, batch):
+        names, recipients = zip(*batch)
+        return self._job(names, recipients, lambda: self.build_batch(recipients),
+                         functools.partial(self._record_all, recipients, QUEUED))
+
+    def _split(self, result):
+        """One result per address: batch jobs carry tuples of names and recipients."""
+        job = result.job
+        if not isinstance(job.recipient, tuple):
+            yield result
+            return
+        for name, recipient in zip(job.name, job.recipient):
+            single = SendJob(name, recipient, job.build)
+            single.attempts = job.attempts
+            if result.ok and recipient in result.refused:
+                yield SendResult(single, False, "Recipient email refused by server", result.elapsed)
+            else:
+                yield SendResult(single, result.ok, result.error, result.elapsed, result.exception)
+
+    def build_spool(self, path):
+        """Render every message into a spool directory at ``path`` instead of sending it.
+
+        Rows get the same cleaning, de-duplication and per-row hooks as a
+        send and build on ``builders`` threads (or ``processes``), in list
+        order. Nothing connects and the journal isn't consulted, so the
+        spool holds the whole list; ``SpoolCampaign`` skips what was already
+        sent when it delivers. Yields a ``SendResult`` per job as it is
+        written (``ok`` False if it failed to build); render failures and
+        rejected rows are also kept in the spool's manifest.
+        """
+        self.report = CampaignReport(self.recipients.count())
+        self.metrics.start()
+        if self.processes and not self.bcc_batch:
+            self.render_pool = RenderPool(self, self.processes)
+        elif self.loader is None and self.prefetch and not self.bcc_batch:
+            self.loader = AttachmentLoader(self.assets, ahead=self.prefetch)
+        if self.bcc_batch:
+            # No server to ask for its RCPT limit; deliver with a relay that takes this many
+            self.batch_size = self.bcc_batch
+        report = self.report
+        writer = SpoolWriter(path, {"campaign": self.id, "subject": self.subject, "sender": self.sender,
+                                    "boundary": self.skeleton.boundary})
+        try:
+            for job, ok, value, elapsed in self._build_in_order(self.jobs()):
+                if ok:
+                    from_addr, to_addrs, message = value
+                    writer.add(job.name, job.recipient, from_addr, to_addrs, message)
+                    report.sent += len(job.recipient) if isinstance(job.recipient, tuple) else 1
+                    self.metrics.count("messages_built")
+                    yield SendResult(job, True, elapsed=elapsed)
+                else:
+                    result = SendResult(job, False, describe_error(value), elapsed, value)
+                    for single in self._split(result):
+                        report.failed.append((single.name, single.recipient, single.error))
+                    self.metrics.count("messages_failed")
+                    yield result
+            writer.close(failed=report.failed)
+        except BaseException:
+            writer.abort()
+            raise
+        finally:
+            self.close()
+
+    def _build_in_order(self, jobs):
+        """``(job, ok, envelope or exception, seconds)`` per job, built in parallel but yielded in order."""
+        pool = self.render_pool
+        executor = pool.executor if pool is not None else ThreadPoolExecutor(self.builders)
+        window = collections.deque()
+        limit = (pool.processes if pool is not None else self.builders) * 4
+        try:
+            for job in jobs:
+                window.append((job, time.perf_counter(), executor.submit(job.build)))
+                if len(window) >= limit:
+                    yield self._built(*window.popleft())
+            while window:
+                yield self._built(*window.popleft())
+        finally:
+            if pool is None:
+                executor.shutdown(cancel_futures=True)
+
+    def _built(self, job, start, future):
+        try:
+            value = future.result()
+        except Exception as e:
+            return job, False, e, time.perf_counter() - start
+        if self.render_pool is not None:
+            value = self.assemble(value)
+        return job, True, value, time.perf_counter() - start
+
+    def results(self, should_stop=None):
+        """Send everything and yield each job's final ``SendResult``."""
+        report = self.report
+        metrics = self.metrics
+        for batch_result in self.engine.run(self.jobs(), should_stop=should_stop):
+            metrics.observe("send_seconds", batch_result.elapsed)
+            for result in self._split(batch_result):
+                if result.ok:
+                    report.sent += 1
+                    metrics.count("messages_sent")
+                    self._record(result.recipient, SENT)
+                else:
+                    report.failed.append((result.name, result.recipient, result.error))
+                    metrics.count("messages_failed")
+                    self._record(result.recipient, FAILED, result.error)
+                yield result
+        report.stopped = self.engine.stopped
+        report.retried = self.engine.retried
+        metrics.count("messages_retried", report.retried)
+        report.stages = getattr(self.engine, 'stats', {})
+        if self.domains is not None:
+            report.domains = self.domains.summary()
+
+
+class SpoolCampaign(Campaign):
+    """Delivers a spool made by ``Campaign.build_spool``.
+
+    Each message's bytes go from the spool straight to ``sendmail``, so
+    sending does no rendering at all. Everything about delivery works as
+    for ``Campaign``: connections, rate limits, retries, ``senders``,
+    ``domain_limits`` and the journal, under the built campaign's id, so a
+    delivery resumes a send of the same campaign and vice versa.
+
+        with SpoolCampaign("campaign.spool", password, connections=4) as campaign:
+            for result in campaign.results():
+                ...
+    """
+
+    def __init__(self, spool, password=None, **options):
+        if not isinstance(spool, Spool):
+            spool = Spool(spool)
+        manifest = spool.manifest
+        # Nothing left to render or read ahead
+        options.update(prefetch=0, processes=None)
+        super().__init__(spool, None, manifest["subject"], manifest["sender"], password,
+                         name_col="name", email_col="recipient", **options)
+        self.spool = spool
+        self._id = manifest["campaign"]
+
+    def build_spool(self, path):
+        raise TypeError("A spool is already built")
+
+    def jobs(self):
+        spool = self.spool
+        for entry in spool.entries():
+            if isinstance(entry["recipient"], list):
+                # A Bcc batch: leave addresses already sent out of the envelope
+                pairs = [(name, recipient) for name, recipient in zip(entry["name"], entry["recipient"])
+                         if recipient not in self.already_sent]
+                self.report.skipped += len(entry["recipient"]) - len(pairs)
+                if not pairs:
+                    continue
+                names, recipients = zip(*pairs)
+                yield self._job(names, recipients, functools.partial(spool.envelope, entry, list(recipients)),
+                                functools.partial(self._record_all, recipients, QUEUED))
+                continue
+            recipient = entry["recipient"]
+            if recipient in self.already_sent:
+                self.report.skipped += 1
+                continue
+            yield self._job(entry["name"], recipient, functools.partial(spool.envelope, entry),
+                            functools.partial(self._record, recipient, QUEUED))
+
+    def close(self):
+        super().close()
+        self.spool.close()
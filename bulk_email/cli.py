@@ -0,0 +1,468 @@
+"""Command-line campaign runner.
+
+    python -m bulk_email send recipients.csv --template body.md --subject "Hello"
+
+Credentials come from EMAIL_USER / EMAIL_PASSWORD (a .env file is read when
+python-dotenv is installed). With ``--senders accounts.json`` the recipients
+are shared between several accounts instead (see ``SenderPool.from_file``)
+and EMAIL_USER is only the From address:
+
+    [{"username": "events1@org.edu", "password_env": "EVENTS1_PASSWORD", "per_day": 10000},
+     {"username": "events2@org.edu", "password_env": "EVENTS2_PASSWORD"}]
+
+``--per-domain N`` and ``--domain-limits limits.json`` send by recipient
+domain, each with its own limits and backoff (see ``DomainScheduler``):
+
+    {"default": {"concurrency": 2}, "ashesi.edu.gh": {"concurrency": 1, "per_minute": 60}}
+
+``build`` renders every message into a spool directory without sending,
+``inspect`` summarizes, verifies or compares spools and ``deliver`` sends
+one, resuming through the same journal as ``send``:
+
+    python -m bulk_email build recipients.csv --template body.md --subject "Hello" --out hello.spool
+    python -m bulk_email inspect hello.spool --show 0
+    python -m bulk_email deliver hello.spool --connections 4
+"""
+import argparse
+import collections
+import json
+import logging
+import os
+import sys
+from datetime import datetime
+
+from .campaign import Campaign, SpoolCampaign
+from .domains import domain_of
+from .logs import log_result, queue_logging
+from .metrics import JsonLinesSink, Metrics, PrometheusSink
+from .recipients import CsvRecipients
+from .retry import RetryPolicy
+from .scheduler import Scheduler, Worker
+from .senders import SenderPool
+from .smtp import OFFICE365_HOST, OFFICE365_PORT
+from .spool import Spool
+from .template import load_template
+from .uploads import UploadSpool
+
+try:
+    from dotenv import load_dotenv
+except ImportError:
+    load_dotenv = None
+
+logger = logging.getLogger("bulk_email")
+
+SCHEDULE_DB = "send_schedule.sqlite3"
+
+
+def add_content_arguments(command):
+    """What to send: options shared by ``send``, ``schedule`` and ``build``."""
+    command.add_argument("recipients", help="CSV file with one recipient per row")
+    command.add_argument("--template", required=True, help="HTML or markdown file with {{column}} placeholders")
+    command.add_argument("--subject", required=True)
+    command.add_argument("--campaign", metavar="NAME",
+                         help="journal the send under this name instead of its content, so a resend after "
+                              "editing the template or list still skips who already got it")
+    command.add_argument("--name-col", help="column with recipient names (auto-detected by default)")
+    command.add_argument("--email-col", help="column with email addresses (auto-detected by default)")
+    command.add_argument("--attach", action="append", default=[], metavar="FILE",
+                         help="file attached to every message (repeatable)")
+    command.add_argument("--attach-col", metavar="COLUMN", help="column with a per-recipient file to attach")
+    command.add_argument("--allow-missing", action="store_true",
+                         help="send even if some --attach-col files don't exist (those recipients fail)")
+    command.add_argument("--keep-duplicates", action="store_true", help="don't de-duplicate addresses")
+    command.add_argument("--bcc-batch", type=int, metavar="N",
+                         help="send a template without placeholders to N recipients per message, all in Bcc")
+    command.add_argument("--builders", type=int, default=2, help="render/build workers with --staged (default 2)")
+    command.add_argument("--processes", type=int, metavar="N",
+                         help="render and build messages in N worker processes, 0 = one per core (implies --staged)")
+    command.add_argument("--chunksize", type=int, default=10000, help="CSV rows read at a time")
+
+
+def add_delivery_arguments(command):
+    """How to send: options shared by ``send``, ``schedule`` and ``deliver``."""
+    command.add_argument("--host", default=OFFICE365_HOST)
+    command.add_argument("--port", type=int, default=OFFICE365_PORT)
+    command.add_argument("--no-starttls", action="store_true", help="talk plain SMTP (local relays only)")
+    command.add_argument("--connections", type=int, default=4, help="parallel SMTP sessions (default 4)")
+    command.add_argument("--senders", metavar="FILE",
+                         help="JSON list of sender accounts to share the campaign between (one session "
+                              "per account per connection)")
+    command.add_argument("--max-rate", type=float, help="extra cap in emails/second on top of the host profile")
+    command.add_argument("--recycle-after", type=int, default=200,
+                         help="start a fresh session after this many messages (0 = never)")
+    command.add_argument("--retries", type=int, default=3, help="retries for temporary failures")
+    command.add_argument("--retry-delay", type=float, default=30.0, help="first retry delay in seconds")
+    command.add_argument("--journal", default="send_journal.sqlite3", help="SQLite send journal ('' to disable)")
+    command.add_argument("--no-resume", action="store_true",
+                         help="resend to recipients the journal marks as sent")
+    command.add_argument("--staged", action="store_true",
+                         help="overlap reading, rendering and sending in separate pipeline stages")
+    command.add_argument("--no-pipelining", action="store_true", help="send SMTP commands one at a time")
+    command.add_argument("--per-domain", type=int, metavar="N",
+                         help="most messages in flight to any one recipient domain; domains take turns "
+                              "and back off on their own when deferred")
+    command.add_argument("--domain-limits", metavar="FILE",
+                         help="JSON object of per-domain concurrency/per_second/per_minute limits, "
+                              'with "default" for the rest (implies sending by domain)')
+
+
+def add_campaign_arguments(command):
+    """Options shared by ``send`` and ``schedule``: what to send and how."""
+    add_content_arguments(command)
+    add_delivery_arguments(command)
+
+
+def domain_limits(args):
+    """``Campaign(domain_limits=...)`` from ``--per-domain`` and ``--domain-limits``, or ``None``."""
+    if args.per_domain is None and not args.domain_limits:
+        return None
+    limits = {}
+    if args.domain_limits:
+        with open(args.domain_limits) as f:
+            limits = json.load(f)
+    if args.per_domain is not None:
+        limits["default"] = dict(limits.get("default", {}), concurrency=args.per_domain)
+    return limits
+
+
+def content_options(args):
+    """``Campaign`` keyword arguments from ``add_content_arguments``."""
+    return dict(
+        name_col=args.name_col, email_col=args.email_col,
+        dedupe=not args.keep_duplicates, bcc_batch=args.bcc_batch, builders=args.builders,
+        processes=(args.processes or os.cpu_count()) if args.processes is not None else None,
+        attachment_col=args.attach_col, name=args.campaign,
+    )
+
+
+def delivery_options(args):
+    """``Campaign`` keyword arguments from ``add_delivery_arguments``."""
+    return dict(
+        host=args.host, port=args.port, starttls=not args.no_starttls,
+        connections=args.connections, max_rate=args.max_rate,
+        recycle_after=args.recycle_after or None,
+        journal_path=args.journal or None, resume=not args.no_resume,
+        pipelining=not args.no_pipelining, staged=args.staged, domain_limits=domain_limits(args),
+    )
+
+
+def campaign_options(args):
+    """``Campaign`` keyword arguments from the shared options; plain JSON, so jobs can store them."""
+    return dict(content_options(args), **delivery_options(args))
+
+
+def add_metrics_arguments(command):
+    command.add_argument("--metrics-jsonl", metavar="FILE", help="append per-stage timing snapshots to FILE")
+    command.add_argument("--metrics-prom", metavar="FILE",
+                         help="keep FILE updated with timings in Prometheus text format")
+    command.add_argument("--metrics-interval", type=float, default=10.0, help="seconds between metrics snapshots")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m bulk_email", description="Send personalized bulk email.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    send = commands.add_parser("send", help="send a campaign to every row of a CSV file")
+    add_campaign_arguments(send)
+    add_metrics_arguments(send)
+    send.set_defaults(func=send_command)
+
+    build = commands.add_parser("build", help="render every message into a spool directory to deliver later")
+    add_content_arguments(build)
+    build.add_argument("--out", required=True, metavar="DIR", help="spool directory to write (replaced if it exists)")
+    build.set_defaults(func=build_command)
+
+    deliver = commands.add_parser("deliver", help="send the messages in a spool made by 'build'")
+    deliver.add_argument("spool", help="spool directory")
+    add_delivery_arguments(deliver)
+    add_metrics_arguments(deliver)
+    deliver.set_defaults(func=deliver_command)
+
+    inspect = commands.add_parser("inspect", help="summarize, check or compare spools made by 'build'")
+    inspect.add_argument("spool", help="spool directory")
+    inspect.add_argument("--show", type=int, metavar="N", help="print message N (0 is the first) as it will be sent")
+    inspect.add_argument("--verify", action="store_true", help="re-read every message and check it against the index")
+    inspect.add_argument("--diff", metavar="OTHER", help="list recipients added, removed or changed in spool OTHER")
+    inspect.set_defaults(func=inspect_command)
+
+    schedule = commands.add_parser("schedule", help="queue a campaign for a worker to send in batches")
+    add_campaign_arguments(schedule)
+    schedule.add_argument("--db", default=SCHEDULE_DB, help=f"schedule database (default {SCHEDULE_DB})")
+    schedule.add_argument("--batch-size", type=int, default=500, help="recipients per batch (default 500)")
+    schedule.add_argument("--window", action="append", default=[], metavar="WHEN",
+                          help='local hours to send in, e.g. "mon-fri 08:00-18:00" (repeatable; default any time)')
+    schedule.add_argument("--daily-quota", type=int, metavar="N",
+                          help="most recipients per day for this sender, counting every job")
+    schedule.add_argument("--start-at", metavar="TIME",
+                          help='don\'t send before this local time, e.g. "2026-11-02 08:00"')
+    schedule.add_argument("--name", help="label shown by 'jobs' (default: the subject)")
+    schedule.add_argument("--password-env", default="EMAIL_PASSWORD",
+                          help="environment variable the worker reads the password from")
+    schedule.set_defaults(func=schedule_command)
+
+    worker = commands.add_parser("worker", help="send scheduled batches as their windows and quotas allow")
+    worker.add_argument("--db", default=SCHEDULE_DB)
+    worker.add_argument("--forever", action="store_true", help="keep waiting for new jobs once all are done")
+    worker.add_argument("--poll", type=float, default=60.0, help="most seconds between checks for work")
+    worker.add_argument("--name", help="worker name recorded on claimed batches (default host:pid)")
+    worker.set_defaults(func=worker_command)
+
+    jobs = commands.add_parser("jobs", help="list scheduled jobs and their progress")
+    jobs.add_argument("--db", default=SCHEDULE_DB)
+    jobs.set_defaults(func=jobs_command)
+
+    cancel = commands.add_parser("cancel", help="stop a scheduled job from sending any further batches")
+    cancel.add_argument("job", type=int)
+    cancel.add_argument("--db", default=SCHEDULE_DB)
+    cancel.set_defaults(func=cancel_command)
+    return parser
+
+
+def metrics_for(args):
+    sinks = []
+    if args.metrics_jsonl:
+        sinks.append(JsonLinesSink(args.metrics_jsonl))
+    if args.metrics_prom:
+        sinks.append(PrometheusSink(args.metrics_prom))
+    return Metrics(sinks, interval=args.metrics_interval)
+
+
+def attachments_ok(campaign, args):
+    """Check the --attach-col files; False if some are missing and that isn't allowed."""
+    if not args.attach_col:
+        return True
+    missing = campaign.check_attachments()
+    for path in missing:
+        logger.warning("Attachment not found: %s", path)
+    if missing and not args.allow_missing:
+        logger.error("%d attachment(s) missing; fix them or pass --allow-missing", len(missing))
+        return False
+    return True
+
+
+def send_command(args):
+    sender = os.getenv('EMAIL_USER')
+    password = os.getenv('EMAIL_PASSWORD')
+    if not sender:
+        logger.error("Email credentials not found in environment variables (EMAIL_USER, EMAIL_PASSWORD)")
+        return 2
+    senders = SenderPool.from_file(args.senders) if args.senders else None
+
+    recipients = CsvRecipients(args.recipients, chunksize=args.chunksize)
+    template = load_template(args.template, recipients.columns)
+    # Encoded once to a temp file and streamed from there into every message
+    with UploadSpool() as uploads:
+        shared_parts = [uploads.attachment_part(path) for path in args.attach]
+        campaign = Campaign(
+            recipients, template, args.subject, sender, password,
+            retry_policy=RetryPolicy(max_attempts=args.retries + 1, base_delay=args.retry_delay),
+            shared_parts=shared_parts, metrics=metrics_for(args), senders=senders, **campaign_options(args),
+        )
+        if not attachments_ok(campaign, args):
+            return 2
+        return run_campaign(campaign, args)
+
+
+def deliver_command(args):
+    password = os.getenv('EMAIL_PASSWORD')
+    senders = SenderPool.from_file(args.senders) if args.senders else None
+    campaign = SpoolCampaign(
+        args.spool, password,
+        retry_policy=RetryPolicy(max_attempts=args.retries + 1, base_delay=args.retry_delay),
+        metrics=metrics_for(args), senders=senders, **delivery_options(args),
+    )
+    return run_campaign(campaign, args)
+
+
+def run_campaign(campaign, args):
+    """Send ``campaign``, logging progress and a summary; the exit status."""
+    senders = campaign.senders
+    metrics = campaign.metrics
+    if senders is not None:
+        logger.info("Connecting %d sender account(s) with %d connection(s) each", len(senders), args.connections)
+    else:
+        logger.info("Connecting to %s:%s with %d connection(s)", args.host, args.port, args.connections)
+    with campaign:
+        report = campaign.report
+        logger.info("Sending '%s' to %d recipients (campaign %s)", campaign.subject, report.total, campaign.id)
+        if campaign.already_sent:
+            logger.info("Resuming: %d recipients already sent will be skipped", len(campaign.already_sent))
+        for done, result in enumerate(campaign.results(), 1):
+            if not result.ok:
+                log_result(logger, result)
+            if done % 100 == 0:
+                logger.info("Progress: %d/%d sent, %d failed", report.sent, report.total, len(report.failed))
+
+    rate = report.sent / report.elapsed if report.elapsed else 0.0
+    logger.info("Sent %d/%d in %.1fs (%.1f emails/s), %d skipped, %d retried, %d failed",
+                report.sent, report.total, report.elapsed, rate, report.skipped, report.retried,
+                len(report.failed))
+    for stage in report.stages.values():
+        logger.info("  %s", stage.describe(report.elapsed))
+    for row in metrics.table():
+        logger.info("  %-40s %7d x %8.2f ms  p50 %8.2f  p99 %8.2f  total %8.2fs", row["stage"], row["count"],
+                    row["mean_ms"], row["p50_ms"], row["p99_ms"], row["total_s"])
+    if senders is not None:
+        for username, sent, failovers, exhausted in senders.summary():
+            logger.info("  sender %s: %d sent, %d failed over%s", username, sent, failovers,
+                        ", out of quota" if exhausted else "")
+    for domain, sent, deferred, backoffs in report.domains:
+        if deferred:
+            logger.info("  domain %s: %d sent, %d deferred, backed off %d time(s)", domain, sent, deferred, backoffs)
+    for name, recipient, reason in report.failed:
+        logger.info("  failed: %s (%s): %s", name, recipient, reason)
+    return 0 if not report.failed else 1
+
+
+def build_command(args):
+    sender = os.getenv('EMAIL_USER')
+    if not sender:
+        logger.error("EMAIL_USER is not set; it is the From address of every message")
+        return 2
+    recipients = CsvRecipients(args.recipients, chunksize=args.chunksize)
+    template = load_template(args.template, recipients.columns)
+    with UploadSpool() as uploads:
+        shared_parts = [uploads.attachment_part(path) for path in args.attach]
+        campaign = Campaign(recipients, template, args.subject, sender, shared_parts=shared_parts,
+                            **content_options(args))
+        if not attachments_ok(campaign, args):
+            return 2
+        logger.info("Building '%s' for %d recipients into %s (campaign %s)", args.subject, recipients.count(),
+                    args.out, campaign.id)
+        for done, result in enumerate(campaign.build_spool(args.out), 1):
+            if not result.ok:
+                log_result(logger, result)
+            if done % 1000 == 0:
+                logger.info("Progress: %d/%d built", campaign.report.sent, campaign.report.total)
+    report = campaign.report
+    rate = report.sent / report.elapsed if report.elapsed else 0.0
+    with Spool(args.out) as spool:
+        logger.info("Built %d message(s) for %d/%d recipients in %.1fs (%.1f/s), %.1f MB, %d failed",
+                    len(spool), report.sent, report.total, report.elapsed, rate, spool.manifest["bytes"] / 1e6,
+                    len(report.failed))
+    for name, recipient, reason in report.failed:
+        logger.info("  failed: %s (%s): %s", name, recipient, reason)
+    logger.info("Check it with 'python -m bulk_email inspect %s', send it with 'python -m bulk_email deliver %s'",
+                args.out, args.out)
+    return 0 if not report.failed else 1
+
+
+def inspect_command(args):
+    with Spool(args.spool) as spool:
+        manifest = spool.manifest
+        if args.show is not None:
+            for entry in spool.entries():
+                if entry["n"] == args.show:
+                    sys.stdout.write(f"MAIL FROM: {entry['from']}\nRCPT TO: {', '.join(entry['to'])}\n\n")
+                    sys.stdout.write(spool.message(entry).decode("utf-8", "replace"))
+                    return 0
+            logger.error("No message %d; the spool has %d, numbered from 0", args.show, len(spool))
+            return 2
+        logger.info("Spool %s: campaign %s, '%s' from %s, built %s", args.spool, manifest["campaign"],
+                    manifest["subject"], manifest["sender"],
+                    datetime.fromtimestamp(manifest["built"]).isoformat(" ", "seconds"))
+        domains = collections.Counter()
+        sizes = []
+        for entry in spool.entries():
+            sizes.append(entry["length"])
+            for address in entry["to"]:
+                domains[domain_of(address)] += 1
+        logger.info("  %d message(s) for %d recipient(s), %.1f MB; smallest %d, largest %d bytes",
+                    len(spool), spool.count(), manifest["bytes"] / 1e6, min(sizes, default=0), max(sizes, default=0))
+        for domain, count in domains.most_common(10):
+            logger.info("  %-40s %7d", domain, count)
+        for name, recipient, reason in manifest.get("failed", []):
+            logger.info("  not built: %s (%s): %s", name, recipient, reason)
+        status = 0
+        if args.verify:
+            bad = spool.verify()
+            for entry in bad:
+                logger.error("  message %d (%s) doesn't match the index", entry["n"], entry["recipient"])
+            logger.info("Verified %d message(s): %s", len(spool), f"{len(bad)} bad" if bad else "all intact")
+            status = 1 if bad else 0
+        if args.diff:
+            with Spool(args.diff) as other:
+                added, removed, changed = spool.diff(other)
+            for label, recipients in (("added", added), ("removed", removed), ("changed", changed)):
+                for recipient in recipients:
+                    logger.info("  %s: %s", label, recipient)
+            logger.info("Compared with %s: %d added, %d removed, %d changed", args.diff, len(added), len(removed),
+                        len(changed))
+    return status
+
+
+def schedule_command(args):
+    sender = os.getenv('EMAIL_USER')
+    if not sender:
+        logger.error("EMAIL_USER is not set; it is the sender the worker will log in as")
+        return 2
+    if not args.journal:
+        logger.error("Scheduled jobs resume from the send journal; --journal can't be disabled")
+        return 2
+    not_before = None
+    if args.start_at:
+        not_before = datetime.fromisoformat(args.start_at).timestamp()
+
+    recipients = CsvRecipients(args.recipients, chunksize=args.chunksize)
+    # Fail now on a template that doesn't compile, not hours later in the worker
+    load_template(args.template, recipients.columns)
+    options = campaign_options(args)
+    # The worker may run from another directory, and batches always resume from the journal
+    options.update(journal_path=os.path.abspath(args.journal), resume=True)
+    spec = {
+        "recipients": os.path.abspath(args.recipients), "template": {"path": os.path.abspath(args.template)},
+        "subject": args.subject, "sender": sender, "password_env": args.password_env,
+        "senders": os.path.abspath(args.senders) if args.senders else None,
+        "attach": [os.path.abspath(path) for path in args.attach],
+        "retries": args.retries, "retry_delay": args.retry_delay, "chunksize": args.chunksize,
+        "options": options,
+    }
+    rows = recipients.count()
+    with Scheduler(args.db) as scheduler:
+        job = scheduler.add(spec, rows, batch_size=args.batch_size, windows=args.window,
+                            daily_quota=args.daily_quota, not_before=not_before, name=args.name)
+    logger.info("Scheduled job %d: %d recipients in %d batch(es) of up to %d; run 'python -m bulk_email "
+                "worker --db %s' to send", job, rows, -(-rows // args.batch_size), args.batch_size, args.db)
+    return 0
+
+
+def worker_command(args):
+    with Scheduler(args.db) as scheduler:
+        worker = Worker(scheduler, name=args.name, poll=args.poll)
+        try:
+            worker.run(forever=args.forever)
+        except KeyboardInterrupt:
+            # The batch in flight stays leased until it expires, then any worker resumes it
+            logger.info("Interrupted; unfinished batches resume on the next run")
+            return 1
+    logger.info("No scheduled jobs left; %d batch(es) sent by this worker", worker.batches)
+    return 0
+
+
+def jobs_command(args):
+    with Scheduler(args.db) as scheduler:
+        jobs = scheduler.jobs()
+    if not jobs:
+        logger.info("No scheduled jobs in %s", args.db)
+    for job in jobs:
+        logger.info("%4d  %-9s %-30s %6d/%d sent, %d failed, batches %d/%d done%s  windows: %s%s", job["id"],
+                    job["state"], job["name"][:30], job["sent"], job["rows"], job["failed"], job["done"],
+                    job["batches"], f" ({job['running']} running)" if job["running"] else "",
+                    ", ".join(job["windows"]) or "any time",
+                    f", {job['daily_quota']}/day" if job["daily_quota"] else "")
+    return 0
+
+
+def cancel_command(args):
+    with Scheduler(args.db) as scheduler:
+        scheduler.cancel(args.job)
+    logger.info("Job %d cancelled; workers stop its batches at their next heartbeat", args.job)
+    return 0
+
+
+def main(argv=None):
+    queue_logging(logging.StreamHandler())
+    if load_dotenv is not None:
+        load_dotenv()
+    args = build_parser().parse_args(argv)
+    return args.func(args)
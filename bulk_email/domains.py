@@ -0,0 +1,237 @@
+import collections
+import time
+
+from .ratelimit import TokenBucket
+from .retry import TRANSIENT, classify
+from .smtp import is_disconnect
+
+# Jobs read ahead of sending so that other domains can go past a busy one;
+# their journal writes and attachment prefetches wait until each is handed out
+LOOKAHEAD = 5000
+
+# Recent deliveries a domain's pace is measured over
+RATE_SAMPLE = 50
+
+# Per-domain limits; "default" applies to every domain not listed. Each
+# entry takes ``DomainThrottle`` keyword arguments, e.g.
+#     {"default": {"concurrency": 2}, "ashesi.edu.gh": {"concurrency": 1, "per_minute": 60}}
+DOMAIN_PROFILES = {"default": {}}
+
+
+def domain_of(recipient):
+    """Lower-cased domain of an address, or of the first one in a Bcc batch."""
+    if isinstance(recipient, tuple):
+        recipient = recipient[0] if recipient else ""
+    return recipient.rpartition("@")[2].strip().lower()
+
+
+def is_deferral(exc):
+    """True when the receiving side said "try again later" (a 4xx reply), not when the session dropped."""
+    return exc is not None and not is_disconnect(exc) and classify(exc) == TRANSIENT
+
+
+class DomainThrottle:
+    """Concurrency, rate and backoff state for one recipient domain.
+
+    ``concurrency`` caps the messages to the domain in flight at once and
+    ``per_second``/``per_minute`` (with ``burst``) its pace. A deferral
+    halves both, from the pace it was actually delivering at if none is
+    set, and pauses the domain for ``pause`` seconds, twice as long after
+    each deferral with no delivery in between, up to ``max_pause``. Every
+    ``ramp_interval`` seconds without one they grow back by a quarter, up
+    to where they started.
+    """
+
+    def __init__(self, concurrency=None, per_second=None, per_minute=None, burst=1, pause=2.0,
+                 max_pause=300.0, ramp_interval=10.0, min_factor=0.05):
+        self.concurrency = concurrency
+        self.buckets = []
+        if per_second:
+            self.buckets.append(TokenBucket(per_second, max(1, burst)))
+        if per_minute:
+            self.buckets.append(TokenBucket(per_minute / 60.0, max(1, burst)))
+        self.pause = pause
+        self.max_pause = max_pause
+        self.ramp_interval = ramp_interval
+        self.min_factor = min_factor
+        self.factor = 1.0
+        self.strikes = 0
+        self.paused_until = 0.0
+        self.last_change = 0.0
+        self.in_flight = 0
+        self.delivered = collections.deque(maxlen=RATE_SAMPLE)
+        self.sent = 0
+        self.deferred = 0
+        self.backoffs = 0
+
+    def limit(self):
+        if self.concurrency is None:
+            return None
+        return max(1, int(self.concurrency * self.factor))
+
+    def ready_at(self, now):
+        """When the next message may go (``now`` or earlier means now), or ``None`` until one finishes."""
+        limit = self.limit()
+        if limit is not None and self.in_flight >= limit:
+            return None
+        ready = self.paused_until
+        for bucket in self.buckets:
+            bucket.refill(now, self.factor)
+            if bucket.tokens < 1:
+                ready = max(ready, now + (1 - bucket.tokens) / (bucket.rate * self.factor))
+        return ready
+
+    def take(self):
+        self.in_flight += 1
+        for bucket in self.buckets:
+            bucket.tokens -= 1
+
+    def delivery_rate(self):
+        """Messages per second over the last ``RATE_SAMPLE`` deliveries, or ``None``."""
+        times = self.delivered
+        if len(times) < 2 or times[-1] <= times[0]:
+            return None
+        return (len(times) - 1) / (times[-1] - times[0])
+
+    def done(self, now, exc=None, ok=True):
+        self.in_flight -= 1
+        if ok:
+            self.sent += 1
+            self.strikes = 0
+            self.delivered.append(now)
+            if self.factor < 1.0 and now - self.last_change >= self.ramp_interval:
+                self.factor = min(1.0, self.factor * 1.25)
+                self.last_change = now
+        elif is_deferral(exc):
+            self.deferred += 1
+            # Replies to messages already in flight count as the same signal
+            if now < self.paused_until:
+                return
+            if not self.buckets:
+                # No pace was set: learn one from what the domain was taking before it objected
+                rate = self.delivery_rate()
+                if rate:
+                    self.buckets.append(TokenBucket(rate, 1))
+                    self.buckets[0].updated = now
+            self.backoffs += 1
+            self.strikes += 1
+            self.factor = max(self.min_factor, self.factor / 2)
+            self.paused_until = now + min(self.max_pause, self.pause * 2 ** (self.strikes - 1))
+            self.last_change = now
+
+
+class DomainScheduler:
+    """Hands out send jobs grouped by recipient domain, taking turns between domains.
+
+    Jobs wait in one queue per domain and ``pop`` goes round the domains,
+    skipping any that is at its concurrency limit, out of rate budget or
+    backing off after a deferral, so one slow or greylisting domain never
+    holds up the rest of the campaign. ``limits`` maps domains to
+    ``DomainThrottle`` settings (see ``DOMAIN_PROFILES``); ``concurrency``
+    is the cap for domains whose settings don't give one. The engine
+    reports every attempt back through ``done``.
+
+    Not thread-safe: the engine calls it from its dispatching thread only.
+    """
+
+    def __init__(self, limits=None, concurrency=None, lookahead=LOOKAHEAD, metrics=None):
+        self.limits = dict(DOMAIN_PROFILES)
+        self.limits.update(limits or {})
+        self.concurrency = concurrency
+        self.lookahead = lookahead
+        self.metrics = metrics
+        self.throttles = {}
+        self.queues = {}
+        self.ring = collections.deque()
+        self.pending = 0
+
+    def __len__(self):
+        return self.pending
+
+    def throttle(self, domain):
+        throttle = self.throttles.get(domain)
+        if throttle is None:
+            settings = dict(self.limits.get(domain, self.limits["default"]))
+            settings.setdefault("concurrency", self.concurrency)
+            throttle = self.throttles[domain] = DomainThrottle(**settings)
+        return throttle
+
+    def push(self, job, front=False):
+        """Queue ``job`` behind its domain's others, or ahead of them (a retry) with ``front``."""
+        domain = domain_of(job.recipient)
+        jobs = self.queues.get(domain)
+        if jobs is None:
+            jobs = self.queues[domain] = collections.deque()
+            self.ring.append(domain)
+        if front:
+            jobs.appendleft(job)
+        else:
+            jobs.append(job)
+        self.pending += 1
+
+    def pop(self, now=None):
+        """The next job whose domain may send now, or ``None``."""
+        now = time.monotonic() if now is None else now
+        for _ in range(len(self.ring)):
+            domain = self.ring[0]
+            self.ring.rotate(-1)
+            throttle = self.throttle(domain)
+            ready = throttle.ready_at(now)
+            if ready is None or ready > now:
+                continue
+            jobs = self.queues[domain]
+            job = jobs.popleft()
+            if not jobs:
+                del self.queues[domain]
+                self.ring.pop()
+            throttle.take()
+            self.pending -= 1
+            if job.on_dispatch is not None:
+                job.on_dispatch()
+                job.on_dispatch = None
+            return job
+        return None
+
+    def drain(self):
+        """Remove and return every job still queued, e.g. once the run is stopped."""
+        jobs = [job for domain in self.ring for job in self.queues[domain]]
+        self.queues.clear()
+        self.ring.clear()
+        self.pending = 0
+        return jobs
+
+    def admit(self, job, now=None):
+        """Take a slot for ``job`` outside the queues, e.g. a retry whose message is already built.
+
+        Returns 0.0 once taken, else the seconds to wait before asking again,
+        or ``None`` if the domain waits for one of its sends to finish.
+        """
+        now = time.monotonic() if now is None else now
+        throttle = self.throttle(domain_of(job.recipient))
+        ready = throttle.ready_at(now)
+        if ready is None or ready > now:
+            return None if ready is None else ready - now
+        throttle.take()
+        return 0.0
+
+    def wake(self, now=None):
+        """Seconds until a queued domain frees up on its own, or ``None`` if all wait for a send to finish."""
+        now = time.monotonic() if now is None else now
+        times = [ready for ready in (self.throttle(domain).ready_at(now) for domain in self.ring)
+                 if ready is not None]
+        return max(0.0, min(times) - now) if times else None
+
+    def done(self, job, exc=None, ok=True):
+        """Record how an attempt handed out by ``pop`` went."""
+        domain = domain_of(job.recipient)
+        throttle = self.throttle(domain)
+        deferrals = throttle.backoffs
+        throttle.done(time.monotonic(), exc, ok)
+        if self.metrics is not None and throttle.backoffs != deferrals:
+            self.metrics.count("domain_backoffs", domain=domain)
+
+    def summary(self):
+        """``[(domain, sent, deferred, backoffs)]``, most deferred first."""
+        rows = [(domain, throttle.sent, throttle.deferred, throttle.backoffs)
+                for domain, throttle in self.throttles.items()]
+        return sorted(rows, key=lambda row: (-row[2], -row[1], row[0]))
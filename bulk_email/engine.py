@@ -0,0 +1,249 @@
+import queue
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .ratelimit import QuotaExceeded, RateLimiter
+from .retry import RetryQueue
+
+
+class SendJob:
+    """One pending email.
+
+    ``build`` is called on a worker thread and returns
+    ``(from_addr, to_addrs, message)`` ready for ``sendmail``.
+    ``on_dispatch``, if given, is called once when a ``DomainScheduler``
+    hands the job out, for work that only pays off shortly before sending.
+    """
+
+    __slots__ = ("name", "recipient", "build", "attempts", "on_dispatch")
+
+    def __init__(self, name, recipient, build, on_dispatch=None):
+        self.name = name
+        self.recipient = recipient
+        self.build = build
+        self.attempts = 0
+        self.on_dispatch = on_dispatch
+
+
+class SendResult:
+    """Outcome of one job; ``refused`` maps addresses the server turned down
+    in an otherwise accepted message to their ``(code, reply)``."""
+
+    __slots__ = ("job", "ok", "error", "elapsed", "exception", "refused")
+
+    def __init__(self, job, ok, error=None, elapsed=0.0, exception=None, refused=None):
+        self.job = job
+        self.ok = ok
+        self.error = error
+        self.elapsed = elapsed
+        self.exception = exception
+        self.refused = refused or {}
+
+    @property
+    def name(self):
+        return self.job.name
+
+    @property
+    def recipient(self):
+        return self.job.recipient
+
+
+def describe_error(exc):
+    """Turn a send exception into the short reason shown in the failed list."""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return "Recipient email refused by server"
+    if isinstance(exc, smtplib.SMTPDataError):
+        return f"SMTP Data Error: {str(exc)}"
+    return f"Unexpected error: {str(exc)}"
+
+
+def open_sessions(connect, count):
+    """Call ``connect`` ``count`` times in parallel; on any failure quit the rest and raise."""
+    sessions, errors = [], []
+    with ThreadPoolExecutor(count) as pool:
+        for future in [pool.submit(connect) for _ in range(count)]:
+            try:
+                sessions.append(future.result())
+            except Exception as e:
+                errors.append(e)
+    if errors:
+        quit_sessions(sessions)
+        raise errors[0]
+    return sessions
+
+
+def quit_sessions(sessions):
+    for session in sessions:
+        try:
+            session.quit()
+        except Exception:
+            pass
+
+
+class SendEngine:
+    """Send jobs over several authenticated SMTP sessions in parallel.
+
+    ``connect`` is a zero-argument callable returning a logged-in session
+    with ``sendmail``/``quit``, normally a connected ``SMTPConnection`` so a
+    dropped session heals itself; it is called once per connection. Every send first
+    waits on ``limiter`` (a ``RateLimiter`` shared by all connections);
+    ``max_rate`` is a shortcut for a plain messages-per-second cap. Results
+    are yielded back on the calling thread so progress output stays where
+    it was. With a ``RetryPolicy``, transient failures (4xx replies, dropped
+    sessions) are re-queued with backoff while fresh jobs keep flowing, and
+    only the final outcome of each job is yielded. With ``domains`` (a
+    ``DomainScheduler``) jobs are read ahead and handed out by recipient
+    domain, within each domain's concurrency and rate limits.
+
+        with SendEngine(connect, connections=4, limiter=limiter_for(host)) as engine:
+            for result in engine.run(jobs):
+                ...
+    """
+
+    def __init__(self, connect, connections=4, max_rate=None, limiter=None, retry_policy=None, domains=None):
+        self.connect = connect
+        self.connections = max(1, int(connections))
+        self.limiter = limiter or RateLimiter(per_second=max_rate)
+        self.retries = RetryQueue(retry_policy) if retry_policy else None
+        self.domains = domains
+        self.retried = 0
+        self.sessions = []
+        self.threads = []
+        self._jobs = queue.Queue()
+        self._results = queue.Queue()
+        self._stopped = False
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self):
+        """Open every session up front so login errors surface before sending."""
+        self.sessions = open_sessions(self.connect, self.connections)
+        for session in self.sessions:
+            thread = threading.Thread(target=self._worker, args=(session,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def close(self):
+        for _ in self.threads:
+            self._jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        self._quit_sessions()
+
+    def stop(self):
+        """Stop handing out new jobs; in-flight messages still finish."""
+        self._stopped = True
+
+    @property
+    def stopped(self):
+        return self._stopped
+
+    def run(self, jobs, should_stop=None):
+        """Feed ``jobs`` to the workers and yield a ``SendResult`` for each one finished."""
+        jobs = iter(jobs)
+        domains = self.domains
+        window = self.connections * 2
+        in_flight = 0
+        exhausted = False
+        while True:
+            if should_stop is not None and should_stop():
+                self._stopped = True
+            while not self._stopped and in_flight < window:
+                # Retries whose backoff has elapsed go ahead of fresh jobs
+                job = self.retries.pop_due() if self.retries else None
+                if domains is not None:
+                    if job is not None:
+                        domains.push(job, front=True)
+                    while not exhausted and len(domains) < domains.lookahead:
+                        job = next(jobs, None)
+                        exhausted = job is None
+                        if job is not None:
+                            domains.push(job)
+                    job = domains.pop()
+                elif job is None and not exhausted:
+                    job = next(jobs, None)
+                    exhausted = job is None
+                if job is None:
+                    break
+                self._jobs.put(job)
+                in_flight += 1
+            waiting = len(self.retries) if self.retries else 0
+            if self._stopped and waiting:
+                for job in self.retries.drain():
+                    yield SendResult(job, False, "Stopped before retry")
+                waiting = 0
+            if self._stopped and domains is not None and len(domains):
+                # Read ahead but never handed out
+                for job in domains.drain():
+                    yield SendResult(job, False, "Stopped before sending")
+            wake = self._wake(waiting)
+            if in_flight == 0:
+                if wake is None:
+                    return
+                time.sleep(min(1.0, wake))
+                continue
+            try:
+                # With the window full a due retry has to wait for a result anyway
+                result = self._results.get(timeout=min(1.0, wake) if wake is not None and in_flight < window
+                                           else None)
+            except queue.Empty:
+                continue
+            in_flight -= 1
+            if domains is not None:
+                domains.done(result.job, result.exception, result.ok)
+            if not result.ok and self._should_retry(result):
+                self.retries.push(result.job, result.job.attempts)
+                self.retried += 1
+                continue
+            yield result
+
+    def _wake(self, waiting):
+        """Seconds until a retry falls due or a domain frees up, or ``None`` if nothing is waiting."""
+        times = []
+        if waiting:
+            times.append(max(0.0, self.retries.next_due() - time.monotonic()))
+        if self.domains is not None and len(self.domains) and not self._stopped:
+            wake = self.domains.wake()
+            # None: every queued domain is at its concurrency limit until a result comes in
+            times.append(1.0 if wake is None else wake)
+        return min(times) if times else None
+
+    def _should_retry(self, result):
+        return (self.retries is not None and not self._stopped and result.exception is not None
+                and self.retries.policy.should_retry(result.exception, result.job.attempts))
+
+    def _worker(self, session):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            job.attempts += 1
+            start = time.perf_counter()
+            try:
+                from_addr, to_addrs, message = job.build()
+                self.limiter.acquire(1 if isinstance(to_addrs, str) else len(to_addrs))
+                refused = session.sendmail(from_addr, to_addrs, message)
+                result = SendResult(job, True, refused=refused)
+                self.limiter.feedback()
+            except QuotaExceeded as e:
+                self._stopped = True
+                result = SendResult(job, False, str(e))
+            except Exception as e:
+                result = SendResult(job, False, describe_error(e), exception=e)
+                # With domains a refused recipient is for its domain to back off, not the whole relay
+                if self.domains is None or not isinstance(e, smtplib.SMTPRecipientsRefused):
+                    self.limiter.feedback(e)
+            result.elapsed = time.perf_counter() - start
+            self._results.put(result)
+
+    def _quit_sessions(self):
+        quit_sessions(self.sessions)
+        self.sessions = []
@@ -0,0 +1,101 @@
+import hashlib
+import sqlite3
+import threading
+import time
+
+QUEUED = "queued"
+SENT = "sent"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sends (
+    campaign TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    state TEXT NOT NULL,
+    detail TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (campaign, recipient)
+)
+"""
+
+
+def campaign_id(*parts):
+    """Stable short id for a campaign, e.g. ``campaign_id(sender, subject, content_digest)``."""
+    return hashlib.sha1("\x1f".join(str(part) for part in parts).encode("utf-8")).hexdigest()[:12]
+
+
+class SendJournal:
+    """Append-only record of what happened to each recipient of a campaign.
+
+    Writes are buffered and committed in batches of ``flush_every`` records
+    or every ``flush_interval`` seconds, whichever comes first, so the send
+    loop pays for one fsync per batch rather than per message. A crash can
+    lose at most the last unflushed batch. It may be written from any thread.
+
+        with SendJournal("send_journal.sqlite3", campaign) as journal:
+            done = journal.delivered()
+            ...
+            journal.record(recipient, SENT)
+    """
+
+    def __init__(self, path, campaign, flush_every=50, flush_interval=1.0):
+        self.path = path
+        self.campaign = campaign
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=FULL")
+        self.conn.execute(SCHEMA)
+        self.conn.commit()
+        self._pending = []
+        self._last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def record(self, recipient, state, detail=None):
+        with self.lock:
+            self._pending.append((self.campaign, recipient, state, detail, time.time()))
+            if (len(self._pending) >= self.flush_every
+                    or time.monotonic() - self._last_flush >= self.flush_interval):
+                self._flush()
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def _flush(self):
+        if self._pending:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO sends (campaign, recipient, state, detail, updated) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    self._pending,
+                )
+            self._pending = []
+        self._last_flush = time.monotonic()
+
+    def delivered(self):
+        """Recipients already sent in this campaign, for resuming."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT recipient FROM sends WHERE campaign = ? AND state = ?", (self.campaign, SENT)
+            )
+            return {recipient for (recipient,) in rows}
+
+    def counts(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT state, COUNT(*) FROM sends WHERE campaign = ? GROUP BY state", (self.campaign,)
+            )
+            return dict(rows)
+
+    def close(self):
+        with self.lock:
+            self._flush()
+            self.conn.close()
@@ -0,0 +1,83 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import time
+
+FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+_listeners = {}
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """Queues records unformatted; the listener thread does the formatting."""
+
+    def prepare(self, record):
+        return record
+
+
+def queue_logging(*handlers, level=logging.INFO, fmt=FORMAT, logger=None):
+    """Send ``logger``'s records (the root logger's by default) to ``handlers`` from a background thread.
+
+    A logging call on the send path then only puts the record on a queue;
+    formatting and the file and console writes happen on the listener
+    thread, which is drained and stopped at exit. Calling it again for the
+    same logger (as every Streamlit rerun does) returns the running listener.
+    """
+    target = logging.getLogger(logger)
+    listener = _listeners.get(target.name)
+    if listener is not None:
+        return listener
+    formatter = logging.Formatter(fmt)
+    for handler in handlers:
+        if handler.formatter is None:
+            handler.setFormatter(formatter)
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    for handler in target.handlers[:]:
+        target.removeHandler(handler)
+    target.addHandler(_QueueHandler(records))
+    target.setLevel(level)
+    listener.start()
+    atexit.register(listener.stop)
+    _listeners[target.name] = listener
+    return listener
+
+
+def log_send(logger, recipient, elapsed, error=None, **fields):
+    """One compact record per message, e.g. ``sent to=a@b.org ms=41.7`` or ``failed to=... error="..."``.
+
+    Extra ``fields`` are appended as ``key=value``; failures are logged as warnings.
+    """
+    extra = "".join(f" {key}={value}" for key, value in fields.items()) if fields else ""
+    if error is None:
+        logger.info("sent to=%s ms=%.1f%s", recipient, elapsed * 1000, extra)
+    else:
+        logger.warning("failed to=%s ms=%.1f error=%s%s", recipient, elapsed * 1000, json.dumps(str(error)), extra)
+
+
+def log_result(logger, result):
+    """``log_send`` for a ``SendResult``."""
+    log_send(logger, result.recipient, result.elapsed, None if result.ok else result.error)
+
+
+class Throttle:
+    """True at most once every ``interval`` seconds, for batching UI refreshes.
+
+        refresh = Throttle(1.0)
+        for result in campaign.results():
+            if refresh():
+                progress_bar.progress(...)
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.last = None
+
+    def __call__(self):
+        now = time.monotonic()
+        if self.last is None or now - self.last >= self.interval:
+            self.last = now
+            return True
+        return False
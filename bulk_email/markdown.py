@@ -0,0 +1,121 @@
+import re
+
+# One alternation tried left to right at each position. Code spans, images
+# and links are single tokens, so nothing inside them is re-interpreted;
+# everything else is an emphasis delimiter or a run of plain text. Labels
+# stop at the next bracket and URLs at the next parenthesis, so a failed
+# match never rescans the rest of the line.
+_INLINE = re.compile(r"""
+    (?P<text>[^`!\[*~_]+)
+  | `(?P<code>[^`]*)`
+  | !\[(?P<alt>[^\[\]]*)\]\((?P<src>[^()]+)\)
+  | \[(?P<label>[^\[\]]+)\]\((?P<href>[^()]+)\)
+  | (?P<delim>\*\*\*|\*\*|~~|_)
+  | (?P<char>.)
+""", re.VERBOSE | re.DOTALL)
+
+# Lines without any of these are plain text and skip the tokenizer
+_SPECIAL = re.compile(r"[`!\[*~_]")
+
+_ORDERED = re.compile(r"\d+\. ")
+
+_TAGS = {
+    "***": ("<strong><em>", "</em></strong>"),
+    "**": ("<strong>", "</strong>"),
+    "~~": ("<del>", "</del>"),
+    "_": ("<em>", "</em>"),
+}
+
+
+def _inline(text):
+    """Convert the inline syntax of one line.
+
+    Delimiters are paired with a stack: a closer matches the nearest open
+    delimiter of the same kind, and anything opened in between stays
+    literal, so tags always nest properly. ``_`` only opens or closes at a
+    word boundary, leaving snake_case words and URLs alone.
+    """
+    if not _SPECIAL.search(text):
+        return text
+    out = []
+    append = out.append
+    stack = []  # (index in out, delimiter) of unmatched openers
+    open_counts = dict.fromkeys(_TAGS, 0)
+    for m in _INLINE.finditer(text):
+        kind = m.lastgroup
+        if kind == "text" or kind == "char":
+            append(m.group())
+        elif kind == "code":
+            append(f"<code>{m.group('code')}</code>")
+        elif kind == "src":
+            append(f'<img src="{m.group("src")}" alt="{m.group("alt")}" style="max-width: 100%;">')
+        elif kind == "href":
+            append(f'<a href="{m.group("href")}">{_inline(m.group("label"))}</a>')
+        else:
+            delim = m.group("delim")
+            start, end = m.span()
+            if delim == "_":
+                can_open = start == 0 or not text[start - 1].isalnum()
+                can_close = end == len(text) or not text[end].isalnum()
+            else:
+                can_open = can_close = True
+            if can_close and open_counts[delim]:
+                depth = len(stack) - 1
+                while stack[depth][1] != delim:
+                    depth -= 1
+                for _, skipped in stack[depth:]:
+                    open_counts[skipped] -= 1
+                out[stack[depth][0]] = _TAGS[delim][0]
+                del stack[depth:]
+                append(_TAGS[delim][1])
+            elif can_open:
+                stack.append((len(out), delim))
+                open_counts[delim] += 1
+                append(delim)
+            else:
+                append(delim)
+    return "".join(out)
+
+
+def markdown_to_html(text):
+    """Convert the notebook's markdown subset to HTML in one pass over the lines.
+
+    Supports ***bold italic***, **bold**, _italic_, ~~strike~~, `code`,
+    [links](url), ![images](url), ``---`` rules, ``> `` quotes and ``- ``
+    / ``1. `` lists. Consecutive list items share one list and consecutive
+    quote lines one blockquote; every other newline becomes ``<br>``.
+    """
+    parts = []
+    block = None
+    for number, line in enumerate(text.split("\n")):
+        if line.endswith("\r"):
+            line = line[:-1]
+        if line == "---":
+            kind, html = None, "<hr>"
+        elif line.startswith("> "):
+            kind, html = "blockquote", _inline(line[2:])
+        elif line.startswith("- "):
+            kind, html = "ul", f"<li>{_inline(line[2:])}</li>"
+        else:
+            ordered = _ORDERED.match(line)
+            if ordered:
+                kind, html = "ol", f"<li>{_inline(line[ordered.end():])}</li>"
+            else:
+                kind, html = None, _inline(line)
+
+        if kind is not None and kind == block:
+            if kind == "blockquote":
+                parts.append("<br>")
+            parts.append(html)
+            continue
+        if block is not None:
+            parts.append(f"</{block}>")
+        if number:
+            parts.append("<br>")
+        if kind is not None:
+            parts.append(f"<{kind}>")
+        parts.append(html)
+        block = kind
+    if block is not None:
+        parts.append(f"</{block}>")
+    return "".join(parts)
@@ -0,0 +1,201 @@
+import bisect
+import json
+import os
+import threading
+import time
+
+# Histogram bucket upper bounds in seconds: 50us doubling up to about 52s
+BUCKETS = tuple(0.00005 * 2 ** i for i in range(21))
+
+
+class Histogram:
+    """Fixed-bucket histogram of durations; quantiles are read from the buckets.
+
+    With buckets doubling in width a quantile is only known to within its
+    bucket, so ``quantile`` reports the bucket's upper bound: a p99 of 12.8 ms
+    means 99% of the values were at most that, and may be up to half of it.
+    """
+
+    def __init__(self, bounds=BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the ``q`` quantile, capped at the max seen."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return min(self.max, self.bounds[i]) if i < len(self.bounds) else self.max
+        return self.max
+
+    def snapshot(self):
+        return {"count": self.count, "sum": self.sum, "max": self.max,
+                "p50": self.quantile(0.5), "p90": self.quantile(0.9), "p99": self.quantile(0.99),
+                "buckets": list(self.counts)}
+
+
+def _key(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+
+class Metrics:
+    """Counters and duration histograms for one or more campaigns.
+
+    The sending core records into it as it goes (``Campaign`` passes its
+    ``metrics`` down to the SMTP sessions), and anything can read it:
+
+        metrics = Metrics([JsonLinesSink("metrics.jsonl")], interval=10)
+        campaign = Campaign(..., metrics=metrics)
+
+    ``table()`` gives per-stage rows for a live dashboard, ``prometheus()``
+    the Prometheus text format, and every sink receives ``snapshot()``
+    each ``interval`` seconds while a campaign runs and once at the end.
+    Recording is a dict lookup and a bucket increment under a lock.
+    """
+
+    def __init__(self, sinks=(), interval=None, prefix="bulk_email"):
+        self.sinks = list(sinks)
+        self.interval = interval
+        self.prefix = prefix
+        self.counters = {}
+        self.histograms = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __getstate__(self):
+        # Render worker processes record into a throwaway copy
+        state = self.__dict__.copy()
+        state.update(sinks=[], lock=None, _stop=None, _thread=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def observe(self, name, seconds, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, amount=1, **labels):
+        key = _key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def snapshot(self):
+        with self.lock:
+            return {"time": time.time(), "uptime": time.time() - self.started,
+                    "counters": dict(self.counters),
+                    "histograms": {key: h.snapshot() for key, h in self.histograms.items()}}
+
+    def table(self):
+        """One row per histogram, slowest total first: the data behind the dashboards."""
+        with self.lock:
+            rows = [{"stage": key, "count": h.count, "total_s": round(h.sum, 3),
+                     "mean_ms": round(h.sum / h.count * 1000, 2) if h.count else 0.0,
+                     "p50_ms": round(h.quantile(0.5) * 1000, 2), "p99_ms": round(h.quantile(0.99) * 1000, 2),
+                     "max_ms": round(h.max * 1000, 2)}
+                    for key, h in self.histograms.items()]
+        return sorted(rows, key=lambda row: -row["total_s"])
+
+    def prometheus(self):
+        """Everything in the Prometheus text exposition format."""
+        lines = []
+        family = None
+        with self.lock:
+            for key, value in sorted(self.counters.items()):
+                name, labels = _split(f"{self.prefix}_{key}")
+                if name != family:
+                    family = name
+                    lines.append(f"# TYPE {name}_total counter")
+                lines.append(f"{name}_total{labels} {value}")
+            for key, h in sorted(self.histograms.items()):
+                name, labels = _split(f"{self.prefix}_{key}")
+                inner = labels[1:-1] + "," if labels else ""
+                if name != family:
+                    family = name
+                    lines.append(f"# TYPE {name} histogram")
+                cumulative = 0
+                for bound, n in zip([f"{bound:g}" for bound in h.bounds] + ["+Inf"], h.counts):
+                    cumulative += n
+                    lines.append(f'{name}_bucket{{{inner}le="{bound}"}} {cumulative}')
+                lines.append(f"{name}_sum{labels} {h.sum}")
+                lines.append(f"{name}_count{labels} {h.count}")
+        return "\n".join(lines) + "\n"
+
+    def flush(self):
+        if not self.sinks:
+            return
+        snapshot = self.snapshot()
+        for sink in self.sinks:
+            sink.emit(self, snapshot)
+
+    def start(self):
+        """Flush to the sinks every ``interval`` seconds until ``close``."""
+        if not self.sinks or not self.interval or self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="metrics", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.flush()
+
+
+def _split(key):
+    name, brace, labels = key.partition("{")
+    return name, brace + labels
+
+
+class JsonLinesSink:
+    """Appends each snapshot to ``path`` as one JSON line."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, metrics, snapshot):
+        with open(self.path, "a") as f:
+            f.write(json.dumps(snapshot) + "\n")
+
+
+class PrometheusSink:
+    """Rewrites ``path`` with the Prometheus text format, e.g. for node_exporter's textfile collector."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def emit(self, metrics, snapshot):
+        partial = self.path + ".tmp"
+        with open(partial, "w") as f:
+            f.write(metrics.prometheus())
+        os.replace(partial, self.path)
@@ -0,0 +1,214 @@
+import base64
+import os
+import uuid
+from email.mime.application import MIMEApplication
+from email.mime.image import MIMEImage
+from email.mime.text import MIMEText
+from email.policy import SMTP
+
+CRLF = b"\r\n"
+
+# Bytes read per block when spooling or sending a part from disk; a whole
+# number of 57-byte groups, so every block encodes to complete base64 lines
+SPOOL_BLOCK = 57 * 16 * 1024
+
+
+def encode_part(part):
+    """Serialize a MIME part, headers and transfer-encoded body, to bytes."""
+    return part.as_bytes(policy=SMTP)
+
+
+def image_part(data, cid=None, filename=None, inline=True, subtype=None):
+    image = MIMEImage(data, _subtype=subtype) if subtype else MIMEImage(data)
+    if cid:
+        image.add_header('Content-ID', f'<{cid}>')
+    if inline:
+        if filename:
+            image.add_header('Content-Disposition', 'inline', filename=filename)
+        else:
+            image.add_header('Content-Disposition', 'inline')
+    return encode_part(image)
+
+
+def attachment_part(data, filename, subtype='octet-stream'):
+    part = MIMEApplication(data, _subtype=subtype)
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+    return encode_part(part)
+
+
+class SpooledPart:
+    """A pre-serialized MIME part kept in a file instead of memory.
+
+    Made by ``spool_image_part``/``spool_attachment_part``; anywhere a part's
+    bytes are accepted (``MessageSkeleton`` parts, ``extra_parts``) a
+    ``SpooledPart`` works too, and the message it ends up in is sent block
+    by block straight from the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.size = os.path.getsize(path)
+
+    def __len__(self):
+        return self.size
+
+    def __bytes__(self):
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def chunks(self, blocksize=SPOOL_BLOCK):
+        with open(self.path, "rb") as f:
+            while True:
+                block = f.read(blocksize)
+                if not block:
+                    return
+                yield block
+
+
+def _spool(part, source, dest):
+    """Write ``part``'s headers, then ``source`` base64-encoded one block at a time.
+
+    Byte-for-byte what ``encode_part`` gives for the same data, without the
+    file or its encoding ever being in memory whole.
+    """
+    with open(source, "rb") as src, open(dest, "wb") as out:
+        out.write(encode_part(part))
+        while True:
+            block = src.read(SPOOL_BLOCK)
+            if not block:
+                break
+            out.write(base64.encodebytes(block).replace(b"\n", CRLF))
+    return SpooledPart(dest)
+
+
+def spool_image_part(source, dest, cid=None, filename=None, inline=True, subtype=None):
+    """``image_part`` for the file at ``source``, written to ``dest``."""
+    if subtype is None:
+        raise ValueError("spool_image_part needs the image subtype")
+    image = MIMEImage(b"", _subtype=subtype)
+    if cid:
+        image.add_header('Content-ID', f'<{cid}>')
+    if inline:
+        if filename:
+            image.add_header('Content-Disposition', 'inline', filename=filename)
+        else:
+            image.add_header('Content-Disposition', 'inline')
+    return _spool(image, source, dest)
+
+
+def spool_attachment_part(source, dest, filename, subtype='octet-stream'):
+    """``attachment_part`` for the file at ``source``, written to ``dest``."""
+    part = MIMEApplication(b"", _subtype=subtype)
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+    return _spool(part, source, dest)
+
+
+class MessageStream:
+    """A message made of bytes and ``SpooledPart`` segments.
+
+    ``MessageSkeleton`` returns one when a spooled part is involved;
+    ``PipeliningSMTP.sendmail`` sends it segment by segment, so memory per
+    message stays at the personalized bytes however large the attachments.
+    Every segment starts at the beginning of a line and ends with CRLF.
+    """
+
+    def __init__(self, segments):
+        self.segments = tuple(segments)
+        self.size = sum(len(segment) for segment in self.segments)
+
+    def __len__(self):
+        return self.size
+
+    def __bytes__(self):
+        return b"".join(self.chunks())
+
+    def chunks(self):
+        for segment in self.segments:
+            if isinstance(segment, bytes):
+                yield segment
+            else:
+                yield from segment.chunks()
+
+
+def _segments(pieces):
+    """Merge runs of bytes in ``pieces``, leaving ``SpooledPart``s between them."""
+    segments = []
+    run = []
+    for piece in pieces:
+        if isinstance(piece, bytes):
+            run.append(piece)
+        else:
+            if run:
+                segments.append(b"".join(run))
+                run = []
+            segments.append(piece)
+    if run:
+        segments.append(b"".join(run))
+    return segments
+
+
+class MessageSkeleton:
+    """Multipart message whose shared parts are encoded once per campaign.
+
+    ``parts`` are pre-serialized blocks from ``image_part``/``attachment_part``
+    (logo, header image, common attachments). ``build`` only encodes the
+    headers and the HTML for a recipient and splices the shared blocks in,
+    so per-message cost depends on the personalized content alone.
+
+    Parts may also be ``SpooledPart``s; messages then come back as a
+    ``MessageStream`` instead of bytes and the part is read from disk as
+    each message is sent.
+
+    A message with ``extra_parts`` is a ``multipart/mixed`` holding the
+    ``multipart/<subtype>`` body, then the extra parts as its attachments.
+    Its boundary contains ``boundary``, so blanking that out of a message
+    (see ``spool.message_digest``) covers both.
+    """
+
+    def __init__(self, parts=(), subtype='related'):
+        self.subtype = subtype
+        self.boundary = f"===============bulk_{uuid.uuid4().hex}=="
+        delimiter = b"--" + self.boundary.encode("ascii") + CRLF
+        self._delimiter = delimiter
+        self._shared = _segments(piece for part in parts for piece in (delimiter, part, CRLF))
+        self._close = b"--" + self.boundary.encode("ascii") + b"--" + CRLF
+        # Not a prefix of the body's boundary, or the other way round
+        mixed = f"mixed_{self.boundary}".encode("ascii")
+        self._body_header = (f'Content-Type: multipart/{self.subtype}; boundary="{self.boundary}"'.encode("ascii")
+                             + CRLF)
+        self._mixed_header = b'Content-Type: multipart/mixed; boundary="' + mixed + b'"' + CRLF
+        self._mixed_delimiter = b"--" + mixed + CRLF
+        self._mixed_close = b"--" + mixed + b"--" + CRLF
+
+    def build(self, headers, html, extra_parts=()):
+        """Return the full message as bytes (a ``MessageStream`` with spooled parts).
+
+        ``headers`` is a sequence of ``(name, value)`` pairs such as From, To,
+        Cc and Subject; ``extra_parts`` are pre-serialized per-recipient blocks.
+        """
+        return self.join(*self.build_split(headers, html, extra_parts))
+
+    def build_split(self, headers, html, extra_parts=()):
+        """``build`` without the shared parts: the ``(head, tail)`` that go around them.
+
+        Render worker processes return these so the shared blocks never
+        cross a process boundary; ``join`` puts the message together.
+        """
+        head = [SMTP.fold_binary(*SMTP.header_store_parse(name, value)) for name, value in headers]
+        head.append(b"MIME-Version: 1.0" + CRLF)
+        if extra_parts:
+            head.append(self._mixed_header + CRLF + self._mixed_delimiter)
+        head.append(self._body_header + CRLF)
+        head.append(self._delimiter + encode_part(MIMEText(html, "html")) + CRLF)
+        pieces = [self._close]
+        if extra_parts:
+            pieces.extend(piece for part in extra_parts for piece in (self._mixed_delimiter, part, CRLF))
+            pieces.append(self._mixed_close)
+        tail = _segments(pieces)
+        # Spooled per-recipient parts stay on disk: the tail is then a stream
+        return b"".join(head), tail[0] if len(tail) == 1 else MessageStream(tail)
+
+    def join(self, head, tail):
+        tail = tail.segments if isinstance(tail, MessageStream) else (tail,)
+        segments = _segments((head, *self._shared, *tail))
+        return segments[0] if len(segments) == 1 else MessageStream(segments)
@@ -0,0 +1,410 @@
+import asyncio
+import contextlib
+import itertools
+import queue
+import smtplib
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .engine import SendResult, describe_error, open_sessions, quit_sessions
+from .ratelimit import QuotaExceeded, RateLimiter
+
+# Jobs pulled from the recipient iterator per trip to the reader thread
+READ_BATCH = 64
+
+_DONE = object()
+
+
+def _build_all(builds):
+    """Run several builds in one executor task; failures are returned, not raised."""
+    outcomes = []
+    for build in builds:
+        try:
+            outcomes.append((True, build()))
+        except Exception as e:
+            outcomes.append((False, e))
+    return outcomes
+
+
+class StageStats:
+    """Timing for one pipeline stage.
+
+    ``busy`` is time spent working, ``starved`` time waiting for input and
+    ``blocked`` time waiting for room in the next stage's queue, all summed
+    over the stage's workers. The stage with the highest ``utilization``
+    is the one limiting throughput.
+    """
+
+    __slots__ = ("name", "workers", "items", "busy", "starved", "blocked")
+
+    def __init__(self, name, workers=1):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+
+    def utilization(self, elapsed):
+        return self.busy / (elapsed * self.workers) if elapsed > 0 else 0.0
+
+    def describe(self, elapsed):
+        per_item = self.busy / self.items * 1000 if self.items else 0.0
+        return (f"{self.name}: {self.items} items, {per_item:.1f} ms each, "
+                f"{self.utilization(elapsed):.0%} busy x{self.workers}, "
+                f"starved {self.starved:.1f}s, blocked {self.blocked:.1f}s")
+
+
+class SendPipeline:
+    """Staged alternative to ``SendEngine``: read, build and send overlap.
+
+    An asyncio loop on a background thread runs three stages joined by
+    bounded queues, so a slow stage pushes back on the ones before it:
+
+    - read: pulls jobs from the iterator (CSV parsing, cleaning) in batches
+    - build: ``builders`` workers call ``job.build()`` (render + MIME)
+    - send: one transmitter per SMTP session runs ``sendmail``
+
+    Blocking work runs in per-stage thread pools, so the SMTP sessions keep
+    their reconnect, recycle and pipelining behaviour. The interface matches
+    ``SendEngine`` (``open``, ``run``, ``stop``, ``close``), and per-stage
+    timings are collected in ``stats``. Pass ``build_executor`` (e.g. a
+    ``RenderPool``'s process pool) to build somewhere other than threads;
+    ``job.build`` must then be picklable, and ``assemble`` turns what it
+    returns into ``(from_addr, to_addrs, message)``. With ``build_batch``
+    above 1, jobs already waiting are built several to an executor task,
+    which saves most of the per-task cost of a process pool.
+
+    With ``domains`` (a ``DomainScheduler``) read jobs wait in it instead
+    of going straight to the builders, and a dispatcher feeds the builders
+    by recipient domain within each domain's limits; a retry waits for its
+    domain to have room again.
+    """
+
+    def __init__(self, connect, connections=4, builders=2, max_rate=None, limiter=None,
+                 retry_policy=None, queue_size=None, build_executor=None, assemble=None,
+                 build_batch=1, domains=None):
+        self.connect = connect
+        self.connections = max(1, int(connections))
+        self.builders = max(1, int(builders))
+        self.limiter = limiter or RateLimiter(per_second=max_rate)
+        self.retry_policy = retry_policy
+        self.queue_size = queue_size or self.connections * 4
+        self.build_executor = build_executor
+        self.assemble = assemble
+        self.build_batch = max(1, int(build_batch))
+        self.domains = domains
+        self.retried = 0
+        self.sessions = []
+        self.stats = {}
+        self.elapsed = 0.0
+        self._stopped = False
+        self._retrying = set()
+        self._reading = False
+        self._work = None
+        self._room = None
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def open(self):
+        """Open every session up front so login errors surface before sending."""
+        self.sessions = open_sessions(self.connect, self.connections)
+
+    def close(self):
+        quit_sessions(self.sessions)
+        self.sessions = []
+
+    def stop(self):
+        """Stop reading new jobs; messages already being sent still finish.
+
+        Jobs already read but not yet sent, including those waiting in
+        ``domains``, come back as failed results ("Stopped before sending"),
+        so every job read gets a result.
+        """
+        self._stopped = True
+
+    @property
+    def stopped(self):
+        return self._stopped
+
+    def run(self, jobs, should_stop=None):
+        """Push ``jobs`` through the stages and yield a ``SendResult`` for each one finished."""
+        results = queue.Queue()
+        thread = threading.Thread(target=self._run_loop, args=(jobs, results), daemon=True)
+        thread.start()
+        finished = False
+        try:
+            while True:
+                if should_stop is not None and should_stop():
+                    self._stopped = True
+                try:
+                    item = results.get(timeout=0.2)
+                except queue.Empty:
+                    continue
+                if item is _DONE:
+                    finished = True
+                    break
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            if not finished:
+                # The caller gave up on the results; wind the stages down
+                self._stopped = True
+            thread.join()
+
+    def _run_loop(self, jobs, results):
+        try:
+            asyncio.run(self._main(iter(jobs), results))
+        except BaseException as e:
+            results.put(e)
+        results.put(_DONE)
+
+    async def _main(self, jobs, results):
+        self.stats = {
+            "read": StageStats("read"),
+            "build": StageStats("build", self.builders),
+            "send": StageStats("send", self.connections),
+        }
+        start = time.perf_counter()
+        build_q = asyncio.Queue(self.queue_size + self.builders * self.build_batch)
+        send_q = asyncio.Queue(self.queue_size)
+        if self.build_executor is None:
+            build_executor = ThreadPoolExecutor(self.builders)
+        else:
+            build_executor = contextlib.nullcontext(self.build_executor)
+        with ThreadPoolExecutor(1) as read_pool, build_executor as build_pool, \
+                ThreadPoolExecutor(self.connections) as send_pool:
+            watcher = asyncio.create_task(self._watch_stop())
+            if self.domains is not None:
+                self._reading = True
+                self._work = asyncio.Event()
+                self._room = asyncio.Event()
+                dispatcher = asyncio.create_task(self._dispatch(build_q))
+            builders = [asyncio.create_task(self._build(build_q, send_q, build_pool, results))
+                        for _ in range(self.builders)]
+            senders = [asyncio.create_task(self._send(session, send_q, send_pool, results))
+                       for session in self.sessions]
+            await self._read(jobs, build_q, read_pool)
+            if self.domains is not None:
+                await dispatcher
+                # After a stop, what was read ahead and never handed out
+                for job in self.domains.drain():
+                    results.put(SendResult(job, False, "Stopped before sending"))
+            await asyncio.gather(*builders)
+            # Retries go back into send_q, so wait until none are in flight or pending
+            while True:
+                await send_q.join()
+                if not self._retrying:
+                    break
+                await asyncio.wait(list(self._retrying))
+            for _ in senders:
+                await send_q.put(None)
+            await asyncio.gather(*senders)
+            watcher.cancel()
+        self.elapsed = time.perf_counter() - start
+
+    async def _put(self, q, item, stats):
+        start = time.perf_counter()
+        await q.put(item)
+        stats.blocked += time.perf_counter() - start
+
+    async def _get(self, q, stats):
+        start = time.perf_counter()
+        item = await q.get()
+        stats.starved += time.perf_counter() - start
+        return item
+
+    async def _read(self, jobs, build_q, pool):
+        loop = asyncio.get_running_loop()
+        stats = self.stats["read"]
+        while not self._stopped:
+            start = time.perf_counter()
+            batch = await loop.run_in_executor(pool, list, itertools.islice(jobs, READ_BATCH))
+            stats.busy += time.perf_counter() - start
+            if not batch:
+                break
+            stats.items += len(batch)
+            for job in batch:
+                if self.domains is None:
+                    await self._put(build_q, job, stats)
+                else:
+                    await self._push(job, stats)
+        if self.domains is not None:
+            # The dispatcher tells the builders once it has handed everything out
+            self._reading = False
+            self._work.set()
+            return
+        for _ in range(self.builders):
+            await build_q.put(None)
+
+    async def _push(self, job, stats):
+        """Queue a read job in the domain scheduler, waiting while it holds a full lookahead."""
+        domains = self.domains
+        start = time.perf_counter()
+        while len(domains) >= domains.lookahead and not self._stopped:
+            self._room.clear()
+            await self._wait(self._room, 1.0)
+        stats.blocked += time.perf_counter() - start
+        domains.push(job)
+        self._work.set()
+
+    async def _dispatch(self, build_q):
+        """Move jobs from the domain scheduler to the builders as their domains have room."""
+        domains = self.domains
+        while not self._stopped:
+            self._work.clear()
+            job = domains.pop()
+            if job is not None:
+                self._room.set()
+                await build_q.put(job)
+                continue
+            if not self._reading and not len(domains):
+                break
+            wake = domains.wake()
+            # None: every queued domain waits for one of its sends to finish
+            await self._wait(self._work, 1.0 if wake is None else min(1.0, wake))
+        self._room.set()
+        for _ in range(self.builders):
+            await build_q.put(None)
+
+    async def _wait(self, event, timeout):
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    def _done(self, job, exc=None, ok=False):
+        if self.domains is not None:
+            self.domains.done(job, exc, ok)
+            self._work.set()
+
+    def _drop(self, job, results):
+        """Report a job taken off a queue after ``stop``, so it isn't left unaccounted for."""
+        self._done(job)
+        results.put(SendResult(job, False, "Stopped before sending"))
+
+    async def _build(self, build_q, send_q, pool, results):
+        loop = asyncio.get_running_loop()
+        stats = self.stats["build"]
+        done = False
+        while not done:
+            job = await self._get(build_q, stats)
+            if job is None:
+                return
+            # Take whatever else is already queued, up to build_batch, as one executor task
+            batch = [job]
+            while len(batch) < self.build_batch and not build_q.empty():
+                job = build_q.get_nowait()
+                if job is None:
+                    done = True
+                    break
+                batch.append(job)
+            if self._stopped:
+                for job in batch:
+                    self._drop(job, results)
+                continue
+            start = time.perf_counter()
+            if len(batch) == 1:
+                outcomes = [await self._build_one(loop, pool, batch[0])]
+            else:
+                outcomes = await loop.run_in_executor(pool, _build_all, [job.build for job in batch])
+            stats.busy += time.perf_counter() - start
+            stats.items += len(batch)
+            for job, (ok, value) in zip(batch, outcomes):
+                if ok and self.assemble is not None:
+                    value = self.assemble(value)
+                if ok:
+                    await self._put(send_q, (job, value), stats)
+                else:
+                    self._done(job)
+                    results.put(SendResult(job, False, describe_error(value), exception=value))
+
+    async def _build_one(self, loop, pool, job):
+        try:
+            return True, await loop.run_in_executor(pool, job.build)
+        except Exception as e:
+            return False, e
+
+    async def _send(self, session, send_q, pool, results):
+        loop = asyncio.get_running_loop()
+        stats = self.stats["send"]
+        while True:
+            item = await self._get(send_q, stats)
+            if item is None:
+                send_q.task_done()
+                return
+            job, envelope = item
+            if not self._stopped:
+                start = time.perf_counter()
+                result = await loop.run_in_executor(pool, self._transmit, session, job, envelope)
+                stats.busy += time.perf_counter() - start
+                stats.items += 1
+                self._done(job, result.exception, result.ok)
+                if not result.ok and self._should_retry(result):
+                    self.retried += 1
+                    delay = self.retry_policy.delay(job.attempts)
+                    task = asyncio.create_task(self._retry_later(job, envelope, delay, send_q, results))
+                    self._retrying.add(task)
+                    task.add_done_callback(self._retrying.discard)
+                else:
+                    results.put(result)
+            else:
+                self._drop(job, results)
+            send_q.task_done()
+
+    def _transmit(self, session, job, envelope):
+        """Send one built message on a send-pool thread."""
+        from_addr, to_addrs, message = envelope
+        job.attempts += 1
+        start = time.perf_counter()
+        try:
+            self.limiter.acquire(1 if isinstance(to_addrs, str) else len(to_addrs))
+            refused = session.sendmail(from_addr, to_addrs, message)
+            result = SendResult(job, True, refused=refused)
+            self.limiter.feedback()
+        except QuotaExceeded as e:
+            self._stopped = True
+            result = SendResult(job, False, str(e))
+        except Exception as e:
+            result = SendResult(job, False, describe_error(e), exception=e)
+            # With domains a refused recipient is for its domain to back off, not the whole relay
+            if self.domains is None or not isinstance(e, smtplib.SMTPRecipientsRefused):
+                self.limiter.feedback(e)
+        result.elapsed = time.perf_counter() - start
+        return result
+
+    def _should_retry(self, result):
+        return (self.retry_policy is not None and not self._stopped and result.exception is not None
+                and self.retry_policy.should_retry(result.exception, result.job.attempts))
+
+    async def _retry_later(self, job, envelope, delay, send_q, results):
+        try:
+            await asyncio.sleep(delay)
+            if self.domains is not None:
+                await self._admit(job)
+        except asyncio.CancelledError:
+            results.put(SendResult(job, False, "Stopped before retry"))
+            return
+        await send_q.put((job, envelope))
+
+    async def _admit(self, job):
+        """Wait until the retry's domain has room, then take its place there."""
+        while True:
+            wait = self.domains.admit(job)
+            if wait == 0.0:
+                return
+            await asyncio.sleep(0.2 if wait is None else min(1.0, wait))
+
+    async def _watch_stop(self):
+        """Cancel pending retries once the run is stopped."""
+        while not self._stopped:
+            await asyncio.sleep(0.1)
+        for task in list(self._retrying):
+            task.cancel()
@@ -0,0 +1,76 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+def content_key(*parts):
+    """Digest of the strings (or bytes) a template is made from, to key ``PreviewCache`` by.
+
+        key = content_key(salutation, body, signature, logo.digest, ",".join(columns))
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, str):
+            part = part.encode("utf-8")
+        digest.update(len(part).to_bytes(8, "big"))
+        digest.update(part)
+    return digest.hexdigest()
+
+
+class PreviewCache:
+    """Compiled templates and rendered rows for the editors' previews.
+
+    ``template(key, build)`` calls ``build()`` only for a key it hasn't
+    seen, so redrawing a preview, or editing a template back to an
+    earlier version, costs a lookup. ``render(key, index, load, render)``
+    keeps each row's output by key and row index and calls ``load()`` for
+    the row only when it has none, so paging back and forth through a list
+    reads and renders each row once. The key must tell lists apart as well
+    as templates, e.g. ``(template_key, recipients.source)`` for a spooled
+    upload, whose path changes with its content.
+    The least recently used entries are dropped past ``templates`` and
+    ``rows``. Safe to share between threads, e.g. Streamlit sessions.
+    """
+
+    def __init__(self, templates=16, rows=1024):
+        self.max_templates = templates
+        self.max_rows = rows
+        self._templates = OrderedDict()
+        self._rows = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def template(self, key, build):
+        with self.lock:
+            template = self._templates.get(key)
+            if template is not None:
+                self._templates.move_to_end(key)
+                return template
+        template = build()
+        with self.lock:
+            self._templates[key] = template
+            while len(self._templates) > self.max_templates:
+                self._templates.popitem(last=False)
+        return template
+
+    def render(self, key, index, load, render):
+        """``render(load())``, or what it gave last time for this key and row index."""
+        with self.lock:
+            html = self._rows.get((key, index))
+            if html is not None:
+                self._rows.move_to_end((key, index))
+                self.hits += 1
+                return html
+        html = render(load())
+        with self.lock:
+            self.misses += 1
+            self._rows[(key, index)] = html
+            while len(self._rows) > self.max_rows:
+                self._rows.popitem(last=False)
+        return html
+
+    def clear(self):
+        with self.lock:
+            self._templates.clear()
+            self._rows.clear()
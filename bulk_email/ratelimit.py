@@ -0,0 +1,131 @@
+import threading
+import time
+
+from .smtp import reply_code
+
+# Replies that mean "slow down", not "this message is bad"
+THROTTLE_CODES = (421, 450, 451, 452)
+
+# Known relay limits. Office 365 allows 30 messages/minute and 10,000
+# recipients/day per mailbox; Gmail allows about 2,000/day for Workspace.
+PROFILES = {
+    "smtp.office365.com": {"per_minute": 30, "per_day": 10000, "burst": 5},
+    "smtp.gmail.com": {"per_second": 1, "per_minute": 60, "per_day": 2000, "burst": 5},
+    "default": {},
+}
+
+
+class QuotaExceeded(Exception):
+    """Raised when the per-day budget is used up."""
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now, factor=1.0):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate * factor)
+        self.updated = now
+
+    def reserve(self, factor=1.0):
+        """Take one token, going into debt if needed, and return the seconds to wait."""
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / (self.rate * factor)
+
+
+class RateLimiter:
+    """Per-second, per-minute and per-day budgets shared by every sender thread.
+
+    ``throttled()`` halves the send rate and pauses briefly; ``succeeded()``
+    ramps the rate back up once no throttling has been seen for
+    ``ramp_interval`` seconds. ``feedback(exc)`` does either from a send result.
+    """
+
+    def __init__(self, per_second=None, per_minute=None, per_day=None, burst=1,
+                 min_factor=0.05, ramp_interval=10.0, pause=2.0):
+        self.buckets = []
+        if per_second:
+            self.buckets.append(TokenBucket(per_second, max(1, burst)))
+        if per_minute:
+            self.buckets.append(TokenBucket(per_minute / 60.0, per_minute))
+        self.day = TokenBucket(per_day / 86400.0, per_day) if per_day else None
+        self.min_factor = min_factor
+        self.ramp_interval = ramp_interval
+        self.pause = pause
+        self.factor = 1.0
+        self.paused_until = 0.0
+        self.last_change = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self, recipients=1):
+        """Block until one message may be sent.
+
+        The per-day budget counts recipients, as Office 365 does, so a
+        message to several addresses uses up that many.
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.day is not None:
+                self.day.refill(now)
+                if self.day.tokens < recipients:
+                    raise QuotaExceeded("Daily sending quota reached")
+                self.day.tokens -= recipients
+            delay = max(0.0, self.paused_until - now)
+            for bucket in self.buckets:
+                bucket.refill(now, self.factor)
+                delay = max(delay, bucket.reserve(self.factor))
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttled(self):
+        with self.lock:
+            now = time.monotonic()
+            # Replies to messages already in flight count as the same signal
+            if now < self.paused_until:
+                return
+            self.factor = max(self.min_factor, self.factor / 2)
+            self.paused_until = now + self.pause
+            self.last_change = now
+
+    def succeeded(self):
+        if self.factor >= 1.0:
+            return
+        with self.lock:
+            now = time.monotonic()
+            if now - self.last_change >= self.ramp_interval:
+                self.factor = min(1.0, self.factor * 1.25)
+                self.last_change = now
+
+    def feedback(self, exc=None):
+        """Adjust the rate from a send outcome (``None`` means it went through)."""
+        if exc is None:
+            self.succeeded()
+        elif reply_code(exc) in THROTTLE_CODES:
+            self.throttled()
+
+    def call(self, send, *args, **kwargs):
+        """Run ``send(*args, **kwargs)`` inside the budget and learn from its outcome."""
+        self.acquire()
+        try:
+            result = send(*args, **kwargs)
+        except Exception as e:
+            self.feedback(e)
+            raise
+        self.feedback()
+        return result
+
+
+def limiter_for(host, **overrides):
+    """Build a ``RateLimiter`` from the named profile for ``host``.
+
+    Keyword overrides replace individual budgets; pass ``None`` to keep the
+    profile value.
+    """
+    settings = dict(PROFILES.get(host, PROFILES["default"]))
+    settings.update({key: value for key, value in overrides.items() if value is not None})
+    return RateLimiter(**settings)
@@ -0,0 +1,49 @@
+import functools
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+# The builder each worker process received at startup
+_builder = None
+
+
+def _init_worker(builder):
+    global _builder
+    _builder = builder
+
+
+def _build(row, recipient):
+    return _builder.build_parts(row, recipient)
+
+
+class RenderPool:
+    """Build messages in worker processes instead of threads.
+
+    ``builder`` is a picklable object with ``build_parts(row, recipient)``
+    and ``assemble(parts)``, normally the ``Campaign``. Each worker receives
+    its own copy once at startup, together with the compiled template and
+    shared MIME parts it holds. After that only the row goes out and only
+    the per-recipient bytes come back; ``assemble`` splices the shared parts
+    in on this side. Rendering and serialization so scale across cores
+    instead of contending for the GIL.
+
+        with RenderPool(campaign, processes=16) as pool:
+            parts = pool.executor.submit(pool.build_for(row, recipient)).result()
+            from_addr, to_addrs, message = campaign.assemble(parts)
+    """
+
+    def __init__(self, builder, processes=None):
+        self.processes = processes or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(self.processes, initializer=_init_worker, initargs=(builder,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+    def build_for(self, row, recipient):
+        """A picklable stand-in for ``builder.build_parts(row, recipient)`` to run in a worker."""
+        return functools.partial(_build, row, recipient)
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
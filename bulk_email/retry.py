@@ -0,0 +1,78 @@
+import heapq
+import itertools
+import random
+import smtplib
+import time
+
+from .smtp import is_disconnect, reply_code
+
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+
+
+def classify(exc):
+    """Sort a send failure into ``TRANSIENT`` (worth retrying) or ``PERMANENT``.
+
+    4xx replies, dropped sessions and socket errors are transient; 5xx
+    replies and anything unrecognised are permanent. A refused-recipients
+    error is transient only if every recipient got a 4xx.
+    """
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        codes = [code for code, _ in exc.recipients.values()]
+        return TRANSIENT if codes and all(400 <= code < 500 for code in codes) else PERMANENT
+    code = reply_code(exc)
+    if code is not None:
+        return TRANSIENT if 400 <= code < 500 else PERMANENT
+    if is_disconnect(exc) or isinstance(exc, OSError):
+        return TRANSIENT
+    return PERMANENT
+
+
+class RetryPolicy:
+    """Exponential backoff with jitter: attempt n waits about ``base_delay * factor**(n-1)``."""
+
+    def __init__(self, max_attempts=3, base_delay=30.0, factor=2.0, max_delay=900.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.factor = factor
+        self.max_delay = max_delay
+
+    def delay(self, attempt):
+        delay = min(self.max_delay, self.base_delay * self.factor ** (attempt - 1))
+        # Equal jitter: half fixed, half random, so retries from one burst spread out
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def should_retry(self, exc, attempts):
+        return attempts < self.max_attempts and classify(exc) == TRANSIENT
+
+
+class RetryQueue:
+    """Jobs waiting for their next attempt, ordered by due time."""
+
+    def __init__(self, policy=None):
+        self.policy = policy or RetryPolicy()
+        self._heap = []
+        self._seq = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def push(self, job, attempt):
+        due = time.monotonic() + self.policy.delay(attempt)
+        heapq.heappush(self._heap, (due, next(self._seq), job))
+        return due
+
+    def next_due(self):
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None):
+        """Return the next job whose backoff has elapsed, or ``None``."""
+        now = time.monotonic() if now is None else now
+        if self._heap and self._heap[0][0] <= now:
+            return heapq.heappop(self._heap)[2]
+        return None
+
+    def drain(self):
+        jobs = [entry[2] for entry in sorted(self._heap)]
+        self._heap = []
+        return jobs
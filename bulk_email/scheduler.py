@@ -0,0 +1,499 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+from .assets import AssetStore
+from .campaign import Campaign
+from .logs import Throttle, log_result
+from .recipients import CsvRecipients
+from .retry import RetryPolicy
+from .senders import SenderPool
+from .template import CompiledTemplate, load_template
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+ACTIVE = "active"
+CANCELLED = "cancelled"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scheduled_jobs (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    spec TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    windows TEXT NOT NULL,
+    daily_quota INTEGER,
+    quota_key TEXT NOT NULL,
+    not_before REAL NOT NULL,
+    state TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS scheduled_batches (
+    job INTEGER NOT NULL,
+    batch INTEGER NOT NULL,
+    start INTEGER NOT NULL,
+    stop INTEGER NOT NULL,
+    state TEXT NOT NULL,
+    worker TEXT,
+    lease_until REAL NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    reserved INTEGER NOT NULL DEFAULT 0,
+    reserved_day TEXT,
+    updated REAL NOT NULL,
+    PRIMARY KEY (job, batch)
+);
+CREATE TABLE IF NOT EXISTS daily_usage (
+    quota_key TEXT NOT NULL,
+    day TEXT NOT NULL,
+    used INTEGER NOT NULL,
+    PRIMARY KEY (quota_key, day)
+);
+"""
+
+DAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+
+def _minutes(text):
+    hours, _, minutes = text.partition(":")
+    value = int(hours) * 60 + int(minutes or 0)
+    if not 0 <= value <= 1440:
+        raise ValueError(f"Bad time of day: {text!r}")
+    return value
+
+
+def _days(text):
+    days = set()
+    for part in text.lower().split(","):
+        first, _, last = part.strip().partition("-")
+        if first[:3] not in DAYS or (last and last[:3] not in DAYS):
+            raise ValueError(f"Bad day range: {part!r}")
+        start = DAYS.index(first[:3])
+        end = DAYS.index(last[:3]) if last else start
+        days.update((start + i) % 7 for i in range((end - start) % 7 + 1))
+    return days
+
+
+def parse_window(text):
+    """``"mon-fri 08:00-18:00"`` -> ``(weekdays, start_minute, end_minute)``; the days are optional."""
+    fields = text.split()
+    if len(fields) == 1:
+        days, hours = set(range(7)), fields[0]
+    elif len(fields) == 2:
+        days, hours = _days(fields[0]), fields[1]
+    else:
+        raise ValueError(f"Bad send window: {text!r}")
+    start, _, end = hours.partition("-")
+    return days, _minutes(start), _minutes(end)
+
+
+class Windows:
+    """Local hours in which a scheduled campaign may send.
+
+        Windows(["mon-fri 08:00-18:00", "sat 10:00-13:00"])
+
+    A window whose end is before its start runs past midnight
+    (``"22:00-06:00"``) and belongs to the day it starts on; ``24:00`` is the
+    end of the day. No windows at all means any time.
+    """
+
+    def __init__(self, specs=()):
+        self.specs = list(specs)
+        self.windows = [parse_window(spec) for spec in self.specs]
+
+    def _intervals(self, day):
+        midnight = datetime.combine(day, datetime.min.time())
+        for days, start, end in self.windows:
+            if day.weekday() in days:
+                length = end - start if end > start else end + 1440 - start
+                begin = midnight + timedelta(minutes=start)
+                yield begin, begin + timedelta(minutes=length)
+
+    def current(self, now):
+        """``(begin, end)`` of the window ``now`` is in, or ``None``; overlapping windows are merged."""
+        if not self.windows:
+            return None
+        found = None
+        # Walk forward through windows that touch, so back-to-back ones count as one
+        for day in (now.date() - timedelta(days=1), now.date(), now.date() + timedelta(days=1)):
+            for begin, end in sorted(self._intervals(day)):
+                if found is None and begin <= now < end:
+                    found = [begin, end]
+                elif found is not None and begin <= found[1]:
+                    found[1] = max(found[1], end)
+        return tuple(found) if found else None
+
+    def is_open(self, now):
+        return not self.windows or self.current(now) is not None
+
+    def closes_at(self, now):
+        """When the current window ends, or ``None`` if sending is never cut off."""
+        window = self.current(now)
+        return window[1] if window else None
+
+    def next_open(self, now):
+        """The next time a window opens after ``now`` (``now`` itself if one is open)."""
+        if self.is_open(now):
+            return now
+        starts = [begin for offset in range(8)
+                  for begin, _ in self._intervals(now.date() + timedelta(days=offset)) if begin > now]
+        return min(starts) if starts else None
+
+
+class Claim:
+    """A batch handed to one worker, with what it needs to run it.
+
+    ``remaining`` is the share of today's quota reserved for this batch
+    (``None`` without a quota); the batch must not send more than that.
+    """
+
+    def __init__(self, job, batch, start, stop, spec, remaining, closes_at):
+        self.job = job
+        self.batch = batch
+        self.start = start
+        self.stop = stop
+        self.spec = spec
+        self.remaining = remaining
+        self.closes_at = closes_at
+
+
+class Scheduler:
+    """Campaigns queued in SQLite and sent batch by batch within time windows and daily quotas.
+
+    ``add`` splits a campaign (a JSON ``spec``, see ``build_campaign``) into
+    batches of ``batch_size`` rows. Workers ``claim`` a batch whose job is
+    inside one of its ``windows``, past ``not_before`` and under its
+    ``daily_quota`` (recipients per local day, shared by every job with the
+    same ``quota_key``, by default the sender address); the claim is a
+    lease that ``heartbeat`` extends, so a batch whose worker died is
+    picked up again once ``lease`` seconds pass. A claim reserves its
+    batch's share of the quota up front, so workers claiming at the same
+    time split what is left instead of each spending all of it; sends
+    move from the reservation to the day's usage as they are reported,
+    and whatever is unused goes back when the batch finishes or its lease
+    runs out. The campaigns themselves
+    resume from their send journal, so a batch cut short (by the window
+    closing, the quota, a stop or a crash) only sends what is left.
+    """
+
+    def __init__(self, path, lease=300.0):
+        self.path = path
+        self.lease = lease
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA busy_timeout=30000")
+        self.conn.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def _transaction(self):
+        # BEGIN IMMEDIATE takes the write lock up front, so two workers can't claim the same batch
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def add(self, spec, rows, batch_size=500, windows=(), daily_quota=None, not_before=None, name=None,
+            quota_key=None):
+        """Queue a campaign over ``rows`` recipients; returns the job id."""
+        Windows(windows)  # reject bad windows now rather than in the worker
+        now = time.time()
+        with self.lock:
+            conn = self._transaction()
+            try:
+                job = conn.execute(
+                    "INSERT INTO scheduled_jobs (name, spec, rows, windows, daily_quota, quota_key, not_before, "
+                    "state, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (name or spec.get("subject", ""), json.dumps(spec), rows, json.dumps(list(windows)),
+                     daily_quota, quota_key or spec.get("sender", ""), not_before or now, ACTIVE, now),
+                ).lastrowid
+                conn.executemany(
+                    "INSERT INTO scheduled_batches (job, batch, start, stop, state, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                    [(job, i, start, min(rows, start + batch_size), PENDING, now)
+                     for i, start in enumerate(range(0, rows, batch_size))],
+                )
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return job
+
+    def cancel(self, job):
+        with self.lock:
+            self.conn.execute("UPDATE scheduled_jobs SET state = ? WHERE id = ? AND state = ?",
+                              (CANCELLED, job, ACTIVE))
+
+    def used(self, quota_key, day=None):
+        """Recipients sent under ``quota_key`` on ``day`` (a local ``date``, today by default)."""
+        day = (day or datetime.now().date()).isoformat()
+        with self.lock:
+            row = self.conn.execute("SELECT used FROM daily_usage WHERE quota_key = ? AND day = ?",
+                                    (quota_key, day)).fetchone()
+        return row[0] if row else 0
+
+    def active(self):
+        """Number of jobs not yet finished or cancelled."""
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM scheduled_jobs WHERE state = ?", (ACTIVE,)).fetchone()[0]
+
+    def jobs(self):
+        """One dict per job with its batch counts and totals, newest first."""
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT j.id, j.name, j.state, j.rows, j.windows, j.daily_quota, j.not_before, "
+                "COUNT(b.batch), SUM(b.state = ?), SUM(b.state = ?), SUM(b.sent), SUM(b.failed) "
+                "FROM scheduled_jobs j JOIN scheduled_batches b ON b.job = j.id GROUP BY j.id ORDER BY j.id DESC",
+                (DONE, RUNNING),
+            ).fetchall()
+        keys = ("id", "name", "state", "rows", "windows", "daily_quota", "not_before",
+                "batches", "done", "running", "sent", "failed")
+        jobs = [dict(zip(keys, row)) for row in rows]
+        for job in jobs:
+            job["windows"] = json.loads(job["windows"])
+        return jobs
+
+    def claim(self, worker, now=None):
+        """Lease the next batch that may be sent now to ``worker``.
+
+        Returns ``(claim, None)``, or ``(None, wake)`` with the earliest time
+        (epoch seconds) anything could become claimable.
+        """
+        now = time.time() if now is None else now
+        local = datetime.fromtimestamp(now)
+        wake = None
+
+        def later(when):
+            nonlocal wake
+            if when is not None and when > now:
+                wake = when if wake is None else min(wake, when)
+
+        with self.lock:
+            conn = self._transaction()
+            try:
+                for job, spec, windows, quota, quota_key, not_before in conn.execute(
+                        "SELECT id, spec, windows, daily_quota, quota_key, not_before FROM scheduled_jobs "
+                        "WHERE state = ? ORDER BY id", (ACTIVE,)).fetchall():
+                    if not_before > now:
+                        later(not_before)
+                        continue
+                    windows = Windows(json.loads(windows))
+                    if not windows.is_open(local):
+                        opens = windows.next_open(local)
+                        later(opens.timestamp() if opens else None)
+                        continue
+                    day = local.date().isoformat()
+                    remaining = None
+                    if quota:
+                        row = conn.execute("SELECT used FROM daily_usage WHERE quota_key = ? AND day = ?",
+                                           (quota_key, day)).fetchone()
+                        remaining = quota - (row[0] if row else 0)
+                        if remaining <= 0:
+                            tomorrow = datetime.combine(local.date() + timedelta(days=1), datetime.min.time())
+                            later(tomorrow.timestamp())
+                            continue
+                        # Batches other workers hold count against the quota until they report or lapse
+                        reserved, lapses = conn.execute(
+                            "SELECT COALESCE(SUM(b.reserved), 0), MIN(b.lease_until) FROM scheduled_batches b "
+                            "JOIN scheduled_jobs j ON j.id = b.job WHERE j.quota_key = ? AND b.reserved > 0 "
+                            "AND b.reserved_day = ? AND b.lease_until > ?", (quota_key, day, now)).fetchone()
+                        remaining -= reserved
+                        if remaining <= 0:
+                            later(lapses)
+                            continue
+                    batch = conn.execute(
+                        "SELECT batch, start, stop FROM scheduled_batches WHERE job = ? AND state != ? "
+                        "AND lease_until <= ? ORDER BY batch LIMIT 1", (job, DONE, now)).fetchone()
+                    if batch is None:
+                        leased = conn.execute(
+                            "SELECT MIN(lease_until) FROM scheduled_batches WHERE job = ? AND state != ?",
+                            (job, DONE)).fetchone()[0]
+                        if leased is None:
+                            conn.execute("UPDATE scheduled_jobs SET state = ? WHERE id = ?", (DONE, job))
+                        else:
+                            later(leased)
+                        continue
+                    if remaining is not None:
+                        remaining = min(remaining, batch[2] - batch[1])
+                    conn.execute(
+                        "UPDATE scheduled_batches SET state = ?, worker = ?, lease_until = ?, reserved = ?, "
+                        "reserved_day = ?, updated = ? WHERE job = ? AND batch = ?",
+                        (RUNNING, worker, now + self.lease, remaining or 0, day, now, job, batch[0]))
+                    conn.execute("COMMIT")
+                    closes = windows.closes_at(local)
+                    return Claim(job, batch[0], batch[1], batch[2], json.loads(spec), remaining,
+                                 closes.timestamp() if closes else None), None
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return None, wake
+
+    def heartbeat(self, claim, sent=0, now=None):
+        """Extend the lease and count ``sent`` more recipients against today's quota.
+
+        Returns ``False`` once the job has been cancelled.
+        """
+        now = time.time() if now is None else now
+        with self.lock:
+            conn = self._transaction()
+            try:
+                conn.execute("UPDATE scheduled_batches SET lease_until = ?, sent = sent + ?, "
+                             "reserved = MAX(0, reserved - ?), updated = ? WHERE job = ? AND batch = ?",
+                             (now + self.lease, sent, sent, now, claim.job, claim.batch))
+                self._use(conn, claim.job, sent, now)
+                state = conn.execute("SELECT state FROM scheduled_jobs WHERE id = ?", (claim.job,)).fetchone()[0]
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        return state == ACTIVE
+
+    def finish(self, claim, done, sent=0, failed=0, retry_at=0.0, now=None):
+        """Release a batch and what it didn't use of its quota reservation: ``done`` if it ran to the
+        end, else pending again from ``retry_at``."""
+        now = time.time() if now is None else now
+        with self.lock:
+            conn = self._transaction()
+            try:
+                conn.execute(
+                    "UPDATE scheduled_batches SET state = ?, worker = NULL, lease_until = ?, sent = sent + ?, "
+                    "failed = ?, reserved = 0, updated = ? WHERE job = ? AND batch = ?",
+                    (DONE if done else PENDING, 0.0 if done else retry_at, sent, failed, now, claim.job, claim.batch))
+                self._use(conn, claim.job, sent, now)
+                left = conn.execute("SELECT COUNT(*) FROM scheduled_batches WHERE job = ? AND state != ?",
+                                    (claim.job, DONE)).fetchone()[0]
+                if not left:
+                    conn.execute("UPDATE scheduled_jobs SET state = ? WHERE id = ? AND state = ?",
+                                 (DONE, claim.job, ACTIVE))
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+
+    def _use(self, conn, job, sent, now):
+        if sent:
+            conn.execute(
+                "INSERT INTO daily_usage (quota_key, day, used) "
+                "SELECT quota_key, ?, ? FROM scheduled_jobs WHERE id = ? "
+                "ON CONFLICT (quota_key, day) DO UPDATE SET used = used + excluded.used",
+                (datetime.fromtimestamp(now).date().isoformat(), sent, job))
+
+
+def build_campaign(spec, start=0, stop=None, metrics=None):
+    """The ``Campaign`` for rows ``start:stop`` of a scheduled job's ``spec``.
+
+    ``spec`` is plain JSON: ``recipients`` (CSV path), ``template``
+    (``{"path": ...}`` or ``{"marked": ..., "columns": [...]}`` from
+    ``CompiledTemplate.marked``), ``subject``, ``sender``, ``password_env``
+    (the environment variable holding the password, ``EMAIL_PASSWORD`` by
+    default), optional ``senders`` (a ``SenderPool`` file), ``attach``
+    (files for every message), ``retries``, ``retry_delay``, ``chunksize``
+    and ``options``: further ``Campaign`` keyword arguments, which should
+    include a ``journal_path`` so batches resume.
+    """
+    recipients = CsvRecipients(spec["recipients"], chunksize=spec.get("chunksize", 10000), start=start, stop=stop)
+    template = spec["template"]
+    if "path" in template:
+        template = load_template(template["path"], recipients.columns)
+    else:
+        template = CompiledTemplate(template["marked"], template["columns"])
+    assets = AssetStore()
+    options = dict(spec.get("options", {}))
+    options.setdefault("resume", True)
+    return Campaign(
+        recipients, template, spec["subject"], spec["sender"],
+        os.environ.get(spec.get("password_env") or "EMAIL_PASSWORD"),
+        retry_policy=RetryPolicy(max_attempts=spec.get("retries", 3) + 1, base_delay=spec.get("retry_delay", 30.0)),
+        shared_parts=[assets.load(path).attachment_part() for path in spec.get("attach", ())],
+        assets=assets, senders=SenderPool.from_file(spec["senders"]) if spec.get("senders") else None,
+        metrics=metrics, **options,
+    )
+
+
+class Worker:
+    """Claims and sends scheduled batches until no active job is left (or forever).
+
+        Worker(Scheduler("send_schedule.sqlite3")).run()
+
+    Between batches it sleeps until the next window opens, the quota resets
+    or another worker's lease runs out, checking at least every ``poll``
+    seconds for new jobs. A batch that fails to start (e.g. the server is
+    unreachable) is retried after ``retry_after`` seconds.
+    """
+
+    def __init__(self, scheduler, make_campaign=build_campaign, name=None, poll=60.0, heartbeat=10.0,
+                 retry_after=300.0):
+        self.scheduler = scheduler
+        self.make_campaign = make_campaign
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.poll = poll
+        self.heartbeat = heartbeat
+        self.retry_after = retry_after
+        self.batches = 0
+        self._stop = threading.Event()
+
+    def stop(self):
+        """Finish the message in flight, release the batch and return from ``run``."""
+        self._stop.set()
+
+    def run(self, forever=False):
+        while not self._stop.is_set():
+            claim, wake = self.scheduler.claim(self.name)
+            if claim is not None:
+                self.run_batch(claim)
+                continue
+            if not forever and not self.scheduler.active():
+                return
+            delay = self.poll if wake is None else min(self.poll, max(1.0, wake - time.time()))
+            logger.info("Nothing to send; next check in %.0fs", delay)
+            self._stop.wait(delay)
+
+    def run_batch(self, claim):
+        logger.info("Job %d batch %d: rows %d-%d", claim.job, claim.batch, claim.start, claim.stop - 1)
+        scheduler = self.scheduler
+        beat = Throttle(self.heartbeat)
+        counted = 0
+        active = True
+        report = None
+
+        def should_stop():
+            nonlocal counted, active
+            if beat():
+                active = scheduler.heartbeat(claim, report.sent - counted)
+                counted = report.sent
+            return (self._stop.is_set() or not active
+                    or (claim.closes_at is not None and time.time() >= claim.closes_at))
+
+        try:
+            campaign = self.make_campaign(claim.spec, claim.start, claim.stop)
+            # This batch's share of today's quota; the campaign's rate limiter stops exactly there
+            if claim.remaining is not None:
+                campaign.daily_quota = claim.remaining
+            with campaign:
+                report = campaign.report
+                for result in campaign.results(should_stop=should_stop):
+                    log_result(logger, result)
+        except Exception as e:
+            logger.error("Job %d batch %d failed to run: %s", claim.job, claim.batch, e)
+            sent = report.sent - counted if report is not None else 0
+            scheduler.finish(claim, False, sent, retry_at=time.time() + self.retry_after)
+            return
+        self.batches += 1
+        scheduler.finish(claim, not report.stopped, report.sent - counted, len(report.failed))
+        logger.info("Job %d batch %d: %d sent, %d skipped, %d failed%s", claim.job, claim.batch, report.sent,
+                    report.skipped, len(report.failed), "" if not report.stopped else " (paused)")
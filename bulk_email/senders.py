@@ -0,0 +1,214 @@
+import bisect
+import hashlib
+import json
+import os
+import smtplib
+import threading
+import time
+
+from .ratelimit import THROTTLE_CODES, QuotaExceeded, limiter_for
+from .smtp import OFFICE365_HOST, OFFICE365_PORT, SMTPConnection, is_disconnect, reply_code
+
+# Ring points per unit of weight; more points spread recipients more evenly
+VNODES = 256
+
+
+def _point(key):
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class SenderAccount:
+    """One mailbox or relay in a ``SenderPool``, with its own quota and rate state.
+
+    ``per_second``, ``per_minute``, ``per_day`` and ``burst`` override the
+    ``PROFILES`` entry for ``host``. ``envelope_from`` (the account's own
+    address by default) is the SMTP ``MAIL FROM``; the ``From`` header is
+    the campaign's sender, so on Office 365 every account needs Send As
+    rights for that address (or use the account's own address as it).
+    """
+
+    def __init__(self, username, password=None, host=OFFICE365_HOST, port=OFFICE365_PORT, starttls=True,
+                 envelope_from=None, weight=1, per_second=None, per_minute=None, per_day=None, burst=None):
+        self.username = username
+        self.password = password
+        self.host = host
+        self.port = port
+        self.starttls = starttls
+        self.envelope_from = envelope_from or username
+        self.weight = weight
+        self.limiter = limiter_for(host, per_second=per_second, per_minute=per_minute, per_day=per_day,
+                                   burst=burst)
+        self.exhausted = False
+        self.down_until = 0.0
+        self.sent = 0
+        self.failovers = 0
+
+    def __repr__(self):
+        return f"SenderAccount({self.username!r}, host={self.host!r})"
+
+    def healthy(self, now):
+        """Not out of quota and not cooling off after a throttle reply or a lost session."""
+        return not self.exhausted and now >= self.down_until
+
+
+class SenderPool:
+    """Several sender accounts sharing one campaign, so their quotas add up.
+
+    Recipients are placed on a consistent-hash ring of the accounts
+    (``weight`` points each), so a recipient always maps to the same
+    account, also when an interrupted campaign is resumed, and adding an
+    account only moves the recipients that now hash to it. An account that
+    gets a throttling reply or loses its session is left alone for
+    ``down_for`` seconds, and one that has used up its daily quota for the
+    rest of the run: meanwhile its recipients go to the next healthy account
+    on the ring (the failed message is retried there by the engine).
+    When it comes back its own rate limiter has already halved its pace.
+    ``QuotaExceeded`` is raised only once every account is out of quota.
+
+        pool = SenderPool([SenderAccount("a@org.edu", pw_a), SenderAccount("b@org.edu", pw_b)])
+        campaign = Campaign(..., senders=pool, connections=2)
+
+    ``Campaign`` calls ``connect()`` once per connection; each call returns
+    a ``PooledSession`` with one SMTP session per account.
+    """
+
+    def __init__(self, accounts, down_for=60.0, metrics=None):
+        self.accounts = list(accounts)
+        if not self.accounts:
+            raise ValueError("A sender pool needs at least one account")
+        self.down_for = down_for
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        ring = sorted((_point(f"{account.username}@{account.host}#{i}"), index)
+                      for index, account in enumerate(self.accounts)
+                      for i in range(max(1, int(VNODES * account.weight))))
+        self._points = [point for point, _ in ring]
+        self._owners = [index for _, index in ring]
+
+    @classmethod
+    def from_file(cls, path, **options):
+        """Load accounts from a JSON list of ``SenderAccount`` keyword arguments.
+
+        ``password_env`` names an environment variable holding the password,
+        so the file itself can stay free of secrets.
+        """
+        with open(path) as f:
+            entries = json.load(f)
+        accounts = []
+        for entry in entries:
+            entry = dict(entry)
+            env = entry.pop("password_env", None)
+            if env is not None:
+                entry["password"] = os.environ.get(env)
+            accounts.append(SenderAccount(**entry))
+        return cls(accounts, **options)
+
+    def __len__(self):
+        return len(self.accounts)
+
+    def home(self, recipient):
+        """Index of the account ``recipient`` hashes to."""
+        i = bisect.bisect(self._points, _point(recipient.strip().lower()))
+        return self._owners[i % len(self._owners)]
+
+    def route(self, recipient):
+        """Index of the account to send to ``recipient`` now: its own, or the next healthy one."""
+        start = bisect.bisect(self._points, _point(recipient.strip().lower()))
+        now = time.monotonic()
+        home = self._owners[start % len(self._owners)]
+        seen = set()
+        for step in range(len(self._owners)):
+            index = self._owners[(start + step) % len(self._owners)]
+            if index in seen:
+                continue
+            if self.accounts[index].healthy(now):
+                if index != home:
+                    self._failover(home)
+                return index
+            seen.add(index)
+            if len(seen) == len(self.accounts):
+                break
+        # Nobody healthy: use the account that recovers first and still has quota
+        candidates = [i for i, account in enumerate(self.accounts) if not account.exhausted]
+        if not candidates:
+            raise QuotaExceeded("Daily sending quota reached on every sender account")
+        return min(candidates, key=lambda i: self.accounts[i].down_until)
+
+    def connect(self, recycle_after=None, pipelining=True, metrics=None):
+        return PooledSession(self, recycle_after=recycle_after, pipelining=pipelining, metrics=metrics).connect()
+
+    def summary(self):
+        """``[(username, sent, failovers, exhausted)]`` per account."""
+        return [(account.username, account.sent, account.failovers, account.exhausted)
+                for account in self.accounts]
+
+    def _failover(self, home):
+        with self.lock:
+            self.accounts[home].failovers += 1
+        if self.metrics is not None:
+            self.metrics.count("sender_failovers", account=self.accounts[home].username)
+
+    def _exhausted(self, index):
+        self.accounts[index].exhausted = True
+
+    def _down(self, index):
+        self.accounts[index].down_until = time.monotonic() + self.down_for
+
+
+class PooledSession:
+    """What one engine connection sees of a ``SenderPool``: ``sendmail`` picks
+    the account for the first recipient, waits on that account's rate
+    limiter and sends over its SMTP session."""
+
+    def __init__(self, pool, recycle_after=None, pipelining=True, metrics=None):
+        self.pool = pool
+        self.metrics = metrics
+        self.connections = [SMTPConnection(account.host, account.port, account.username, account.password,
+                                           starttls=account.starttls, recycle_after=recycle_after,
+                                           pipelining=pipelining, metrics=metrics)
+                            for account in pool.accounts]
+
+    def connect(self):
+        """Log in to every account, so bad credentials show up before sending."""
+        try:
+            for connection in self.connections:
+                connection.connect()
+        except Exception:
+            self.quit()
+            raise
+        return self
+
+    def rcpt_limit(self):
+        return min(connection.rcpt_limit() for connection in self.connections)
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        recipients = [to_addrs] if isinstance(to_addrs, str) else list(to_addrs)
+        pool = self.pool
+        while True:
+            index = pool.route(recipients[0])
+            account = pool.accounts[index]
+            try:
+                account.limiter.acquire(len(recipients))
+                break
+            except QuotaExceeded:
+                pool._exhausted(index)
+        try:
+            refused = self.connections[index].sendmail(account.envelope_from, recipients, msg)
+        except smtplib.SMTPRecipientsRefused:
+            # A refused recipient is its domain's doing, not a sign the account is throttled
+            raise
+        except Exception as e:
+            account.limiter.feedback(e)
+            if is_disconnect(e) or reply_code(e) in THROTTLE_CODES:
+                pool._down(index)
+            raise
+        account.limiter.feedback()
+        with pool.lock:
+            account.sent += 1
+        if self.metrics is not None:
+            self.metrics.count("sender_messages", account=account.username)
+        return refused
+
+    def quit(self):
+        for connection in self.connections:
+            connection.quit()
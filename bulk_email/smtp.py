@@ -0,0 +1,325 @@
+import logging
+import re
+import smtplib
+import time
+
+from .mime import CRLF, MessageStream
+
+logger = logging.getLogger(__name__)
+
+OFFICE365_HOST = "smtp.office365.com"
+OFFICE365_PORT = 587
+
+# Recipients per transaction when the server doesn't advertise a limit.
+# Office 365 accepts up to 500; most relays accept at least 100.
+DEFAULT_RCPT_LIMIT = 100
+
+# smtplib's line-ending and dot-stuffing rules; its own helpers for them are private
+_EOL = re.compile(r'(?:\r\n|\n|\r(?!\n))')
+_LEADING_DOT = re.compile(br'(?m)^\.')
+
+
+def _fix_eols(text):
+    return _EOL.sub('\r\n', text)
+
+
+def _quote_periods(data):
+    """Double a dot at the start of any line, so it can't end the DATA section early."""
+    return _LEADING_DOT.sub(b'..', data)
+
+
+class PipeliningSMTP(smtplib.SMTP):
+    """``smtplib.SMTP`` that pipelines the envelope (RFC 2920).
+
+    When the server advertises PIPELINING, ``sendmail`` writes MAIL FROM,
+    every RCPT TO and DATA in a single write and then reads the replies in
+    order, so a message costs two round trips however many recipients it
+    has. Without PIPELINING it falls back to the stock one-command-at-a-time
+    dialogue. Return value and exceptions match ``smtplib.SMTP.sendmail``.
+
+    ``msg`` may also be a ``MessageStream``; its spooled parts are then sent
+    block by block from disk, with or without PIPELINING.
+
+    With ``metrics`` set (a ``Metrics``) the wait for each reply is recorded
+    as ``smtp_reply_seconds`` by command; the pipelined MAIL/RCPT/DATA batch
+    counts as ``envelope`` and the wait after the message body as ``message``.
+    """
+
+    metrics = None
+    _timed = None
+    _sent_at = None
+
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=(), rcpt_options=()):
+        self.ehlo_or_helo_if_needed()
+        if not self.has_extn('pipelining'):
+            return super().sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+        if isinstance(msg, str):
+            msg = _fix_eols(msg).encode('ascii')
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        mail_options = list(mail_options)
+        if self.has_extn('size'):
+            mail_options.insert(0, "size=%d" % len(msg))
+        if any(option.lower() == 'smtputf8' for option in mail_options):
+            if not self.has_extn('smtputf8'):
+                raise smtplib.SMTPNotSupportedError('SMTPUTF8 not supported by server')
+            self.command_encoding = 'utf-8'
+
+        commands = [self._command("mail", "FROM:%s%s" % (smtplib.quoteaddr(from_addr), _options(mail_options)))]
+        for addr in to_addrs:
+            commands.append(self._command("rcpt", "TO:%s%s" % (smtplib.quoteaddr(addr), _options(rcpt_options))))
+        commands.append(self._command("data"))
+        self._timed = "envelope"
+        self.send(b"".join(commands))
+
+        # Every pipelined command gets a reply, even after an early failure
+        mail_reply = self.getreply()
+        senderrs = {}
+        for addr in to_addrs:
+            code, resp = self.getreply()
+            if code not in (250, 251):
+                senderrs[addr] = (code, resp)
+        data_code, data_resp = self.getreply()
+        if data_code == 354 and (mail_reply[0] != 250 or len(senderrs) == len(to_addrs)):
+            # Nothing to deliver, but the server is waiting for a body
+            self.send(b"." + CRLF)
+            data_code, data_resp = self.getreply()
+
+        if mail_reply[0] != 250:
+            self._abort(mail_reply[0], data_code)
+            raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+        if len(senderrs) == len(to_addrs):
+            self._abort(*[code for code, _ in senderrs.values()], data_code)
+            raise smtplib.SMTPRecipientsRefused(senderrs)
+        if data_code != 354:
+            self._abort(data_code)
+            raise smtplib.SMTPDataError(data_code, data_resp)
+
+        self._send_body(msg)
+        code, resp = self.getreply()
+        if code != 250:
+            self._abort(code)
+            raise smtplib.SMTPDataError(code, resp)
+        return senderrs
+
+    def data(self, msg):
+        # The stock dialogue's DATA, for servers that don't pipeline, with
+        # the body sent by _send_body so streams and timings work there too
+        self.putcmd("data")
+        code, repl = self.getreply()
+        if code != 354:
+            raise smtplib.SMTPDataError(code, repl)
+        self._send_body(msg)
+        return self.getreply()
+
+    def putcmd(self, cmd, args=""):
+        self._timed = cmd.lower()
+        super().putcmd(cmd, args)
+
+    def send(self, s):
+        super().send(s)
+        self._sent_at = time.perf_counter()
+
+    def getreply(self):
+        reply = super().getreply()
+        # Only the first reply after a write is a round trip; the rest were already buffered
+        if self._sent_at is not None and self.metrics is not None:
+            self.metrics.observe("smtp_reply_seconds", time.perf_counter() - self._sent_at, command=self._timed)
+        self._sent_at = None
+        return reply
+
+    def _send_body(self, msg):
+        """Send the message after DATA was accepted, then the terminating dot."""
+        self._timed = "message"
+        if isinstance(msg, MessageStream):
+            for segment in msg.segments:
+                if isinstance(segment, bytes):
+                    self.send(_quote_periods(segment))
+                else:
+                    # Spooled parts are headers and base64: no line starts with a dot
+                    for block in segment.chunks():
+                        self.send(block)
+            self.send(b"." + CRLF)
+            return
+        body = _quote_periods(msg)
+        if body[-2:] != CRLF:
+            body += CRLF
+        self.send(body + b"." + CRLF)
+
+    def rcpt_limit(self, default=DEFAULT_RCPT_LIMIT):
+        """Recipients per transaction: the server's LIMITS RCPTMAX (RFC 9422) or ``default``."""
+        self.ehlo_or_helo_if_needed()
+        for item in (self.esmtp_features.get('limits') or '').split():
+            key, _, value = item.partition('=')
+            if key.upper() == 'RCPTMAX' and value.isdigit():
+                return int(value)
+        return default
+
+    def _command(self, cmd, args=""):
+        line = f'{cmd} {args}' if args else cmd
+        if '\r' in line or '\n' in line:
+            raise ValueError(f'command and arguments contain prohibited newline characters: {line!r}')
+        return (line + '\r\n').encode(self.command_encoding)
+
+    def _abort(self, *codes):
+        """Reset the transaction, or drop the socket if the server said 421."""
+        if 421 in codes:
+            self.close()
+            return
+        try:
+            self.rset()
+        except smtplib.SMTPServerDisconnected:
+            # Surfaces on the next command, as with smtplib's own reset
+            pass
+
+
+def _options(options):
+    return (' ' + ' '.join(options)) if options else ''
+
+
+def open_session(host=OFFICE365_HOST, port=OFFICE365_PORT, username=None, password=None,
+                 starttls=True, timeout=60, pipelining=True, metrics=None):
+    """Open an SMTP session, upgrade it with STARTTLS and log in.
+
+    Credentials are optional so the same helper works against a local relay.
+    With ``pipelining`` the session is a ``PipeliningSMTP``. ``metrics``
+    records ``smtp_connect_seconds`` (TCP connect and greeting),
+    ``smtp_login_seconds`` (STARTTLS and AUTH) and, on a
+    ``PipeliningSMTP``, every reply wait.
+    """
+    start = time.perf_counter()
+    server = (PipeliningSMTP if pipelining else smtplib.SMTP)(host, port, timeout=timeout)
+    connected = time.perf_counter()
+    if pipelining:
+        server.metrics = metrics
+    try:
+        if starttls:
+            server.starttls()
+        if username:
+            server.login(username, password)
+    except Exception:
+        server.close()
+        raise
+    if metrics is not None:
+        metrics.observe("smtp_connect_seconds", connected - start)
+        metrics.observe("smtp_login_seconds", time.perf_counter() - connected)
+    return server
+
+
+def reply_code(exc):
+    """Best-effort SMTP reply code for a send exception, or ``None``."""
+    code = getattr(exc, "smtp_code", None)
+    if code is None and isinstance(exc, smtplib.SMTPRecipientsRefused) and exc.recipients:
+        code = next(iter(exc.recipients.values()))[0]
+    return code
+
+
+def is_disconnect(exc):
+    """True when ``exc`` means the session is gone rather than the message was bad."""
+    if isinstance(exc, (smtplib.SMTPServerDisconnected, ConnectionError)):
+        return True
+    return isinstance(exc, smtplib.SMTPResponseException) and exc.smtp_code == 421
+
+
+class SMTPConnection:
+    """A logged-in SMTP session that looks after itself during long sends.
+
+    When the server drops the session (``SMTPServerDisconnected``, a reset
+    socket or a 421 reply) it reconnects with STARTTLS and login and retries
+    the in-flight message, up to ``retries`` times. With ``recycle_after``
+    set it also opens a fresh session every N messages, before relays such
+    as Office 365 cut it off themselves. Sessions pipeline their commands
+    when the server allows it (see ``PipeliningSMTP``).
+    """
+
+    def __init__(self, host=OFFICE365_HOST, port=OFFICE365_PORT, username=None, password=None,
+                 starttls=True, timeout=60, recycle_after=None, retries=2, pipelining=True, metrics=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.recycle_after = recycle_after
+        self.retries = retries
+        self.pipelining = pipelining
+        self.metrics = metrics
+        self.server = None
+        self.sent_on_session = 0
+        self.reconnects = 0
+
+    def __enter__(self):
+        if self.server is None:
+            self.connect()
+        return self
+
+    def __exit__(self, *exc):
+        self.quit()
+
+    def connect(self):
+        self.server = open_session(self.host, self.port, self.username, self.password,
+                                   starttls=self.starttls, timeout=self.timeout,
+                                   pipelining=self.pipelining, metrics=self.metrics)
+        self.sent_on_session = 0
+        return self
+
+    def rcpt_limit(self, default=DEFAULT_RCPT_LIMIT):
+        """Most recipients the server takes in one transaction."""
+        if self.server is None:
+            self.connect()
+        if isinstance(self.server, PipeliningSMTP):
+            return self.server.rcpt_limit(default)
+        return default
+
+    def reconnect(self):
+        self.close()
+        self.reconnects += 1
+        if self.metrics is not None:
+            self.metrics.count("smtp_reconnects")
+        logger.info("Reconnecting to %s:%s", self.host, self.port)
+        self.connect()
+
+    def sendmail(self, from_addr, to_addrs, msg):
+        if isinstance(msg, MessageStream) and not self.pipelining:
+            # Plain smtplib sessions need the whole message in memory
+            msg = bytes(msg)
+        return self._send("sendmail", from_addr, to_addrs, msg)
+
+    def send_message(self, msg, from_addr=None, to_addrs=None):
+        return self._send("send_message", msg, from_addr, to_addrs)
+
+    def _send(self, method, *args):
+        if self.server is None:
+            self.connect()
+        elif self.recycle_after and self.sent_on_session >= self.recycle_after:
+            logger.info("Recycling SMTP session after %d messages", self.sent_on_session)
+            self.quit()
+            self.connect()
+        attempt = 0
+        while True:
+            try:
+                refused = getattr(self.server, method)(*args)
+                self.sent_on_session += 1
+                return refused
+            except Exception as e:
+                if not is_disconnect(e) or attempt >= self.retries:
+                    raise
+                attempt += 1
+                logger.warning("SMTP session lost (%s); retrying", e)
+                self.reconnect()
+
+    def quit(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
+            except Exception:
+                pass
+        self.close()
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.close()
+            except Exception:
+                pass
+        self.server = None
@@ -0,0 +1,186 @@
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import time
+
+from .mime import MessageStream
+
+# Start of messages.bin; each message follows as an 8-byte big-endian length and the bytes
+MAGIC = b"BULKSPOOL 1\r\n"
+LENGTH = struct.Struct(">Q")
+
+MANIFEST = "manifest.json"
+INDEX = "index.jsonl"
+MESSAGES = "messages.bin"
+
+# Stands in for the MIME boundary in digests, so two builds of the same content match
+BOUNDARY_MARK = b"BOUNDARY"
+
+
+def message_digest(message, boundary):
+    """SHA-256 of a message (bytes or ``MessageStream``) with its MIME ``boundary`` blanked out."""
+    digest = hashlib.sha256()
+    boundary = boundary.encode("ascii")
+    segments = message.segments if isinstance(message, MessageStream) else (message,)
+    for segment in segments:
+        if isinstance(segment, bytes):
+            # Boundaries only ever appear in the personalized bytes, never inside a spooled part
+            digest.update(segment.replace(boundary, BOUNDARY_MARK))
+        else:
+            for block in segment.chunks():
+                digest.update(block)
+    return digest.hexdigest()
+
+
+class SpoolWriter:
+    """Writes fully built messages to a spool directory for ``Spool`` to send later.
+
+    The directory holds ``messages.bin`` (each RFC 5322 message, as
+    ``sendmail`` takes it, behind its length), ``index.jsonl`` (one
+    JSON line per message: sequence number, name, recipient, envelope,
+    offset, length and digest) and ``manifest.json``, written last. The
+    spool is built under ``path + ".partial"`` and only replaces ``path``
+    once complete, so a crashed build never looks finished.
+    """
+
+    def __init__(self, path, manifest):
+        self.path = path
+        self.partial = path.rstrip("/\\") + ".partial"
+        self.manifest = dict(manifest)
+        self.boundary = self.manifest.get("boundary", "")
+        if os.path.exists(self.partial):
+            shutil.rmtree(self.partial)
+        os.makedirs(self.partial)
+        self._messages = open(os.path.join(self.partial, MESSAGES), "wb")
+        self._index = open(os.path.join(self.partial, INDEX), "w", encoding="utf-8")
+        self._messages.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.count = 0
+        self.recipients = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def add(self, name, recipient, from_addr, to_addrs, message):
+        """Append one message; ``recipient`` is the journal key (a tuple for a Bcc batch)."""
+        length = len(message)
+        self._messages.write(LENGTH.pack(length))
+        if isinstance(message, MessageStream):
+            for block in message.chunks():
+                self._messages.write(block)
+        else:
+            self._messages.write(message)
+        batch = isinstance(recipient, tuple)
+        entry = {"n": self.count, "name": list(name) if batch else name,
+                 "recipient": list(recipient) if batch else recipient,
+                 "from": from_addr, "to": [to_addrs] if isinstance(to_addrs, str) else list(to_addrs),
+                 "offset": self.offset + LENGTH.size, "length": length,
+                 "digest": message_digest(message, self.boundary)}
+        self._index.write(json.dumps(entry) + "\n")
+        self.offset += LENGTH.size + length
+        self.count += 1
+        self.recipients += len(recipient) if batch else 1
+        return entry
+
+    def close(self, **extra):
+        """Finish the spool: write the manifest and move it into place."""
+        self._messages.close()
+        self._index.close()
+        self.manifest.update(extra, messages=self.count, recipients=self.recipients, bytes=self.offset,
+                             built=time.time())
+        with open(os.path.join(self.partial, MANIFEST), "w", encoding="utf-8") as f:
+            json.dump(self.manifest, f, indent=1)
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+        os.replace(self.partial, self.path)
+
+    def abort(self):
+        self._messages.close()
+        self._index.close()
+        shutil.rmtree(self.partial, ignore_errors=True)
+
+
+class Spool:
+    """A finished spool directory, read back for delivery or inspection.
+
+    Messages are memory-mapped, so each send reads just its own bytes and
+    any number of sender threads can read at once. ``entries()`` streams
+    the index; ``envelope(entry)`` gives ``(from_addr, to_addrs, message)``
+    ready for ``sendmail``.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(os.path.join(path, MANIFEST), encoding="utf-8") as f:
+                self.manifest = json.load(f)
+        except FileNotFoundError:
+            raise ValueError(f"{path} is not a finished spool (no {MANIFEST})") from None
+        self._file = open(os.path.join(path, MESSAGES), "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path}/{MESSAGES} is not a spool message file")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.manifest["messages"]
+
+    def count(self):
+        """Recipients in the spool (Bcc batches count every address)."""
+        return self.manifest["recipients"]
+
+    def entries(self):
+        with open(os.path.join(self.path, INDEX), encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def message(self, entry):
+        offset = entry["offset"]
+        return self._map[offset:offset + entry["length"]]
+
+    def envelope(self, entry, to_addrs=None):
+        """``(from_addr, to_addrs, message)``; ``to_addrs`` overrides the stored envelope."""
+        return entry["from"], entry["to"] if to_addrs is None else to_addrs, self.message(entry)
+
+    def verify(self):
+        """Entries whose bytes, length prefix or digest don't match the index."""
+        boundary = self.manifest.get("boundary", "")
+        bad = []
+        for entry in self.entries():
+            offset = entry["offset"]
+            prefix = self._map[offset - LENGTH.size:offset]
+            if len(prefix) != LENGTH.size or LENGTH.unpack(prefix)[0] != entry["length"] \
+                    or message_digest(self.message(entry), boundary) != entry["digest"]:
+                bad.append(entry)
+        return bad
+
+    def diff(self, other):
+        """Compare by recipient with another spool: ``(added, removed, changed)`` recipient lists."""
+        def digests(spool):
+            return {json.dumps(entry["recipient"]): entry["digest"] for entry in spool.entries()}
+        mine, theirs = digests(self), digests(other)
+        added = [json.loads(key) for key in theirs.keys() - mine.keys()]
+        removed = [json.loads(key) for key in mine.keys() - theirs.keys()]
+        changed = [json.loads(key) for key in mine.keys() & theirs.keys() if mine[key] != theirs[key]]
+        return sorted(added, key=str), sorted(removed, key=str), sorted(changed, key=str)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
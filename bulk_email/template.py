@@ -0,0 +1,62 @@
+from html import escape
+
+from .markdown import markdown_to_html
+
+# Stands in for a {{column}} placeholder while the surrounding text is
+# converted; none of the markdown rules touch it.
+_MARK = "\x00"
+
+
+def mark_placeholders(text, columns):
+    """Replace each ``{{column}}`` with a marker carrying the column's index."""
+    for index, col in enumerate(columns):
+        text = text.replace(f"{{{{{col}}}}}", f"{_MARK}{index}{_MARK}")
+    return text
+
+
+def compile_markdown(text, columns):
+    """Convert markdown once, keeping the placeholders as markers."""
+    return markdown_to_html(mark_placeholders(text, columns))
+
+
+class CompiledTemplate:
+    """A template split into static segments and the columns between them.
+
+    Built once per campaign from marked text (see ``compile_markdown``);
+    ``render(row)`` only joins the segments with the row's values, HTML-escaped,
+    since they go into the page after the markdown step: a name like
+    ``A & <B>`` shows as written instead of becoming markup.
+    """
+
+    def __init__(self, marked, columns):
+        parts = marked.split(_MARK)
+        self.columns = tuple(columns)
+        self.segments = parts[0::2]
+        self.fields = [self.columns[int(index)] for index in parts[1::2]]
+
+    @property
+    def marked(self):
+        """The marked text again, to rebuild the template elsewhere (e.g. in a scheduled job)."""
+        out = [self.segments[0]]
+        for col, segment in zip(self.fields, self.segments[1:]):
+            out.append(f"{_MARK}{self.columns.index(col)}{_MARK}")
+            out.append(segment)
+        return "".join(out)
+
+    def render(self, row):
+        get = row.get
+        out = [self.segments[0]]
+        for col, segment in zip(self.fields, self.segments[1:]):
+            out.append(escape(str(get(col, ''))))
+            out.append(segment)
+        return "".join(out)
+
+
+def load_template(path, columns):
+    """Compile a template file: ``.html`` as-is, anything else as markdown."""
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    if path.lower().endswith(('.html', '.htm')):
+        return CompiledTemplate(mark_placeholders(text, columns), columns)
+    body = compile_markdown(text, columns)
+    return CompiledTemplate(f"<html><body>{body}</body></html>", columns)
@@ -0,0 +1,93 @@
+import hashlib
+import mimetypes
+import os
+import shutil
+import tempfile
+import weakref
+
+from .assets import sniff_image
+from .mime import spool_attachment_part, spool_image_part
+
+
+def iter_uploads(value):
+    """``(name, content)`` for each file in an ipywidgets ``FileUpload.value``.
+
+    Handles both the ipywidgets 7 dict (``{name: {'metadata': ..., 'content': bytes}}``)
+    and the ipywidgets 8 tuple of dicts with ``name`` and a memoryview ``content``.
+    """
+    if isinstance(value, dict):
+        for name, info in value.items():
+            yield info.get('metadata', {}).get('name', name), info['content']
+    else:
+        for info in value:
+            yield info['name'], info['content']
+
+
+class UploadSpool:
+    """Uploaded files written once to a private temp directory and used by path.
+
+    ``add`` stores an upload under a name derived from its content, so the
+    same file uploaded again (or re-read on every widget event) is written
+    once. ``image_part`` and ``attachment_part`` encode a spooled file (or
+    any file on disk) into a ``SpooledPart`` in the spool, a block at a time; messages built from
+    those parts are streamed from disk as they are sent, so memory no longer
+    grows with the size of the attachments. The directory is removed by
+    ``close()`` or when the spool is garbage collected.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = tempfile.mkdtemp(prefix="bulk_email_uploads_", dir=directory)
+        self._cleanup = weakref.finalize(self, shutil.rmtree, self.directory, True)
+        self._parts = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, name, content):
+        """Write ``content`` (bytes or memoryview) to the spool; return its path."""
+        digest = hashlib.sha256(content).hexdigest()[:16]
+        folder = os.path.join(self.directory, digest)
+        path = os.path.join(folder, os.path.basename(name) or "upload")
+        if not os.path.exists(path):
+            os.makedirs(folder, exist_ok=True)
+            partial = path + ".part"
+            with open(partial, "wb") as f:
+                f.write(content)
+            os.replace(partial, path)
+        return path
+
+    def add_uploads(self, value):
+        """Spool every file of a ``FileUpload.value``; ``[(name, path)]`` in upload order."""
+        return [(name, self.add(name, content)) for name, content in iter_uploads(value)]
+
+    def image_part(self, path, cid=None, filename=None, inline=True):
+        """Inline image part for a spooled file; ``ValueError`` if it isn't a readable image."""
+        with open(path, "rb") as f:
+            subtype = sniff_image(f.read(16))
+        if subtype is None:
+            raise ValueError(f"{os.path.basename(path)} is not a readable PNG, JPEG, GIF or WebP image")
+        return self._part(("image", path, cid, filename, inline), lambda dest: spool_image_part(
+            path, dest, cid=cid, filename=filename, inline=inline, subtype=subtype))
+
+    def attachment_part(self, path, filename=None, subtype=None):
+        """Attachment part for a spooled file, typed from its name like ``Asset.attachment_part``."""
+        filename = filename or os.path.basename(path)
+        if subtype is None:
+            maintype, _, subtype = (mimetypes.guess_type(filename)[0] or "").partition("/")
+            if maintype != "application":
+                subtype = "octet-stream"
+        return self._part(("attachment", path, filename, subtype), lambda dest: spool_attachment_part(
+            path, dest, filename, subtype=subtype))
+
+    def close(self):
+        self._parts.clear()
+        self._cleanup()
+
+    def _part(self, key, spool):
+        part = self._parts.get(key)
+        if part is None:
+            part = self._parts[key] = spool(os.path.join(self.directory, f"{len(self._parts)}.mime"))
+        return part
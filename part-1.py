@@ -1,7 +1,8 @@
 import pandas as pd
-import re
 from ipywidgets import FileUpload, Dropdown, VBox, Output, Label, Button, HTML, HBox
 from IPython.display import display, clear_output
+from bulk_email.recipients import CsvRecipients, DUPLICATE_EMAIL, detect_columns, iter_clean_chunks
+from bulk_email.uploads import UploadSpool, iter_uploads
 
 # Widgets
 upload_widget = FileUpload(accept='.csv', multiple=False)
@@ -11,26 +12,30 @@ column_selector_email = Dropdown(description="Email column")
 submit_columns_btn = Button(description="✅ Confirm Columns", button_style='success')
 validation_output = Output()
 
-# Global DataFrame
+# Global recipient list, streamed from the CSV in chunks when sending.
+# The upload is written to a temp file once and read from there.
+csv_spool = UploadSpool()
+recipients = None
+# First rows only, for previews and column lists
 df = pd.DataFrame()
+PREVIEW_ROWS = 5
 
 def handle_upload(change):
   clear_output(wait=True)
   output_preview.clear_output()
-  global df
+  global df, recipients
   if upload_widget.value:
       try:
-          file_info = list(upload_widget.value.values())[0]
-          content = file_info['content']
-          df = pd.read_csv(pd.io.common.BytesIO(content))
+          name, content = next(iter_uploads(upload_widget.value))
+          recipients = CsvRecipients(csv_spool.add(name, content))
+          df = recipients.head(PREVIEW_ROWS)
           
           with output_preview:
               print("✅ CSV File Uploaded Successfully!")
-              print(f"📊 Found {len(df)} rows and {len(df.columns)} columns")
+              print(f"📊 Found {recipients.count()} rows and {len(df.columns)} columns")
               
               # Auto-detect likely name and email columns
-              name_candidates = [col for col in df.columns if any(word in col.lower() for word in ['name', 'full', 'first', 'last'])]
-              email_candidates = [col for col in df.columns if 'email' in col.lower() or 'mail' in col.lower()]
+              name_candidates, email_candidates = detect_columns(df.columns)
               
               if name_candidates:
                   print(f"💡 Auto-detected Name column: '{name_candidates[0]}'")
@@ -88,12 +93,17 @@ def validate_email_list(name_col, email_col):
   validation_output.clear_output()
   if df.empty:
       return
+  valid_count = 0
   errors = []
-  for idx, row in df.iterrows():
-      email = str(row[email_col]).strip()
-      name = str(row[name_col]).strip()
-      if not re.match(r"[^@]+@[^@]+\.[^@]+", email):
-          errors.append((idx+1, name, email))
+  duplicates = []
+  for clean, rejects in iter_clean_chunks(recipients, email_col):
+      valid_count += len(clean)
+      for idx, name, email, reason in zip(rejects.index, rejects[name_col], rejects[email_col], rejects['reason']):
+          entry = (idx+1, str(name).strip(), str(email).strip())
+          if reason == DUPLICATE_EMAIL:
+              duplicates.append(entry)
+          else:
+              errors.append(entry)
   with validation_output:
       if errors:
           print("❌ Invalid email addresses found:")
@@ -101,6 +111,11 @@ def validate_email_list(name_col, email_col):
               print(f"Row {row_num}: {name} - {email}")
       else:
           print("✅ All emails are valid!")
+      if duplicates:
+          print(f"\n🔁 {len(duplicates)} duplicate address(es) will be skipped (each person gets one email):")
+          for row_num, name, email in duplicates:
+              print(f"Row {row_num}: {name} - {email}")
+      print(f"\n👥 {valid_count} unique recipients ready to send")
 
 submit_columns_btn.on_click(lambda b: validate_email_list(
     column_selector_name.value, column_selector_email.value
@@ -1,12 +1,22 @@
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.application import MIMEApplication
-from email.mime.image import MIMEImage
+import os
 import ipywidgets as widgets
 from IPython.display import display, clear_output
 import re
 import io
+from bulk_email.assets import AssetStore
+from bulk_email.mime import MessageSkeleton
+from bulk_email.preview import PreviewCache, content_key
+from bulk_email.smtp import open_session
+from bulk_email.template import CompiledTemplate, compile_markdown
+from bulk_email.uploads import UploadSpool, iter_uploads
+
+# Logo, embedded images and attachments are loaded, checked and encoded once
+# here and shared by the preview, the test email and the bulk send.
+asset_store = AssetStore()
+# Embedded images and attachments are spooled to disk instead and streamed
+# from there into each message, so a large file isn't held per message.
+upload_spool = UploadSpool()
+DEFAULT_LOGO_URL = "https://raw.githubusercontent.com/nanadotam/1nri-photo/main/temp/ASC%20LOGO%20PNG.png"
 
 # -- Globals from Step 1 --
 # Assume df is already loaded, and st_placeholders contains dynamic columns
@@ -43,104 +53,81 @@ preview_button = widgets.Button(description="👀 Preview Email", button_style='
 test_button = widgets.Button(description="📨 Send Test Email", button_style='warning')
 test_email_input = widgets.Text(placeholder='Enter your email', description='Test To:')
 preview_output = widgets.Output()
+preview_html = widgets.HTML()
+preview_row_input = widgets.BoundedIntText(value=1, min=1, max=1, description='Row:', layout=widgets.Layout(width='160px'))
+preview_prev_button = widgets.Button(description="◀", layout=widgets.Layout(width='40px'))
+preview_next_button = widgets.Button(description="▶", layout=widgets.Layout(width='40px'))
+preview_row_label = widgets.HTML()
 test_output = widgets.Output()
 
 # --- Logo Preview Handler ---
+def logo_asset():
+    """The uploaded logo from the asset store, or None when the default ASC logo is used."""
+    if not logo_uploader.value:
+        return None
+    logo_name, logo_content = next(iter_uploads(logo_uploader.value))
+    return asset_store.add(logo_content, logo_name)
+
 def update_logo_preview(change):
     logo_preview_output.clear_output()
     with logo_preview_output:
         if logo_uploader.value:
-            import base64
-            logo_file = list(logo_uploader.value.values())[0]
-            logo_content = logo_file['content']
-            logo_base64 = base64.b64encode(logo_content).decode('utf-8')
-            logo_name = logo_file['metadata']['name']
-            
-            if logo_name.lower().endswith('.png'):
-                data_url = f"data:image/png;base64,{logo_base64}"
-            elif logo_name.lower().endswith(('.jpg', '.jpeg')):
-                data_url = f"data:image/jpeg;base64,{logo_base64}"
-            else:
-                data_url = f"data:image/png;base64,{logo_base64}"
-            
+            logo_name = next(iter_uploads(logo_uploader.value))[0]
+            try:
+                data_url = logo_asset().data_url()
+            except ValueError as e:
+                print(f"❌ {e}. The default ASC logo will be used instead.")
+                return
             print(f"📄 Custom logo: {logo_name}")
             display(widgets.HTML(value=f'<img src="{data_url}" style="max-width: 120px; height: auto; border: 1px solid #ddd; padding: 5px;" />'))
         else:
             print("📄 Default ASC logo will be used")
-            display(widgets.HTML(value='<img src="https://raw.githubusercontent.com/nanadotam/1nri-photo/main/temp/ASC%20LOGO%20PNG.png" style="max-width: 120px; height: auto; border: 1px solid #ddd; padding: 5px;" />'))
+            display(widgets.HTML(value=f'<img src="{DEFAULT_LOGO_URL}" style="max-width: 120px; height: auto; border: 1px solid #ddd; padding: 5px;" />'))
 
 logo_uploader.observe(update_logo_preview, names='value')
 
 # Initialize logo preview with default
 update_logo_preview(None)
 
-# --- Markdown Formatter ---
-def markdown_to_html(text):
-    # Bold + Italic (***text***)
-    text = re.sub(r'\*\*\*(.*?)\*\*\*', r'<strong><em>\1</em></strong>', text)
-    # Bold (**text**)
-    text = re.sub(r'\*\*(.*?)\*\*', r'<strong>\1</strong>', text)
-    # Italic (_text_)
-    text = re.sub(r'_(.*?)_', r'<em>\1</em>', text)
-    # Strikethrough (~~text~~)
-    text = re.sub(r'~~(.*?)~~', r'<del>\1</del>', text)
-    # Monospace (`text`)
-    text = re.sub(r'`(.*?)`', r'<code>\1</code>', text)
-    # Horizontal Rule (---)
-    text = re.sub(r'^---$', r'<hr>', text, flags=re.MULTILINE)
-    # Blockquote (> text)
-    text = re.sub(r'^> (.*)$', r'<blockquote>\1</blockquote>', text, flags=re.MULTILINE)
-    # Links ([text](url))
-    text = re.sub(r'\[([^\]]+)\]\(([^)]+)\)', r'<a href="\2">\1</a>', text)
-    # Images (![alt](url))
-    text = re.sub(r'!\[([^\]]*)\]\(([^)]+)\)', r'<img src="\2" alt="\1" style="max-width: 100%;">', text)
-    # Unordered list (- item)
-    text = re.sub(r'^- (.*)$', r'<ul><li>\1</li></ul>', text, flags=re.MULTILINE)
-    # Ordered list (1. item)
-    text = re.sub(r'^\d+\. (.*)$', r'<ol><li>\1</li></ol>', text, flags=re.MULTILINE)
-    # Line breaks
-    text = re.sub(r'\n', r'<br>', text)
-    return text
-
 # --- Dynamic HTML Email Generator ---
-def generate_email_html(row, embedded_images=None):
-    import base64
-    
+# Compiled once per template/logo/column set, keyed by their content, and each
+# previewed row rendered once per template; rendering a row is then just a join.
+previews = PreviewCache()
+
+def email_template_key(embedded_count=0):
+    """Content key of the template as the editors and uploads stand now, with the logo to use."""
     # Check if custom logo is uploaded, otherwise use default
-    if logo_uploader.value:
-        # Use uploaded custom logo
-        logo_file = list(logo_uploader.value.values())[0]
-        logo_content = logo_file['content']
-        logo_base64 = base64.b64encode(logo_content).decode('utf-8')
-        # Detect image type
-        if logo_file['metadata']['name'].lower().endswith('.png'):
-            logo_url = f"data:image/png;base64,{logo_base64}"
-        elif logo_file['metadata']['name'].lower().endswith(('.jpg', '.jpeg')):
-            logo_url = f"data:image/jpeg;base64,{logo_base64}"
-        else:
-            logo_url = f"data:image/png;base64,{logo_base64}"  # Default to PNG
+    try:
+        logo = logo_asset()
+    except ValueError:
+        # Already reported under the logo uploader
+        logo = None
+    key = content_key(salutation_input.value, body_input.value, signature_input.value,
+                      logo.digest if logo is not None else "", "\x00".join(df.columns), str(embedded_count))
+    return key, logo
+
+def compile_email_template(embedded_count=0):
+    key, logo = email_template_key(embedded_count)
+    return previews.template(key, lambda: _build_email_template(tuple(df.columns), logo, embedded_count))
+
+def _build_email_template(columns, logo, embedded_count):
+    if logo is not None:
+        logo_url = logo.data_url()
         logo_alt = "Custom Logo"
     else:
         # Use default ASC logo
-        logo_url = "https://raw.githubusercontent.com/nanadotam/1nri-photo/main/temp/ASC%20LOGO%20PNG.png"
+        logo_url = DEFAULT_LOGO_URL
         logo_alt = "ASC Logo"
 
-    def apply_placeholders(text):
-        for col in df.columns:
-            placeholder = f"{{{{{col}}}}}"
-            value = str(row.get(col, ''))
-            text = text.replace(placeholder, value)
-        return markdown_to_html(text)
-
-    salutation = apply_placeholders(salutation_input.value)
-    body = apply_placeholders(body_input.value)
+    salutation = compile_markdown(salutation_input.value, columns)
+    body = compile_markdown(body_input.value, columns)
+    signature = compile_markdown(signature_input.value, columns)
 
     embedded_html = ""
-    if embedded_images:
-        for idx in range(len(embedded_images)):
-            embedded_html += f'<img src="cid:image{idx}" style="max-width: 100%; margin-top: 20px;" /><br/>'
+    for idx in range(embedded_count):
+        embedded_html += f'<img src="cid:image{idx}" style="max-width: 100%; margin-top: 20px;" /><br/>'
 
-    return f"""
+    page = f"""
     <html>
       <head>
         <link href="https://fonts.googleapis.com/css2?family=Playfair+Display:ital,wght@1,400&display=swap" rel="stylesheet">
@@ -164,7 +151,7 @@ def generate_email_html(row, embedded_images=None):
             {embedded_html}
 
             <div style="margin-top: 30px; font-family: 'Playfair Display', 'Times New Roman', serif; font-style: italic; font-size: 16px; color: #262626;">
-              {apply_placeholders(signature_input.value)}
+              {signature}
             </div>
 
           </div>
@@ -172,6 +159,10 @@ def generate_email_html(row, embedded_images=None):
       </body>
     </html>
     """
+    return CompiledTemplate(page, columns)
+
+def generate_email_html(row, embedded_images=None):
+    return compile_email_template(len(embedded_images) if embedded_images else 0).render(row)
 
 # --- Format Button Logic ---
 def insert_format(tag):
@@ -235,28 +226,75 @@ image_btn.on_click(lambda b: insert_format('image'))
 line_btn.on_click(lambda b: insert_format('linebreak'))
 
 # --- Preview Handler ---
+def render_preview():
+    """Show the selected row in the preview; only a new template or row is rendered again."""
+    # Any row of the whole list, not just the few loaded in Step 1; only that row is read from the file
+    total = recipients.count()
+    preview_row_input.max = max(1, total)
+    index = preview_row_input.value - 1
+    embedded_count = len(embedded_images_uploader.value) if embedded_images_uploader.value else 0
+    key, logo = email_template_key(embedded_count)
+    template = previews.template(key, lambda: _build_email_template(tuple(df.columns), logo, embedded_count))
+    # The row is read from the file only if this template hasn't rendered it for this upload yet;
+    # an unchanged value isn't sent to the browser again
+    preview_html.value = previews.render((key, recipients.source), index, lambda: recipients.row(index),
+                                         template.render)
+    preview_row_label.value = f"<span style='color: #666;'>of {total} recipients</span>"
+
+def refresh_preview(change=None):
+    # Live while editing, once the preview has been opened
+    if preview_html.value and not df.empty:
+        render_preview()
+
+def page_preview(step):
+    preview_row_input.value = min(max(1, preview_row_input.value + step), preview_row_input.max)
+
 def preview_email(b):
     preview_output.clear_output()
     if df.empty:
         with preview_output:
             print("⚠️ Upload a CSV first.")
         return
-    email_html = generate_email_html(df.iloc[0], embedded_images_uploader.value)
+    render_preview()
     with preview_output:
         # Show logo status
         if logo_uploader.value:
-            logo_name = list(logo_uploader.value.keys())[0]
+            logo_name = next(iter_uploads(logo_uploader.value))[0]
             print(f"🏢 Using custom logo: {logo_name}")
         else:
             print("🏢 Using default ASC logo")
-        
-        display(widgets.HTML(value=email_html))
-        
+
         if embedded_images_uploader.value:
             print(f"✅ Embedded {len(embedded_images_uploader.value)} image(s).")
         if attachments_uploader.value:
             print(f"📎 {len(attachments_uploader.value)} file attachment(s) ready.")
 
+# --- Shared MIME Parts ---
+# Embedded images and attachments are spooled and encoded once, then streamed into every message.
+MAX_ATTACHMENT_SIZE = 5 * 1024 * 1024
+_skeleton_cache = {}
+
+def _clear_skeleton_cache(change):
+    _skeleton_cache.clear()
+
+embedded_images_uploader.observe(_clear_skeleton_cache, names='value')
+attachments_uploader.observe(_clear_skeleton_cache, names='value')
+
+def build_message_skeleton():
+    if 'skeleton' not in _skeleton_cache:
+        parts = []
+        for idx, (fname, path) in enumerate(upload_spool.add_uploads(embedded_images_uploader.value)):
+            parts.append(upload_spool.image_part(path, cid=f'image{idx}', filename=fname))
+        for fname, path in upload_spool.add_uploads(attachments_uploader.value):
+            if os.path.getsize(path) <= MAX_ATTACHMENT_SIZE:
+                parts.append(upload_spool.attachment_part(path, fname))
+        _skeleton_cache['skeleton'] = MessageSkeleton(parts, subtype='related')
+    return _skeleton_cache['skeleton']
+
+def skipped_attachments():
+    return [fname for fname, content in iter_uploads(attachments_uploader.value)
+            if len(content) > MAX_ATTACHMENT_SIZE]
+
 # --- Test Email Sender ---
 def send_test_email(b):
     test_output.clear_output()
@@ -266,36 +304,22 @@ def send_test_email(b):
             print("❌ Invalid test email")
         return
 
-    msg = MIMEMultipart("related")
-    msg["Subject"] = subject_input.value
-    msg["From"] = sender_email_input.value
-    msg["To"] = recipient
-
     html_content = generate_email_html(df.iloc[0], embedded_images_uploader.value)
-    alt_part = MIMEMultipart("alternative")
-    alt_part.attach(MIMEText(html_content, "html"))
-    msg.attach(alt_part)
-
-    for idx, (fname, filedata) in enumerate(embedded_images_uploader.value.items()):
-        img = MIMEImage(filedata['content'])
-        img.add_header('Content-ID', f'<image{idx}>')
-        img.add_header('Content-Disposition', 'inline', filename=fname)
-        msg.attach(img)
-
-    for fname, filedata in attachments_uploader.value.items():
-        if len(filedata['content']) <= 5 * 1024 * 1024:
-            part = MIMEApplication(filedata['content'])
-            part.add_header('Content-Disposition', 'attachment', filename=fname)
-            msg.attach(part)
-        else:
-            with test_output:
-                print(f"⚠️ Skipped large file: {fname}")
+    skeleton = build_message_skeleton()
+    message = skeleton.build([
+        ("Subject", subject_input.value),
+        ("From", sender_email_input.value),
+        ("To", recipient),
+    ], html_content)
+
+    for fname in skipped_attachments():
+        with test_output:
+            print(f"⚠️ Skipped large file: {fname}")
 
     try:
-        server = smtplib.SMTP("smtp.office365.com", 587)
-        server.starttls()
-        server.login(sender_email_input.value, password_input.value)
-        server.sendmail(sender_email_input.value, recipient, msg.as_string())
+        # Streams the spooled attachments from disk while sending
+        server = open_session(username=sender_email_input.value, password=password_input.value)
+        server.sendmail(sender_email_input.value, recipient, message)
         server.quit()
         with test_output:
             print("✅ Test email sent successfully!")
@@ -305,6 +329,11 @@ def send_test_email(b):
 
 # --- Hooks ---
 preview_button.on_click(preview_email)
+preview_prev_button.on_click(lambda b: page_preview(-1))
+preview_next_button.on_click(lambda b: page_preview(1))
+for _widget in (preview_row_input, salutation_input, body_input, signature_input, logo_uploader,
+                embedded_images_uploader):
+    _widget.observe(refresh_preview, names='value')
 test_button.on_click(send_test_email)
 
 # --- Display UI with enhanced organization ---
@@ -405,5 +434,7 @@ display(widgets.VBox([
     widgets.HTML(value="<p style='color: #666; margin: 5px 0;'>Enter your email address for testing:</p>"),
     test_email_input,
     preview_output,
+    widgets.HBox([preview_prev_button, preview_row_input, preview_next_button, preview_row_label]),
+    preview_html,
     test_output
 ]))
@@ -1,11 +1,18 @@
 from tqdm.notebook import tqdm
+import json
+import os
+import shutil
 import time
 import smtplib
-import re
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from ipywidgets import Button, Output, HTML, VBox, HBox
+import pandas as pd
+from ipywidgets import Button, Output, HTML, VBox, HBox, BoundedIntText, BoundedFloatText, Checkbox, Text
 from IPython.display import display
+from bulk_email.campaign import Campaign, SpoolCampaign
+from bulk_email.journal import campaign_id
+from bulk_email.logs import Throttle
+from bulk_email.retry import RetryPolicy
+from bulk_email.scheduler import Scheduler
+from bulk_email.senders import SenderPool
 
 # --- Send Button + Output Widgets ---
 send_all_button = Button(description="🚀 Send All Emails", button_style='danger')
@@ -14,11 +21,67 @@ confirm_button = Button(description="⚠️ Confirm Send to ALL Recipients", but
 cancel_button = Button(description="❌ Cancel", button_style='')
 send_output = Output()
 confirmation_output = Output()
+connections_input = BoundedIntText(value=4, min=1, max=16, description='Connections:')
+max_rate_input = BoundedFloatText(value=0, min=0, max=100, step=0.5, description='Max emails/s:')
+recycle_input = BoundedIntText(value=200, min=0, max=10000, description='Reconnect every:')
+per_domain_input = BoundedIntText(value=0, min=0, max=16, description='Per domain:')
+resume_checkbox = Checkbox(value=True, description='Resume: skip recipients already sent in this campaign')
+metrics_view = HTML()
+build_button = Button(description="🧱 Build Messages First", button_style='info')
+build_output = Output()
+use_spool_checkbox = Checkbox(value=False, disabled=True, description='Send the built messages instead of rendering while sending')
+schedule_button = Button(description="🗓️ Schedule in Batches", button_style='info')
+schedule_output = Output()
+window_input = Text(value='mon-fri 08:00-18:00', description='Send window:',
+                    placeholder='e.g. mon-fri 08:00-18:00; sat 10:00-13:00')
+batch_size_input = BoundedIntText(value=500, min=10, max=10000, description='Batch size:')
+daily_quota_input = BoundedIntText(value=10000, min=0, max=100000, description='Per day:')
+
+# Seconds between refreshes of the progress bar, progress lines and live timing table
+UI_INTERVAL = 2.0
+
+# Every send is recorded here so an interrupted campaign can be resumed
+JOURNAL_PATH = "send_journal.sqlite3"
+
+# If this file exists, recipients are shared between the sender accounts it lists
+# (see SenderPool.from_file) and the Step 2 address is only used as the From address
+SENDER_ACCOUNTS_FILE = "sender_accounts.json"
+
+# Optional per-domain limits on top of 'Per domain' (see DOMAIN_PROFILES), e.g.
+# {"ashesi.edu.gh": {"concurrency": 1, "per_minute": 60}}
+DOMAIN_LIMITS_FILE = "domain_limits.json"
+
+# 'Build Messages First' renders every email into this folder; sending then just streams them out
+SPOOL_PATH = "campaign.spool"
+
+# Scheduled campaigns are queued here and sent by `python -m bulk_email worker`;
+# their recipient lists are copied next to it, since uploads only live as long as this kernel
+SCHEDULE_DB = "send_schedule.sqlite3"
+SCHEDULE_DIR = "scheduled_lists"
 
 # --- Global flags ---
 stop_sending = False
 confirmed = False
 
+def domain_limits():
+    """Campaign domain_limits from the 'Per domain' box and DOMAIN_LIMITS_FILE; None (0, no file) sends in list order."""
+    if not per_domain_input.value and not os.path.exists(DOMAIN_LIMITS_FILE):
+        return None
+    limits = {}
+    if os.path.exists(DOMAIN_LIMITS_FILE):
+        with open(DOMAIN_LIMITS_FILE) as f:
+            limits = json.load(f)
+    if per_domain_input.value:
+        limits["default"] = dict(limits.get("default", {}), concurrency=per_domain_input.value)
+    return limits
+
+# --- Live Timing Dashboard ---
+def show_metrics(metrics):
+    """Per-stage timings from the campaign's metrics, slowest stage first."""
+    rows = metrics.table()
+    if rows:
+        metrics_view.value = pd.DataFrame(rows).to_html(index=False)
+
 # --- Confirmation Functions ---
 def show_confirmation(b):
     global confirmed
@@ -30,7 +93,7 @@ def show_confirmation(b):
             print("❌ No CSV data loaded. Please complete Step 1 first.")
         return
     
-    recipient_count = len(df)
+    recipient_count = recipients.count()
     
     with confirmation_output:
         print(f"⚠️ CONFIRMATION REQUIRED")
@@ -41,7 +104,7 @@ def show_confirmation(b):
         
         if recipient_count > 50:
             print("\n🚨 WARNING: Large recipient list detected!")
-            print("   Consider breaking this into smaller batches")
+            print("   Consider '🗓️ Schedule in Batches' below to spread it over your sending hours")
             print("   Sending too many emails at once may trigger spam filters")
         
         print("\n💡 This action cannot be undone!")
@@ -102,6 +165,10 @@ def send_bulk_emails(b):
         with send_output:
             print("❌ Please enter your email credentials in Step 2.")
         return
+    if use_spool_checkbox.value and not os.path.isdir(SPOOL_PATH):
+        with send_output:
+            print("❌ No built messages found. Click 'Build Messages First' again or untick 'Send the built messages'.")
+        return
 
     # Enable stop button, disable other buttons
     send_all_button.disabled = True
@@ -109,84 +176,78 @@ def send_bulk_emails(b):
     cancel_button.disabled = True
     stop_button.disabled = False
 
-    name_col = column_selector_name.value
-    email_col = column_selector_email.value
-    total_recipients = len(df)
-
-    failed_list = []
-    sent_count = 0
-    start_time = time.time()
+    delivery = dict(
+        connections=connections_input.value,
+        # Office 365 per-minute/per-day budgets, optionally capped further by the user
+        max_rate=max_rate_input.value or None,
+        # Reconnects and retries by itself if Office 365 drops the session
+        recycle_after=recycle_input.value or None,
+        # Transient failures (4xx, dropped sessions) are retried after roughly 30s, 60s, 120s
+        retry_policy=RetryPolicy(max_attempts=4, base_delay=30),
+        # Same sender, subject, message and recipient list = same campaign in the journal
+        journal_path=JOURNAL_PATH, resume=resume_checkbox.value,
+        senders=SenderPool.from_file(SENDER_ACCOUNTS_FILE) if os.path.exists(SENDER_ACCOUNTS_FILE) else None,
+        # Recipient domains take turns; one that starts deferring backs off while the others carry on
+        domain_limits=domain_limits(),
+    )
+    if use_spool_checkbox.value:
+        # Every email was rendered by 'Build Messages First'; only sending is left
+        campaign = SpoolCampaign(SPOOL_PATH, password_input.value, **delivery)
+        if (campaign.sender, campaign.subject) != (sender_email_input.value, subject_input.value):
+            with send_output:
+                print("⚠️ The built messages have a different sender or subject than Step 2; sending them as built.")
+    else:
+        campaign = Campaign(
+            recipients, compile_email_template(), subject_input.value,
+            sender_email_input.value, password_input.value,
+            name_col=column_selector_name.value, email_col=column_selector_email.value,
+            # Read, render and send in overlapping stages so the sockets never wait on rendering
+            staged=True, **delivery,
+        )
 
     try:
         with send_output:
-            print("🔗 Connecting to email server...")
-        
-        server = smtplib.SMTP("smtp.office365.com", 587)
-        server.starttls()
-        server.login(sender_email_input.value, password_input.value)
+            print(f"🔗 Connecting to email server ({connections_input.value} connections)...")
 
-        with send_output:
-            print("✅ Successfully connected to email server!")
-            print("📊 Email Campaign Details:")
-            print(f"   📧 From: {sender_email_input.value}")
-            print(f"   📝 Subject: {subject_input.value}")
-            print(f"   👥 Total Recipients: {total_recipients}")
-            print("📨 Starting email send... (Click 'Stop Sending' to cancel)\n")
-
-        for index, row in tqdm(df.iterrows(), total=len(df), desc="Sending emails"):
-            # Check if stop was requested
-            if stop_sending:
-                with send_output:
-                    print(f"\n🛑 Sending stopped by user at {sent_count}/{total_recipients} emails sent.")
-                break
-                
-            name = str(row[name_col]).strip()
-            recipient = str(row[email_col]).strip()
-            
-            # Validate email format
-            if not re.match(r"[^@]+@[^@]+\.[^@]+", recipient):
-                failed_list.append((name, recipient, "Invalid email format"))
-                continue
-
-            try:
-                # Create email message
-                msg = MIMEMultipart("alternative")
-                msg["Subject"] = subject_input.value
-                msg["From"] = sender_email_input.value
-                msg["To"] = recipient
-                msg.attach(MIMEText(generate_email_html(row), "html"))
-
-                # Send email
-                server.sendmail(sender_email_input.value, recipient, msg.as_string())
-                sent_count += 1
-                
-                # Progress update every 10 emails
-                if sent_count % 10 == 0:
-                    elapsed_time = time.time() - start_time
+        with campaign:
+            report = campaign.report
+            total_recipients = report.total
+            with send_output:
+                print("✅ Successfully connected to email server!")
+                print("📊 Email Campaign Details:")
+                print(f"   📧 From: {campaign.sender}")
+                print(f"   📝 Subject: {campaign.subject}")
+                print(f"   👥 Total Recipients: {total_recipients}")
+                if campaign.already_sent:
+                    print(f"   ⏭️ Resuming: {len(campaign.already_sent)} recipients already sent will be skipped")
+                print("📨 Starting email send... (Click 'Stop Sending' to cancel)\n")
+
+            results = campaign.results(should_stop=lambda: stop_sending)
+            redraw = Throttle(UI_INTERVAL)
+            for result in tqdm(results, total=total_recipients, desc="Sending emails", mininterval=UI_INTERVAL):
+                sent_count = report.sent
+                # Progress update at most every UI_INTERVAL seconds, however fast emails go out
+                if sent_count and redraw():
+                    show_metrics(campaign.metrics)
+                    elapsed_time = report.elapsed
                     avg_time_per_email = elapsed_time / sent_count
                     remaining_emails = total_recipients - sent_count
                     estimated_time_remaining = remaining_emails * avg_time_per_email
-                    
+
                     with send_output:
                         print(f"📈 Progress: {sent_count}/{total_recipients} sent ({(sent_count/total_recipients)*100:.1f}%)")
                         print(f"⏱️ Estimated time remaining: {estimated_time_remaining/60:.1f} minutes")
-                
-                time.sleep(0.5)  # Delay to avoid spam filters
 
-            except smtplib.SMTPRecipientsRefused:
-                failed_list.append((name, recipient, "Recipient email refused by server"))
-                continue
-            except smtplib.SMTPDataError as e:
-                failed_list.append((name, recipient, f"SMTP Data Error: {str(e)}"))
-                continue
-            except Exception as e:
-                failed_list.append((name, recipient, f"Unexpected error: {str(e)}"))
-                continue
+        show_metrics(campaign.metrics)
+        sent_count = report.sent
+        failed_list = report.failed
 
-        server.quit()
+        if stop_sending:
+            with send_output:
+                print(f"\n🛑 Sending stopped by user at {sent_count}/{total_recipients} emails sent.")
 
         # Final results
-        elapsed_time = time.time() - start_time
+        elapsed_time = report.elapsed
         success_rate = (sent_count / total_recipients) * 100 if total_recipients > 0 else 0
 
         with send_output:
@@ -194,7 +255,20 @@ def send_bulk_emails(b):
             print("📊 CAMPAIGN SUMMARY")
             print("="*50)
             print(f"✅ Successfully sent: {sent_count}/{total_recipients} emails ({success_rate:.1f}%)")
+            if report.skipped:
+                print(f"⏭️ Skipped (already sent earlier): {report.skipped}")
+            if report.retried:
+                print(f"🔁 Automatically retried {report.retried} temporary failure(s)")
             print(f"⏱️ Total time: {elapsed_time/60:.1f} minutes")
+            for stage in report.stages.values():
+                print(f"   ⚙️ {stage.describe(elapsed_time)}")
+            if campaign.senders is not None:
+                for username, sent, failovers, exhausted in campaign.senders.summary():
+                    print(f"   📮 {username}: {sent} sent, {failovers} moved to other accounts"
+                          + (" (daily quota used up)" if exhausted else ""))
+            for domain, sent, deferred, backoffs in report.domains:
+                if deferred:
+                    print(f"   🐢 {domain}: {sent} sent, {deferred} deferred by the server, slowed down {backoffs} time(s)")
             print(f"📧 Average: {elapsed_time/sent_count:.1f} seconds per email" if sent_count > 0 else "")
             
             if failed_list:
@@ -206,9 +280,9 @@ def send_bulk_emails(b):
                 # Suggest retry for certain errors
                 retry_candidates = [entry for entry in failed_list if "timeout" in entry[2].lower() or "connection" in entry[2].lower()]
                 if retry_candidates:
-                    print(f"\n💡 {len(retry_candidates)} failures may be due to temporary network issues. Consider retrying those recipients.")
+                    print(f"\n💡 {len(retry_candidates)} failures may be due to temporary network issues and still failed after automatic retries. Consider retrying those recipients later.")
             
-            if not stop_sending and sent_count == total_recipients:
+            if report.completed:
                 print("\n🎉 Campaign completed successfully!")
 
     except smtplib.SMTPAuthenticationError:
@@ -233,11 +307,102 @@ def send_bulk_emails(b):
         confirm_button.disabled = True
         cancel_button.disabled = True
 
+# --- Build Messages Ahead of Sending ---
+def build_messages(b):
+    build_output.clear_output()
+    with build_output:
+        if df.empty:
+            print("❌ No CSV data loaded. Please complete Step 1 first.")
+            return
+        if not sender_email_input.value:
+            print("❌ Please enter your sender email in Step 2.")
+            return
+        build_button.disabled = True
+        campaign = Campaign(
+            recipients, compile_email_template(), subject_input.value, sender_email_input.value, None,
+            name_col=column_selector_name.value, email_col=column_selector_email.value,
+        )
+        try:
+            print(f"🧱 Building {recipients.count()} emails into {SPOOL_PATH}...")
+            for result in tqdm(campaign.build_spool(SPOOL_PATH), total=recipients.count(),
+                               desc="Building emails", mininterval=UI_INTERVAL):
+                pass
+        except Exception as e:
+            print(f"🚨 Build failed: {str(e)}")
+            return
+        finally:
+            build_button.disabled = False
+        report = campaign.report
+        size = sum(entry.stat().st_size for entry in os.scandir(SPOOL_PATH))
+        print(f"✅ Built {report.sent} emails ({size / 1e6:.1f} MB) in {report.elapsed:.1f} seconds")
+        if report.failed:
+            print(f"❌ {len(report.failed)} row(s) could not be built and will not be sent:")
+            for entry in report.failed:
+                print(f"   • {entry[0]} ({entry[1]}): {entry[2]}")
+        print(f"💡 Check them with: python -m bulk_email inspect {os.path.abspath(SPOOL_PATH)} --show 0")
+        print("   Tick 'Send the built messages' above, then send as usual.")
+        use_spool_checkbox.disabled = False
+        use_spool_checkbox.value = True
+
+# --- Scheduled Sending ---
+def schedule_campaign(b):
+    schedule_output.clear_output()
+    with schedule_output:
+        if df.empty:
+            print("❌ No CSV data loaded. Please complete Step 1 first.")
+            return
+        if not sender_email_input.value:
+            print("❌ Please enter your sender email in Step 2.")
+            return
+        windows = [part.strip() for part in window_input.value.split(';') if part.strip()]
+        campaign = campaign_id(sender_email_input.value, subject_input.value, recipients.digest())
+        os.makedirs(SCHEDULE_DIR, exist_ok=True)
+        csv_path = os.path.abspath(os.path.join(SCHEDULE_DIR, f"{campaign}.csv"))
+        if isinstance(recipients.source, bytes):
+            with open(csv_path, 'wb') as f:
+                f.write(recipients.source)
+        else:
+            shutil.copyfile(recipients.source, csv_path)
+        template = compile_email_template()
+        spec = {
+            "recipients": csv_path,
+            "template": {"marked": template.marked, "columns": list(template.columns)},
+            "subject": subject_input.value, "sender": sender_email_input.value,
+            # The worker reads the password from its environment; it is never stored
+            "password_env": "EMAIL_PASSWORD",
+            "senders": os.path.abspath(SENDER_ACCOUNTS_FILE) if os.path.exists(SENDER_ACCOUNTS_FILE) else None,
+            "retries": 3, "retry_delay": 30,
+            "options": {
+                "name_col": column_selector_name.value, "email_col": column_selector_email.value,
+                "connections": connections_input.value, "max_rate": max_rate_input.value or None,
+                "recycle_after": recycle_input.value or None, "staged": True,
+                "journal_path": os.path.abspath(JOURNAL_PATH), "resume": True,
+                "domain_limits": domain_limits(),
+            },
+        }
+        try:
+            with Scheduler(SCHEDULE_DB) as scheduler:
+                job = scheduler.add(spec, recipients.count(), batch_size=batch_size_input.value, windows=windows,
+                                    daily_quota=daily_quota_input.value or None)
+        except ValueError as e:
+            print(f"❌ {e}")
+            return
+        batches = -(-recipients.count() // batch_size_input.value)
+        print(f"✅ Scheduled job {job}: {recipients.count()} recipients in {batches} batch(es)")
+        print(f"   🕗 Sending hours: {', '.join(windows) or 'any time'}")
+        if daily_quota_input.value:
+            print(f"   📅 At most {daily_quota_input.value} recipients per day")
+        print("💡 Start a worker on a machine that stays on (it resumes where it left off if restarted):")
+        print(f"   EMAIL_PASSWORD=... python -m bulk_email worker --db {os.path.abspath(SCHEDULE_DB)}")
+        print(f"   Check progress with: python -m bulk_email jobs --db {os.path.abspath(SCHEDULE_DB)}")
+
 # --- Hook Up Buttons ---
 send_all_button.on_click(show_confirmation)
 stop_button.on_click(stop_sending_emails)
 confirm_button.on_click(confirm_send)
 cancel_button.on_click(cancel_send)
+schedule_button.on_click(schedule_campaign)
+build_button.on_click(build_messages)
 
 # --- Display Enhanced UI ---
 display(HTML(value="""
@@ -253,7 +418,7 @@ display(HTML(value="""
 <ul style="margin: 10px 0; color: #856404;">
 <li><strong>Test First:</strong> Always send a test email from Step 2 before bulk sending</li>
 <li><strong>Check Recipients:</strong> Verify your CSV data is correct</li>
-<li><strong>Small Batches:</strong> For large lists (50+), consider breaking into smaller batches</li>
+<li><strong>Small Batches:</strong> For large lists (50+), schedule the campaign to go out in batches over your sending hours</li>
 <li><strong>Monitor Progress:</strong> Watch for errors and use the stop button if needed</li>
 <li><strong>Backup Plan:</strong> Keep a record of failed sends for follow-up</li>
 </ul>
@@ -263,12 +428,25 @@ display(HTML(value="""
 display(VBox([
     HTML(value="<h3 style='color: #dc3545;'>🚀 Bulk Email Sending</h3>"),
     HTML(value="<p style='color: #666; margin: 10px 0;'>Click the button below to start the confirmation process:</p>"),
+    HBox([connections_input, max_rate_input, recycle_input, per_domain_input]),
+    resume_checkbox,
+    HBox([build_button, use_spool_checkbox]),
+    build_output,
+    HTML(value="<small style='color: #666;'>More connections send in parallel; sending stays within Office 365 limits and slows down automatically if the server pushes back. Max emails/s adds an extra cap (0 = Office 365 defaults). Each connection starts a fresh session after the 'Reconnect every' count (0 = never). 'Per domain' caps the emails in flight to any one recipient domain, so a busy school server can't hold up everyone else (0 = send in list order)</small>"),
     HBox([send_all_button, stop_button]),
     confirmation_output,
     HTML(value="<h4 style='color: #dc3545;'>Confirmation Required</h4>"),
     HTML(value="<p style='color: #666; margin: 5px 0;'>After clicking 'Send All Emails', you'll need to confirm:</p>"),
     HBox([confirm_button, cancel_button]),
     HTML(value="<hr style='border: 1px solid #dee2e6; margin: 20px 0;'>"),
+    HTML(value="<h4 style='color: #17a2b8;'>🗓️ Or Schedule It</h4>"),
+    HTML(value="<p style='color: #666; margin: 5px 0;'>Queue the campaign to go out in batches within your sending hours and daily limit, without keeping this notebook open. Separate several windows with ';'.</p>"),
+    HBox([window_input, batch_size_input, daily_quota_input]),
+    schedule_button,
+    schedule_output,
+    HTML(value="<hr style='border: 1px solid #dee2e6; margin: 20px 0;'>"),
     HTML(value="<h4 style='color: #007bff;'>📊 Sending Progress & Results</h4>"),
-    send_output
+    send_output,
+    HTML(value="<h4 style='color: #007bff;'>⏱️ Where the time goes</h4>"),
+    metrics_view
 ]))
@@ -1,24 +1,26 @@
-import pandas as pd
-import smtplib
+import sys
 from email.message import EmailMessage
 import os
 from dotenv import load_dotenv
 import logging
+import time
 from datetime import datetime
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
 
-# Configure logging
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bulk_email import QuotaExceeded, SMTPConnection, limiter_for
+from bulk_email.logs import log_send, queue_logging
+from bulk_email.recipients import CsvRecipients, iter_clean_chunks
+
+# Configure logging; records are written by a background thread so sends never wait on disk or console
 log_filename = f'email_sender_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_filename),
-        logging.StreamHandler()  # This will also print to console
-    ]
+queue_logging(
+    logging.FileHandler(log_filename),
+    logging.StreamHandler()  # This will also print to console
 )
+logger = logging.getLogger()
 
 # Load environment variables
 load_dotenv()
@@ -26,10 +28,11 @@ logging.info("Environment variables loaded")
 
 try:
     # Load the CSV file
-    csv_path = 'test_list_nana.csv'
+    # CSV path from the command line; the old fixed name is still the default
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else 'test_list_nana.csv'
     logging.info(f"Attempting to read CSV file from: {csv_path}")
-    data = pd.read_csv(csv_path)
-    logging.info(f"Successfully loaded CSV with {len(data)} entries")
+    data = CsvRecipients(csv_path)
+    logging.info(f"Successfully opened CSV with {data.count()} entries")
 
     # Email server configuration
     smtp_server = 'smtp.office365.com'
@@ -52,23 +55,29 @@ try:
     Your Team
     """
 
+    limiter = limiter_for(smtp_server)
+
+    def clean_rows():
+        for clean, rejects in iter_clean_chunks(data, 'Email'):
+            for email, reason in zip(rejects['Email'], rejects['reason']):
+                logging.warning(f"Skipping {email}: {reason}")
+            yield from clean.to_dict('records')
+
     # Initialize the SMTP server
     logging.info(f"Attempting to connect to SMTP server: {smtp_server}:{smtp_port}")
-    with smtplib.SMTP(smtp_server, smtp_port) as server:
-        server.starttls()
-        logging.info("TLS connection established")
-        
-        server.login(sender_email, sender_password)
-        logging.info("Successfully logged into SMTP server")
-
-        # Loop through each row in the CSV file
-        for index, row in data.iterrows():
+    with SMTPConnection(smtp_server, smtp_port, sender_email, sender_password, recycle_after=200) as server:
+        logging.info("Successfully logged into SMTP server over TLS")
+
+        # Loop through each valid, de-duplicated row in the CSV file
+        for row in clean_rows():
+            # Bound before any column lookup, so a failure on this row logs this row
+            recipient = row['Email']
+            started = time.perf_counter()
+            # Extra fields for this recipient's log record
+            notes = {}
             try:
-                recipient = row['Email']
                 name = row['Name']
                 pdf_path = row['PDFPath']
-                
-                logging.info(f"Processing email for: {recipient}")
 
                 # Create the email
                 msg = EmailMessage()
@@ -88,9 +97,8 @@ try:
                             subtype='pdf', 
                             filename=os.path.basename(pdf_path)
                         )
-                    logging.info(f"PDF attached successfully: {pdf_path}")
                 else:
-                    logging.warning(f"Attachment not found: {pdf_path}")
+                    notes['attachment'] = 'missing'
 
                 # Create HTML content with embedded images
                 html = f"""
@@ -117,11 +125,15 @@ try:
                     msg.attach(img)
 
                 # Send the email
-                server.send_message(msg)
-                logging.info(f"Email successfully sent to: {recipient}")
+                limiter.call(server.send_message, msg)
+                # One compact record per email instead of a line per step
+                log_send(logger, recipient, time.perf_counter() - started, **notes)
 
+            except QuotaExceeded as e:
+                logging.error(f"Stopping at {recipient}: {str(e)}")
+                break
             except Exception as e:
-                logging.error(f"Error processing email for {recipient}: {str(e)}")
+                log_send(logger, recipient, time.perf_counter() - started, error=e, **notes)
                 continue
 
     logging.info("Email sending process completed successfully")
@@ -1,31 +1,61 @@
 import streamlit as st
 import pandas as pd
-import smtplib
 from email.message import EmailMessage
 import os
 from dotenv import load_dotenv
 import logging
+import collections
 from datetime import datetime
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.image import MIMEImage
-from email.mime.application import MIMEApplication
 from jinja2 import Template
+from bulk_email.assets import AssetStore
+from bulk_email.campaign import Campaign
+from bulk_email.logs import Throttle, log_result, queue_logging
+from bulk_email.metrics import JsonLinesSink, Metrics
+from bulk_email.preview import PreviewCache, content_key
+from bulk_email.recipients import CsvRecipients
 
 # Create logs directory if it doesn't exist
 if not os.path.exists('logs'):
     os.makedirs('logs')
 
-# Configure logging
-log_filename = f'logs/email_sender_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_filename),
-        logging.StreamHandler()
-    ]
-)
+@st.cache_resource
+def setup_logging():
+    """One log file and background logging thread per server process, not per rerun; returns its path."""
+    log_filename = f'logs/email_sender_{datetime.now().strftime("%Y%m%d_%H%M%S")}.log'
+    queue_logging(logging.FileHandler(log_filename), logging.StreamHandler())
+    return log_filename
+
+log_filename = setup_logging()
+logger = logging.getLogger(__name__)
+
+# Start a fresh SMTP session after this many messages
+RECYCLE_AFTER = 200
+
+SLE_EMAIL = 'sle@ashesi.edu.gh'
+
+# Per-stage timings are written next to the log every this many seconds
+METRICS_INTERVAL = 30
+# Progress, recent sends, failures and timings are redrawn at most this often while sending
+UI_INTERVAL = 1.0
+# Recent sends shown under the progress bar
+RECENT_SENDS = 10
+
+@st.cache_resource
+def get_asset_store():
+    """One asset cache per server process, kept across reruns and sends."""
+    return AssetStore()
+
+@st.cache_resource
+def get_previews():
+    """Preview renders kept across reruns, so paging back to a recipient costs nothing."""
+    return PreviewCache()
+
+def nomination_html(template, row):
+    return template.format(
+        image_url="cid:header_image",
+        name=row['Name of Nominee'],
+        nominator_name=row['Nominator Name']
+    )
 
 def initialize_app():
     st.set_page_config(page_title="Email Sender App", layout="wide")
@@ -38,21 +68,21 @@ def upload_csv():
     uploaded_file = st.file_uploader("Upload your CSV file", type=['csv'])
     if uploaded_file is not None:
         try:
-            df = pd.read_csv(uploaded_file)
+            recipients = CsvRecipients(uploaded_file.getvalue())
             required_columns = ['Nominator Email(CC)', 'Nominator Name', 'Nominee Email', 'Name of Nominee', 'PDFPath']
-            if not all(col in df.columns for col in required_columns):
+            if not all(col in recipients.columns for col in required_columns):
                 st.error(f"CSV must contain columns: {', '.join(required_columns)}")
                 return None
             
             # Store data in session state but don't preview here
-            st.session_state.preview_data = df
-            return df
+            st.session_state.preview_data = recipients
+            return recipients
         except Exception as e:
             st.error(f"Error reading CSV: {str(e)}")
             logging.error(f"CSV upload error: {str(e)}")
     return None
 
-def email_settings():
+def email_settings(data):
     with st.expander("Email Settings", expanded=True):
         st.subheader("Email Header Image")
         uploaded_header = st.file_uploader("Upload header image", type=['png', 'jpg', 'jpeg'])
@@ -71,10 +101,6 @@ def email_settings():
         
         subject = st.text_input("Email Subject", value="Caught Being Good Nomination!")
         
-        # Create a sample preview using the template
-        sample_name = "Sample Recipient"
-        sample_nominator = "Sample Nominator"
-        
         # Create HTML content with proper escaping of curly braces for CSS
         template_content = """<!DOCTYPE html>
 <html>
@@ -151,11 +177,17 @@ def email_settings():
         if st.session_state.get('header_image_data'):
             st.image(st.session_state.header_image_data, caption="Header Image Preview", width=600)
         
-        # Format the template with both required parameters
-        preview_html = template_content.format(
-            name=sample_name,
-            nominator_name=sample_nominator
-        )
+        # Page through the real recipients; each one is read and formatted once per template and CSV
+        preview_row = st.number_input("Preview recipient", min_value=1, value=1, step=1)
+        key = content_key(template_content, data.digest())
+        # The nominee's name is kept with the HTML for the note under the preview
+        render = lambda row: (nomination_html(template_content, row), row['Name of Nominee'])
+        try:
+            preview_html, nominee = get_previews().render(key, preview_row - 1,
+                                                          lambda: data.row(preview_row - 1), render)
+        except IndexError:
+            st.warning(f"There is no recipient {preview_row} in the CSV; showing the first one")
+            preview_html, nominee = get_previews().render(key, 0, lambda: data.row(0), render)
         
         # Display the formatted content in a container with custom CSS
         st.markdown("""
@@ -175,7 +207,7 @@ def email_settings():
         st.markdown("</div>", unsafe_allow_html=True)
         
         # Add a note about the preview
-        st.info("👆 This is how your email will appear to recipients. The actual email will include the uploaded header image and personalized name.")
+        st.info(f"👆 This is how your email will appear to {nominee}. The actual email will include the uploaded header image.")
 
         return {
             'email': email,
@@ -185,102 +217,106 @@ def email_settings():
             'header_image_data': st.session_state.get('header_image_data') if 'header_image_data' in st.session_state else None
         }
 
+class NominationCampaign(Campaign):
+    """Nominee emails: CC the SLE office and the nominator, attach the nominee's PDF."""
+
+    def render_html(self, row):
+        return nomination_html(self.template, row)
+
+    def cc_for(self, row):
+        # Handle CC recipients - now including SLE email
+        cc_recipients = [SLE_EMAIL]  # Start with SLE email
+        nominator_cc = row['Nominator Email(CC)']
+        if isinstance(nominator_cc, str) and '@' in nominator_cc:
+            cc_recipients.append(nominator_cc.strip())
+        return cc_recipients
+
+    def attachment_paths(self, row):
+        return [row['PDFPath'] + ".pdf"]
+
+    def attachments_for(self, row):
+        pdf_path_with_extension = row['PDFPath'] + ".pdf"
+        # Missing files were found by check_attachments() before sending
+        if pdf_path_with_extension in self.missing_attachments:
+            logging.warning(f"PDF path not found for {row['Nominee Email']}: {pdf_path_with_extension}")
+            return []
+        # Usually already read and encoded in the background while earlier emails were sending
+        return super().attachments_for(row)
+
 def send_emails(settings, data):
     try:
-        smtp_server = 'smtp.office365.com'
-        smtp_port = 587
-        SLE_EMAIL = 'sle@ashesi.edu.gh'  # Add constant
-        logging.info(f"Attempting to connect to SMTP server: {smtp_server}:{smtp_port}")
-        
         if not settings.get('header_image_data'):
             raise ValueError("Header image is required")
         
+        assets = get_asset_store()
+        header_image = assets.add(settings['header_image_data'], 'header image')
+        
+        campaign = NominationCampaign(
+            data, settings['template'], settings['subject'], settings['email'], settings['password'],
+            name_col='Name of Nominee', email_col='Nominee Email',
+            # One session, reconnected by itself if the server drops it
+            connections=1, recycle_after=RECYCLE_AFTER,
+            # Read the next nominee's PDF and build the message while the current one sends
+            staged=True,
+            # Nominees can legitimately share an address; send every row
+            dedupe=False,
+            # Header image is encoded once and shared by every message
+            shared_parts=[header_image.image_part(cid='header_image')],
+            assets=assets,
+            metrics=Metrics([JsonLinesSink(os.path.splitext(log_filename)[0] + '_metrics.jsonl')],
+                            interval=METRICS_INTERVAL),
+        )
+        missing = campaign.check_attachments()
+        if missing:
+            st.warning(f"{len(missing)} PDF file(s) not found; those nominees will get the email without a certificate:")
+            st.code("\n".join(missing[:50]) + (f"\n... and {len(missing) - 50} more" if len(missing) > 50 else ""))
+            logging.warning(f"{len(missing)} PDF file(s) not found: {', '.join(missing)}")
+        logging.info(f"Attempting to connect to SMTP server: {campaign.host}:{campaign.port}")
+        
         with st.spinner('Sending emails...'):
             progress_bar = st.progress(0)
-            total_emails = len(data)
+            recent = st.empty()
+            failures = st.empty()
+            timings = st.empty()
+            sent_lines = collections.deque(maxlen=RECENT_SENDS)
             
-            with smtplib.SMTP(smtp_server, smtp_port) as server:
-                server.starttls()
-                logging.info("TLS connection established")
-                
-                server.login(settings['email'], settings['password'])
-                logging.info("Successfully logged into SMTP server")
+            def refresh():
+                done = report.sent + report.skipped + len(report.failed)
+                progress_bar.progress(min(1.0, done / report.total) if report.total else 1.0,
+                                      text=f"{report.sent}/{report.total} sent, {len(report.failed)} failed")
+                if sent_lines:
+                    recent.text("\n".join(sent_lines))
+                # Failed sends and rows rejected before sending both land in report.failed
+                if report.failed:
+                    failures.dataframe(pd.DataFrame(report.failed, columns=['Name', 'Email', 'Error']),
+                                       hide_index=True)
+                timings.dataframe(pd.DataFrame(campaign.metrics.table()), hide_index=True)
+            
+            with campaign:
+                logging.info("Successfully logged into SMTP server over TLS")
+                report = campaign.report
+                redraw = Throttle(UI_INTERVAL)
                 
-                for index, row in data.iterrows():
-                    try:
-                        msg = MIMEMultipart('related')
-                        msg['From'] = settings['email']
-                        msg['To'] = row['Nominee Email']
-                        
-                        # Handle CC recipients - now including SLE email
-                        cc_recipients = [SLE_EMAIL]  # Start with SLE email
-                        nominator_cc = row['Nominator Email(CC)']
-                        if pd.notna(nominator_cc) and isinstance(nominator_cc, str) and '@' in nominator_cc:
-                            cc_recipients.append(nominator_cc.strip())
-                        
-                        msg['Cc'] = ', '.join(cc_recipients)  # Join all CC recipients
-                        all_recipients = [row['Nominee Email']] + cc_recipients
-                        logging.info(f"CC recipients: {cc_recipients}")
-                        
-                        msg['Subject'] = settings['subject']
-                        
-                        logging.info(f"Processing email for: {row['Nominee Email']}")
-                        
-                        # Create alternative part for HTML
-                        alt_part = MIMEMultipart('alternative')
-                        msg.attach(alt_part)
-                        
-                        # HTML Content
-                        html_content = settings['template'].format(
-                            image_url="cid:header_image",
-                            name=row['Name of Nominee'],
-                            nominator_name=row['Nominator Name']
-                        )
-                        html_part = MIMEText(html_content, 'html')
-                        alt_part.attach(html_part)
-                        
-                        # Attach header image
-                        image = MIMEImage(settings['header_image_data'])
-                        image.add_header('Content-ID', '<header_image>')
-                        image.add_header('Content-Disposition', 'inline')
-                        msg.attach(image)
-                        logging.info("Header image attached successfully")
-                        
-                        # Attach PDF
-                        pdf_path_with_extension = row['PDFPath'] + ".pdf"
-                        if os.path.exists(pdf_path_with_extension):
-                            with open(pdf_path_with_extension, 'rb') as pdf:
-                                pdf_attachment = MIMEApplication(pdf.read(), _subtype='pdf')
-                                pdf_attachment.add_header(
-                                    'Content-Disposition', 
-                                    'attachment', 
-                                    filename=os.path.basename(pdf_path_with_extension)
-                                )
-                                msg.attach(pdf_attachment)
-                                logging.info(f"PDF attached successfully: {pdf_path_with_extension}")
-                        else:
-                            logging.warning(f"PDF path not found for {row['Nominee Email']}: {pdf_path_with_extension}")
-
-                        
-                        # Send email to all recipients
-                        server.send_message(msg, to_addrs=all_recipients)
-                        progress_bar.progress((index + 1) / total_emails)
-                        
-                        # Log success with recipient details - using cc_recipients instead of cc_email
-                        cc_info = f" with CC: {', '.join(cc_recipients)}" if cc_recipients else ""
-                        logging.info(f"Email successfully sent to: {row['Nominee Email']}{cc_info}")
-                        
-                        # Show success in Streamlit
-                        st.write(f"✅ Sent to {row['Name of Nominee']} ({row['Nominator Name']} - {row['Nominee Email']}){cc_info}")
-                        
-                    except Exception as e:
-                        error_msg = f"Error sending to {row['Nominee Email']}: {str(e)}"
-                        st.error(error_msg)
-                        logging.error(error_msg)
-                        continue
-                        
-        st.success("All emails sent successfully!")
-        logging.info("Email sending process completed successfully")
+                for result in campaign.results():
+                    log_result(logger, result)
+                    if result.ok:
+                        sent_lines.append(f"✅ Sent to {result.name} ({result.recipient})")
+                    if redraw():
+                        refresh()
+            
+            refresh()
+            for name, recipient, error in report.failed:
+                logging.error(f"Error sending to {recipient}: {error}")
+        
+        if report.stopped:
+            st.warning(f"Sending stopped early: {report.sent}/{report.total} emails sent.")
+        elif report.failed:
+            st.warning(f"Sent {report.sent}/{report.total} emails; {len(report.failed)} failed.")
+        else:
+            st.success("All emails sent successfully!")
+        logging.info(f"Email sending process completed: {report.sent} sent, {len(report.failed)} failed")
+        for stage in report.stages.values():
+            logging.info(stage.describe(report.elapsed))
         
     except Exception as e:
         error_msg = f"Error: {str(e)}"
@@ -318,7 +354,7 @@ def main():
         st.subheader("CSV Preview")
         st.dataframe(data.head())
         
-        settings = email_settings()
+        settings = email_settings(data)
         
         if st.button("Send Emails", type="primary"):
             if not all([settings['email'], settings['password'], settings['subject']]):
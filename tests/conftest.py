@@ -0,0 +1,16 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The package lives at the repo root and the stand-in SMTP server under benchmarks/
+sys.path[:0] = [ROOT, os.path.join(ROOT, "benchmarks")]
+
+from smtp_sink import SmtpSink  # noqa: E402
+
+
+@pytest.fixture
+def sink():
+    with SmtpSink() as sink:
+        yield sink
@@ -0,0 +1,77 @@
+import os
+
+import pytest
+
+from bulk_email.assets import AssetStore
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"\x00" * 64
+PDF = b"%PDF-1.4\n" + b"x" * 64
+
+
+def test_identical_content_is_stored_once():
+    store = AssetStore()
+    first = store.add(PDF, "a.pdf")
+    second = store.add(bytearray(PDF), "b.pdf")
+    assert second is first
+    assert len(store) == 1
+    assert (store.hits, store.misses) == (1, 1)
+    assert first.digest in store
+
+
+def test_load_reads_a_file_once_until_it_changes(tmp_path):
+    store = AssetStore()
+    path = tmp_path / "cert.pdf"
+    path.write_bytes(PDF)
+    first = store.load(str(path))
+    assert store.load(str(path)) is first
+    path.write_bytes(PDF + b"changed")
+    os.utime(path, ns=(0, os.stat(path).st_mtime_ns + 10 ** 9))
+    assert store.load(str(path)) is not first
+    assert len(store) == 2
+
+
+def test_loaded_files_dedupe_with_the_same_bytes(tmp_path):
+    store = AssetStore()
+    path = tmp_path / "big.pdf"
+    path.write_bytes(PDF)
+    assert store.load(str(path)) is store.add(PDF, "other.pdf")
+    assert store.load(str(path)).data == PDF
+
+
+def test_least_recently_used_is_evicted_first():
+    store = AssetStore(max_bytes=250)
+    a = store.add(b"a" * 100, "a.bin")
+    store.add(b"b" * 100, "b.bin")
+    store.get(a.digest)
+    c = store.add(b"c" * 100, "c.bin")
+    assert store.evictions == 1
+    assert a.digest in store and c.digest in store
+    assert len(store) == 2
+    assert store.size == 200
+
+
+def test_encodings_count_towards_the_budget():
+    store = AssetStore(max_bytes=1000)
+    old = store.add(b"o" * 300, "old.bin")
+    pdf = store.add(PDF * 4, "cert.pdf")
+    pdf.attachment_part()
+    assert store.size > 300 + len(PDF) * 4
+    pdf.data_url()
+    # Encoding the newest asset pushed the older one out
+    assert old.digest not in store
+    assert store.size == pdf.size
+
+
+def test_newest_asset_stays_even_over_budget():
+    store = AssetStore(max_bytes=10)
+    asset = store.add(b"x" * 100, "big.bin")
+    assert asset.digest in store
+
+
+def test_images_are_typed_by_content():
+    store = AssetStore()
+    assert store.add(PNG, "logo.jpg").content_type == "image/png"
+    with pytest.raises(ValueError):
+        store.add(b"not an image", "logo.png")
+    with pytest.raises(ValueError):
+        store.add(b"", "empty.pdf")
@@ -0,0 +1,61 @@
+import threading
+
+from bulk_email.assets import AssetStore
+from bulk_email.attachments import AttachmentLoader
+
+PDF = b"%PDF-1.4\n"
+
+
+def make_files(tmp_path, count):
+    paths = []
+    for i in range(count):
+        path = tmp_path / f"cert{i}.pdf"
+        path.write_bytes(PDF + str(i).encode() * 50)
+        paths.append(str(path))
+    return paths
+
+
+def test_scan_reports_sizes_and_sorted_missing(tmp_path):
+    paths = make_files(tmp_path, 3)
+    missing = [str(tmp_path / "z.pdf"), str(tmp_path / "a.pdf")]
+    with AttachmentLoader() as loader:
+        sizes, absent = loader.scan(paths + missing + paths)
+    assert sizes == {path: len(PDF) + 50 for path in paths}
+    assert absent == sorted(missing)
+
+
+def test_prefetched_files_are_loaded_and_encoded_once(tmp_path):
+    paths = make_files(tmp_path, 10)
+    store = AssetStore()
+    with AttachmentLoader(store, ahead=4) as loader:
+        for path in paths + paths:
+            loader.prefetch(path)
+        assets = [loader.get(path) for path in paths]
+        assert loader.prefetched == 10
+    assert [asset.data for asset in assets] == [open(path, "rb").read() for path in paths]
+    assert store.misses == 10
+    # attachment_part() was already encoded in the background
+    assert all(("attachment", asset.filename) in asset._encoded for asset in assets)
+
+
+def test_lookahead_bounds_the_files_in_flight(tmp_path):
+    paths = make_files(tmp_path, 8)
+    release = threading.Event()
+    with AttachmentLoader(ahead=2) as loader:
+        load = loader._load
+        loader._load = lambda path: release.wait(5) and load(path)
+        for path in paths:
+            loader.prefetch(path)
+        assert len(loader._futures) == 2
+        assert len(loader._waiting) == 6
+        release.set()
+        assert loader.get(paths[0]).filename == "cert0.pdf"
+        # Taking one frees a slot for the next in queue order
+        assert paths[2] in loader._futures
+
+
+def test_get_without_prefetch_loads_directly(tmp_path):
+    path, = make_files(tmp_path, 1)
+    with AttachmentLoader() as loader:
+        assert loader.get(path).data == open(path, "rb").read()
+        assert loader.prefetched == 0
@@ -0,0 +1,96 @@
+import sqlite3
+
+import pytest
+
+from bulk_email.campaign import Campaign
+from bulk_email.domains import DomainScheduler, domain_of
+from bulk_email.engine import SendJob
+from bulk_email.recipients import CsvRecipients
+from bulk_email.template import CompiledTemplate
+
+
+def job(recipient, dispatched=None):
+    on_dispatch = (lambda: dispatched.append(recipient)) if dispatched is not None else None
+    return SendJob(recipient, recipient, None, on_dispatch=on_dispatch)
+
+
+def test_domain_of():
+    assert domain_of("A@School.EDU ") == "school.edu"
+    assert domain_of(("x@one.org", "y@two.org")) == "one.org"
+
+
+def test_domains_take_turns_within_their_concurrency():
+    domains = DomainScheduler(concurrency=1)
+    for i in range(3):
+        domains.push(job(f"{i}@busy.org"))
+    domains.push(job("a@quiet.org"))
+    first, second = domains.pop(), domains.pop()
+    assert {domain_of(first.recipient), domain_of(second.recipient)} == {"busy.org", "quiet.org"}
+    # busy.org has one in flight; nothing else may go until it's done
+    assert domains.pop() is None
+    domains.done(first if domain_of(first.recipient) == "busy.org" else second)
+    assert domain_of(domains.pop().recipient) == "busy.org"
+
+
+def test_dispatch_hook_runs_only_when_handed_out():
+    dispatched = []
+    domains = DomainScheduler(concurrency=1)
+    for i in range(100):
+        domains.push(job(f"{i}@one.org", dispatched))
+    assert dispatched == []
+    popped = domains.pop()
+    assert dispatched == [popped.recipient]
+    domains.done(popped)
+    # A retry pushed back to the front doesn't run it again
+    domains.push(popped, front=True)
+    domains.pop()
+    assert dispatched == [popped.recipient]
+
+
+@pytest.mark.parametrize("staged", [False, True])
+def test_read_ahead_jobs_are_journaled_when_sent(sink, tmp_path, staged):
+    rows = "Name,Email\n" + "".join(f"P{i},p{i}@{'busy' if i % 2 else 'other'}.org\n" for i in range(1000))
+    journal = str(tmp_path / "journal.sqlite3")
+    campaign = Campaign(CsvRecipients(rows.encode()), CompiledTemplate("<p>Hi</p>", ()), "Subject", "me@x.org",
+                        "pw", host=sink.host, port=sink.port, starttls=False, connections=2, staged=staged,
+                        journal_path=journal, domain_limits={}, metrics=None)
+    results = 0
+    with campaign:
+        for _ in campaign.results():
+            results += 1
+            if results == 10:
+                campaign.engine.stop()
+        campaign.journal.flush()
+        queued = sqlite3.connect(journal).execute(
+            "SELECT COUNT(*) FROM sends WHERE detail IS NOT 'Stopped before sending'").fetchone()[0]
+    # All 1000 rows were read ahead, but only what was handed out was journaled before the stop
+    assert queued < 100
+    assert sink.messages == campaign.report.sent
+
+
+def test_drain_empties_every_domain():
+    domains = DomainScheduler()
+    for recipient in ("a@one.org", "b@two.org", "c@one.org"):
+        domains.push(job(recipient))
+    assert sorted(j.recipient for j in domains.drain()) == ["a@one.org", "b@two.org", "c@one.org"]
+    assert len(domains) == 0 and domains.pop() is None
+
+
+@pytest.mark.parametrize("staged", [False, True])
+def test_stopping_accounts_for_every_row(sink, staged):
+    domains = ("one.org", "two.org", "three.org")
+    rows = "Name,Email\n" + "".join(f"P{i},p{i}@{domains[i % 3]}\n" for i in range(300))
+    campaign = Campaign(CsvRecipients(rows.encode()), CompiledTemplate("<p>Hi</p>", ()), "Subject", "me@x.org",
+                        "pw", host=sink.host, port=sink.port, starttls=False, connections=2, staged=staged,
+                        domain_limits={"default": {"concurrency": 1}}, metrics=None)
+    seen = []
+    with campaign:
+        for result in campaign.results():
+            seen.append(result.recipient)
+            if len(seen) == 10:
+                campaign.engine.stop()
+    report = campaign.report
+    assert report.stopped
+    assert report.sent + len(report.failed) + report.skipped == report.total == 300
+    assert sorted(seen) == sorted(f"p{i}@{domains[i % 3]}" for i in range(300))
+    assert {reason for _, _, reason in report.failed} == {"Stopped before sending"}
@@ -0,0 +1,88 @@
+import time
+
+from bulk_email.engine import SendEngine, SendJob
+from bulk_email.retry import RetryPolicy
+from bulk_email.smtp import SMTPConnection
+from smtp_sink import SmtpSink
+
+SENDER = "sender@example.org"
+
+
+def connect_to(sink):
+    return lambda: SMTPConnection(sink.host, sink.port, SENDER, "pw", starttls=False).connect()
+
+
+def message(recipient):
+    return (f"From: {SENDER}\r\nTo: {recipient}\r\nSubject: Test\r\n\r\nHello {recipient}\r\n").encode("ascii")
+
+
+def job(recipient, fail=False):
+    def build():
+        if fail:
+            raise ValueError("bad row")
+        return SENDER, [recipient], message(recipient)
+    return SendJob(recipient, recipient, build)
+
+
+def addresses(count):
+    return [f"person{i}@example.org" for i in range(count)]
+
+
+def run(engine, jobs, should_stop=None):
+    with engine:
+        return list(engine.run(jobs, should_stop=should_stop))
+
+
+def test_sends_every_job_once_across_connections(sink):
+    recipients = addresses(200)
+    results = run(SendEngine(connect_to(sink), connections=4), [job(r) for r in recipients])
+    assert len(results) == 200
+    assert all(result.ok for result in results)
+    assert sorted(result.recipient for result in results) == sorted(recipients)
+    assert sink.messages == 200
+    assert dict(sink.delivered) == {r: 1 for r in recipients}
+    assert sink.connections == 4
+
+
+def test_counts_failures_and_keeps_sending(sink):
+    recipients = addresses(50)
+    jobs = [job(r, fail=i % 10 == 0) for i, r in enumerate(recipients)]
+    results = run(SendEngine(connect_to(sink), connections=3), jobs)
+    failed = [result for result in results if not result.ok]
+    assert len(results) == 50
+    assert len(failed) == 5
+    assert all("bad row" in result.error for result in failed)
+    assert sink.messages == 45
+    assert set(sink.delivered) == {r for i, r in enumerate(recipients) if i % 10}
+
+
+def test_dropped_connections_are_retried_without_duplicates():
+    recipients = addresses(120)
+    with SmtpSink(disconnect_every=7) as sink:
+        engine = SendEngine(connect_to(sink), connections=3, retry_policy=RetryPolicy(max_attempts=4, base_delay=0.01))
+        results = run(engine, [job(r) for r in recipients])
+    assert sink.disconnects > 0
+    assert all(result.ok for result in results)
+    assert len(results) == 120
+    assert dict(sink.delivered) == {r: 1 for r in recipients}
+
+
+def test_stop_flag_ends_the_run_early(sink):
+    recipients = addresses(500)
+    results = []
+    engine = SendEngine(connect_to(sink), connections=2, max_rate=100)
+    with engine:
+        for result in engine.run([job(r) for r in recipients], should_stop=lambda: len(results) >= 20):
+            results.append(result)
+    assert engine.stopped
+    assert 20 <= len(results) < 500
+    assert sink.messages == len(results)
+
+
+def test_rate_cap_holds_across_connections(sink):
+    start = time.monotonic()
+    results = run(SendEngine(connect_to(sink), connections=4, max_rate=40), [job(r) for r in addresses(40)])
+    elapsed = time.monotonic() - start
+    assert all(result.ok for result in results)
+    # 40 messages at 40/s with a burst of one: about a second, however many connections
+    assert elapsed >= 0.8
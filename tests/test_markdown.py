@@ -0,0 +1,51 @@
+import json
+import os
+import time
+
+import pytest
+
+from bulk_email.markdown import markdown_to_html
+from bulk_email.template import CompiledTemplate, compile_markdown
+
+# Inputs with what the regex-chain converter (before the tokenizer) made of them.
+# "same" must still come out identical; "changed" lists the intended fixes.
+with open(os.path.join(os.path.dirname(__file__), "data", "markdown_corpus.json"), encoding="utf-8") as f:
+    CORPUS = json.load(f)
+
+# Why a "changed" entry may differ from the old converter
+INTENDED = {"list merging", "snake_case", "code spans", "images", "crossed delimiters", "crlf"}
+
+
+@pytest.mark.parametrize("entry", CORPUS["same"], ids=lambda entry: repr(entry["input"][:30]))
+def test_matches_legacy_converter(entry):
+    assert markdown_to_html(entry["input"]) == entry["legacy"]
+
+
+@pytest.mark.parametrize("entry", CORPUS["changed"], ids=lambda entry: f"{entry['why']}: {entry['input'][:30]!r}")
+def test_intended_differences(entry):
+    assert entry["why"] in INTENDED
+    html = markdown_to_html(entry["input"])
+    assert html == entry["expected"]
+    assert html != entry["legacy"]
+
+
+def test_placeholders_survive_conversion():
+    columns = ("Name", "Event_Name")
+    template = CompiledTemplate(compile_markdown("Dear **{{Name}}**, see _{{Event_Name}}_.", columns), columns)
+    assert template.render({"Name": "Ama", "Event_Name": "a_b"}) == \
+        "Dear <strong>Ama</strong>, see <em>a_b</em>."
+
+
+def test_values_are_escaped():
+    columns = ("Name", "Link")
+    template = CompiledTemplate(compile_markdown("Dear {{Name}}, [RSVP]({{Link}})", columns), columns)
+    assert template.render({"Name": "A & <B>", "Link": 'x.org/?a=1&b="2"'}) == \
+        'Dear A &amp; &lt;B&gt;, <a href="x.org/?a=1&amp;b=&quot;2&quot;">RSVP</a>'
+
+
+@pytest.mark.parametrize("text", ["[a" * 20000, "_ " * 20000, "**" * 5001, "~~a " * 20000])
+def test_unclosed_markers_stay_linear(text):
+    start = time.perf_counter()
+    markdown_to_html(text)
+    # The regex chain took seconds on these; one pass takes milliseconds
+    assert time.perf_counter() - start < 1.0
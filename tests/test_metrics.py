@@ -0,0 +1,35 @@
+from bulk_email.metrics import BUCKETS, Histogram, Metrics
+
+
+def test_quantiles_are_bucket_upper_bounds():
+    histogram = Histogram()
+    for i in range(100):
+        histogram.observe(0.001 if i < 90 else 0.02)
+    # 0.001 lands in the (0.8 ms, 1.6 ms] bucket and 0.02 in (12.8 ms, 25.6 ms]
+    assert histogram.quantile(0.5) == histogram.quantile(0.9) == 0.0016
+    assert histogram.quantile(0.99) == 0.02  # capped at the largest value seen
+    assert all(histogram.quantile(q) >= 0.001 for q in (0.1, 0.5, 0.9))
+    assert Histogram().quantile(0.99) == 0.0
+
+
+def test_values_past_the_last_bucket_report_the_max():
+    histogram = Histogram()
+    histogram.observe(BUCKETS[-1] * 3)
+    assert histogram.counts[-1] == 1
+    assert histogram.quantile(0.5) == BUCKETS[-1] * 3
+
+
+def test_table_and_prometheus():
+    metrics = Metrics()
+    metrics.count("messages_sent", 3)
+    metrics.count("sender_messages", account="a@x.org")
+    metrics.observe("send_seconds", 0.002)
+    metrics.observe("send_seconds", 0.006)
+    [row] = metrics.table()
+    assert (row["stage"], row["count"], row["total_s"]) == ("send_seconds", 2, 0.008)
+    assert row["p50_ms"] == 3.2 and row["max_ms"] == 6.0 == row["p99_ms"]
+    text = metrics.prometheus()
+    assert "bulk_email_messages_sent_total 3" in text
+    assert 'bulk_email_sender_messages_total{account="a@x.org"} 1' in text
+    assert 'bulk_email_send_seconds_bucket{le="+Inf"} 2' in text
+    assert "bulk_email_send_seconds_count 2" in text
@@ -0,0 +1,57 @@
+import email
+import email.policy
+
+from bulk_email.campaign import Campaign
+from bulk_email.mime import MessageSkeleton, attachment_part, image_part
+from bulk_email.recipients import CsvRecipients
+from bulk_email.spool import message_digest
+from bulk_email.template import CompiledTemplate
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 4
+PDF = b"%PDF-1.4\n" + bytes(range(256)) * 40
+HEADERS = [("Subject", "Hi"), ("From", "me@x.org"), ("To", "a@b.org")]
+
+
+def tree(message):
+    """The content types of ``message`` as nested ``(type, [children])``."""
+    def walk(part):
+        if part.is_multipart():
+            return part.get_content_type(), [walk(child) for child in part.get_payload()]
+        return part.get_content_type()
+    parsed = email.message_from_bytes(bytes(message), policy=email.policy.default)
+    assert not parsed.defects
+    return walk(parsed)
+
+
+def test_html_alone():
+    message = MessageSkeleton(subtype="alternative").build(HEADERS, "<p>Hi</p>")
+    assert tree(message) == ("multipart/alternative", ["text/html"])
+
+
+def test_attachments_go_in_a_mixed_wrapper():
+    skeleton = MessageSkeleton([image_part(PNG, cid="logo", subtype="png")])
+    assert tree(skeleton.build(HEADERS, "<p>Hi</p>")) == ("multipart/related", ["text/html", "image/png"])
+    message = skeleton.build(HEADERS, "<p>Hi</p>", [attachment_part(PDF, "a.pdf", "pdf")] * 2)
+    assert tree(message) == ("multipart/mixed", [("multipart/related", ["text/html", "image/png"]),
+                                                 "application/pdf", "application/pdf"])
+    parsed = email.message_from_bytes(message, policy=email.policy.default)
+    [attachment, _] = parsed.iter_attachments()
+    assert (attachment.get_filename(), attachment.get_content()) == ("a.pdf", PDF)
+
+
+def test_digest_ignores_both_boundaries():
+    parts = [attachment_part(PDF, "a.pdf", "pdf")]
+    first, second = MessageSkeleton(subtype="alternative"), MessageSkeleton(subtype="alternative")
+    assert message_digest(first.build(HEADERS, "<p>Hi</p>", parts), first.boundary) == \
+        message_digest(second.build(HEADERS, "<p>Hi</p>", parts), second.boundary)
+
+
+def test_campaign_attaches_each_rows_file(tmp_path):
+    pdf = tmp_path / "a.pdf"
+    pdf.write_bytes(PDF)
+    rows = f"Name,Email,File\nAda,ada@x.org,{pdf}\nBob,bob@x.org,\n"
+    campaign = Campaign(CsvRecipients(rows.encode()), CompiledTemplate("<p>Hi</p>", ()), "Subject", "me@x.org",
+                        name_col="Name", email_col="Email", attachment_col="File")
+    ada, bob = (campaign.build(row, row["Email"])[2] for row in campaign.recipients)
+    assert tree(ada) == ("multipart/mixed", [("multipart/alternative", ["text/html"]), "application/pdf"])
+    assert tree(bob) == ("multipart/alternative", ["text/html"])
@@ -0,0 +1,40 @@
+from bulk_email.pipeline import SendPipeline
+from test_engine import addresses, connect_to, job, run
+
+
+def test_sends_every_job_once(sink):
+    recipients = addresses(200)
+    results = run(SendPipeline(connect_to(sink), connections=3, builders=2), [job(r) for r in recipients])
+    assert len(results) == 200
+    assert all(result.ok for result in results)
+    assert dict(sink.delivered) == {r: 1 for r in recipients}
+
+
+def test_build_failures_are_reported(sink):
+    recipients = addresses(30)
+    jobs = [job(r, fail=i % 10 == 0) for i, r in enumerate(recipients)]
+    results = run(SendPipeline(connect_to(sink), connections=2, build_batch=4), jobs)
+    assert len(results) == 30
+    assert sorted(result.recipient for result in results if not result.ok) == recipients[::10]
+    assert sink.messages == 27
+
+
+def test_every_job_read_gets_a_result_after_stop(sink):
+    read = []
+
+    def jobs():
+        for recipient in addresses(2000):
+            read.append(recipient)
+            yield job(recipient)
+
+    results = []
+    pipeline = SendPipeline(connect_to(sink), connections=2, max_rate=200)
+    with pipeline:
+        for result in pipeline.run(jobs(), should_stop=lambda: len(results) >= 20):
+            results.append(result)
+    stopped = [result for result in results if not result.ok]
+    assert pipeline.stopped
+    assert len(read) < 2000
+    assert sorted(result.recipient for result in results) == sorted(read)
+    assert stopped and all(result.error == "Stopped before sending" for result in stopped)
+    assert sink.messages == len(results) - len(stopped)
@@ -0,0 +1,46 @@
+from bulk_email.preview import PreviewCache, content_key
+from bulk_email.recipients import CsvRecipients
+
+
+def test_content_key_separates_parts():
+    assert content_key("ab", "c") != content_key("a", "bc")
+    assert content_key("a", b"b") == content_key("a", "b")
+
+
+def test_template_is_built_once_per_key():
+    previews = PreviewCache(templates=2)
+    built = []
+    for key in ("a", "b", "a", "c", "a"):
+        previews.template(key, lambda: built.append(key) or key.upper())
+    # "b" was the least recently used when "c" came in
+    assert built == ["a", "b", "c"]
+    assert previews.template("b", lambda: "again") == "again"
+
+
+def test_cached_row_is_not_read_again(tmp_path, monkeypatch):
+    path = tmp_path / "list.csv"
+    path.write_text("Name,Email\n" + "".join(f"P{i},p{i}@x.org\n" for i in range(50)))
+    recipients = CsvRecipients(str(path))
+    previews = PreviewCache()
+    render = lambda row: f"<p>Hi {row['Name']}</p>"
+    key = ("template", recipients.source)
+    assert previews.render(key, 40, lambda: recipients.row(40), render) == "<p>Hi P40</p>"
+    reads = []
+    read = CsvRecipients._read
+    monkeypatch.setattr(CsvRecipients, "_read", lambda self, **kwargs: reads.append(kwargs) or read(self, **kwargs))
+    assert previews.render(key, 40, lambda: recipients.row(40), render) == "<p>Hi P40</p>"
+    assert not reads
+    assert (previews.hits, previews.misses) == (1, 1)
+    # Another template or list misses the cache and reads its row
+    previews.render(("other", recipients.source), 40, lambda: recipients.row(40), render)
+    assert reads
+
+
+def test_rows_are_evicted_least_recently_used_first():
+    previews = PreviewCache(rows=2)
+    loads = []
+    load = lambda index: lambda: loads.append(index) or {"n": index}
+    render = lambda row: str(row["n"])
+    for index in (0, 1, 0, 2, 1):
+        previews.render("key", index, load(index), render)
+    assert loads == [0, 1, 2, 1]
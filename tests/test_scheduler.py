@@ -0,0 +1,73 @@
+from datetime import datetime
+
+import pytest
+
+from bulk_email.scheduler import Scheduler, Windows
+
+# Claims, reports and usage all take the time from here, so no test straddles midnight
+NOON = datetime(2026, 10, 12, 12, 0).timestamp()
+TODAY = datetime(2026, 10, 12).date()
+SPEC = {"recipients": "list.csv", "template": {"marked": "<p>Hi</p>", "columns": []},
+        "subject": "Subject", "sender": "me@x.org"}
+
+
+@pytest.fixture
+def scheduler(tmp_path):
+    with Scheduler(str(tmp_path / "schedule.sqlite3"), lease=60) as scheduler:
+        yield scheduler
+
+
+def test_windows():
+    windows = Windows(["mon-fri 08:00-18:00", "sat 22:00-02:00"])
+    monday = datetime(2026, 10, 12, 9, 0)
+    assert windows.is_open(monday)
+    assert not windows.is_open(monday.replace(hour=19))
+    assert windows.next_open(monday.replace(hour=19)) == datetime(2026, 10, 13, 8, 0)
+    assert windows.is_open(datetime(2026, 10, 18, 1, 0))  # Sunday night, in Saturday's window
+    with pytest.raises(ValueError):
+        Windows(["someday 08:00-09:00"])
+
+
+def test_simultaneous_claims_split_the_quota(scheduler):
+    scheduler.add(SPEC, 300, batch_size=80, daily_quota=100, not_before=NOON)
+    first, _ = scheduler.claim("worker-1", now=NOON)
+    second, _ = scheduler.claim("worker-2", now=NOON)
+    assert (first.batch, first.remaining) == (0, 80)
+    assert (second.batch, second.remaining) == (1, 20)
+    third, wake = scheduler.claim("worker-3", now=NOON)
+    assert third is None and wake is not None
+
+
+def test_reports_move_the_reservation_to_usage(scheduler):
+    scheduler.add(SPEC, 300, batch_size=80, daily_quota=100, not_before=NOON)
+    first, _ = scheduler.claim("worker-1", now=NOON)
+    scheduler.heartbeat(first, sent=30, now=NOON + 1)
+    assert scheduler.used("me@x.org", TODAY) == 30
+    second, _ = scheduler.claim("worker-2", now=NOON + 2)
+    # 30 used and 50 still held by the first batch
+    assert second.remaining == 20
+    scheduler.finish(first, True, sent=10, now=NOON + 3)
+    assert scheduler.used("me@x.org", TODAY) == 40
+    # The first batch's unused 40 went back: 100 - 40 used - 20 held
+    third, _ = scheduler.claim("worker-3", now=NOON + 4)
+    assert third.remaining == 40
+
+
+def test_a_lapsed_lease_releases_its_reservation(scheduler):
+    scheduler.add(SPEC, 300, batch_size=80, daily_quota=100, not_before=NOON)
+    first, _ = scheduler.claim("worker-1", now=NOON)
+    assert scheduler.claim("worker-2", now=NOON + 1)[0].remaining == 20
+    # Both leases ran out: the first batch is claimed again with the quota back
+    again, _ = scheduler.claim("worker-3", now=NOON + 120)
+    assert (again.batch, again.remaining) == (first.batch, 80)
+
+
+def test_used_up_quota_waits_for_tomorrow(scheduler):
+    scheduler.add(SPEC, 300, batch_size=100, daily_quota=100, not_before=NOON)
+    claim, _ = scheduler.claim("worker-1", now=NOON)
+    scheduler.finish(claim, True, sent=100, now=NOON + 1)
+    claim, wake = scheduler.claim("worker-1", now=NOON + 2)
+    assert claim is None
+    assert datetime.fromtimestamp(wake) == datetime(2026, 10, 13)
+    # A new day has the whole quota again
+    assert scheduler.claim("worker-1", now=wake)[0].remaining == 100
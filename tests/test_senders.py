@@ -0,0 +1,51 @@
+import smtplib
+
+import pytest
+
+from bulk_email.senders import SenderAccount, SenderPool
+from smtp_sink import SmtpSink
+
+MESSAGE = b"Subject: Test\r\n\r\nHello\r\n"
+
+
+def pool(sink, count=2):
+    return SenderPool([SenderAccount(f"sender{i}@x.org", "secret", host=sink.host, port=sink.port, starttls=False)
+                       for i in range(count)])
+
+
+def test_recipients_keep_their_account(sink):
+    senders = pool(sink, 3)
+    session = senders.connect()
+    for i in range(30):
+        session.sendmail("me@x.org", [f"r{i}@y.org"], MESSAGE)
+    session.quit()
+    assert sum(account.sent for account in senders.accounts) == 30
+    assert all(account.sent for account in senders.accounts)
+    assert [senders.home(f"r{i}@y.org") for i in range(30)] == [senders.route(f"r{i}@y.org") for i in range(30)]
+
+
+def test_throttled_account_fails_over():
+    with SmtpSink(throttle=1.0) as sink:
+        senders = pool(sink)
+        session = senders.connect()
+        home = senders.home("r@y.org")
+        with pytest.raises(smtplib.SMTPDataError):
+            session.sendmail("me@x.org", ["r@y.org"], MESSAGE)
+        session.quit()
+    assert not senders.accounts[home].healthy(senders.accounts[home].down_until - 1)
+    assert senders.route("r@y.org") != home
+
+
+def test_refused_recipient_leaves_the_account_alone():
+    with SmtpSink(defer={"school.edu": 1}) as sink:
+        senders = pool(sink)
+        session = senders.connect()
+        home = senders.home("r@school.edu")
+        limiter = senders.accounts[home].limiter
+        session.sendmail("me@x.org", ["r@school.edu"], MESSAGE)
+        with pytest.raises(smtplib.SMTPRecipientsRefused):
+            session.sendmail("me@x.org", ["r@school.edu"], MESSAGE)
+        session.quit()
+    assert senders.accounts[home].down_until == 0.0
+    assert (limiter.factor, limiter.paused_until) == (1.0, 0.0)
+    assert senders.route("r@school.edu") == home
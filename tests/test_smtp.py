@@ -0,0 +1,58 @@
+import smtplib
+
+import pytest
+
+from bulk_email.mime import MessageStream, SpooledPart
+from bulk_email.smtp import PipeliningSMTP, _fix_eols, _quote_periods
+from smtp_sink import SmtpSink
+
+# A lone dot and a leading dot would end the DATA section early if not doubled
+MESSAGE = b"Subject: Dots\r\n\r\nfirst\r\n.\r\n.second\r\nlast"
+
+
+def session(sink):
+    server = PipeliningSMTP(sink.host, sink.port)
+    server.login("anyone", "anything")
+    return server
+
+
+def test_line_endings_and_leading_dots():
+    assert _fix_eols("a\nb\rc\r\nd") == "a\r\nb\r\nc\r\nd"
+    assert _quote_periods(b".a\r\nb.c\r\n.\r\n") == b"..a\r\nb.c\r\n..\r\n"
+
+
+@pytest.mark.parametrize("pipelining", [True, False])
+def test_dot_stuffed_bodies_arrive_whole(sink, pipelining):
+    server = session(sink)
+    if not pipelining:
+        del server.esmtp_features["pipelining"]
+    for _ in range(2):
+        assert server.sendmail("a@x.org", ["b@y.org"], MESSAGE) == {}
+    server.sendmail("a@x.org", ["b@y.org"], MESSAGE.decode("ascii").replace("\r\n", "\n"))
+    server.quit()
+    assert sink.messages == 3
+    # Doubled dots and the CRLF added after the last line
+    assert sink.bytes == 3 * (len(MESSAGE) + 2 + 2)
+
+
+def test_streamed_message_is_dot_stuffed_around_spooled_parts(sink, tmp_path):
+    path = tmp_path / "part"
+    path.write_bytes(b"Content-Type: text/plain\r\n\r\nQUJD\r\n")
+    message = MessageStream([b"Subject: Dots\r\n\r\n.one\r\n", SpooledPart(str(path)), b".\r\n"])
+    server = session(sink)
+    server.sendmail("a@x.org", ["b@y.org"], message)
+    server.sendmail("a@x.org", ["b@y.org"], MESSAGE)
+    server.quit()
+    assert sink.messages == 2
+
+
+def test_refused_envelope_resets_and_the_session_carries_on():
+    with SmtpSink(defer={"y.org": 1}) as sink:
+        server = session(sink)
+        server.sendmail("a@x.org", ["b@y.org"], MESSAGE)
+        with pytest.raises(smtplib.SMTPRecipientsRefused):
+            server.sendmail("a@x.org", ["b@y.org"], MESSAGE)
+        assert server.sendmail("a@x.org", ["c@z.org"], MESSAGE) == {}
+        server.quit()
+    assert sink.messages == 2
+    assert dict(sink.delivered) == {"b@y.org": 1, "c@z.org": 1}
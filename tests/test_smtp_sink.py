@@ -0,0 +1,59 @@
+import smtplib
+
+import pytest
+
+from smtp_sink import SmtpSink
+
+MESSAGE = b"Subject: Test\r\n\r\nHello\r\n"
+
+
+def session(sink):
+    server = smtplib.SMTP(sink.host, sink.port)
+    server.login("anyone", "anything")
+    return server
+
+
+def test_accepts_and_counts_messages(sink):
+    server = session(sink)
+    assert server.has_extn("pipelining")
+    server.sendmail("a@x.org", ["b@y.org", "C@Y.org"], MESSAGE)
+    server.sendmail("a@x.org", ["b@y.org"], MESSAGE)
+    server.quit()
+    assert (sink.messages, sink.recipients) == (2, 3)
+    assert sink.delivered == {"b@y.org": 2, "c@y.org": 1}
+    assert sink.bytes == 2 * len(MESSAGE)
+
+
+def test_throttles_the_requested_fraction():
+    with SmtpSink(throttle=1.0) as sink:
+        server = session(sink)
+        with pytest.raises(smtplib.SMTPDataError) as raised:
+            server.sendmail("a@x.org", ["b@y.org"], MESSAGE)
+        assert raised.value.smtp_code == 451
+        server.quit()
+    assert (sink.throttled, sink.messages) == (1, 0)
+    assert not sink.delivered
+
+
+def test_drops_the_connection_after_n_messages():
+    with SmtpSink(disconnect_every=2) as sink:
+        server = session(sink)
+        for _ in range(2):
+            server.sendmail("a@x.org", ["b@y.org"], MESSAGE)
+        with pytest.raises(smtplib.SMTPServerDisconnected):
+            server.sendmail("a@x.org", ["b@y.org"], MESSAGE)
+    assert (sink.messages, sink.disconnects) == (2, 1)
+
+
+def test_defers_a_domain_beyond_its_rate():
+    with SmtpSink(defer={"School.edu": 1}) as sink:
+        server = session(sink)
+        server.sendmail("a@x.org", ["a@school.edu"], MESSAGE)
+        with pytest.raises(smtplib.SMTPRecipientsRefused) as raised:
+            server.sendmail("a@x.org", ["b@school.edu"], MESSAGE)
+        assert raised.value.recipients["b@school.edu"][0] == 450
+        # Other domains are unaffected
+        server.sendmail("a@x.org", ["c@other.org"], MESSAGE)
+        server.quit()
+    assert sink.deferred == {"school.edu": 1}
+    assert sink.delivered == {"a@school.edu": 1, "c@other.org": 1}
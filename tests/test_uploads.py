@@ -0,0 +1,75 @@
+import gc
+import os
+
+import pytest
+
+from bulk_email.mime import MessageSkeleton, MessageStream, attachment_part, image_part
+from bulk_email.uploads import UploadSpool, iter_uploads
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(range(256)) * 40
+PDF = b"%PDF-1.4\n" + os.urandom(200_000)
+
+
+def test_same_content_is_written_once():
+    with UploadSpool() as spool:
+        first = spool.add("cert.pdf", PDF)
+        assert spool.add("cert.pdf", memoryview(PDF)) == first
+        assert spool.add("copy.pdf", PDF) != first
+        assert open(first, "rb").read() == PDF
+        assert os.path.basename(first) == "cert.pdf"
+
+
+def test_reads_both_file_upload_formats():
+    widgets7 = {"a.png": {"metadata": {"name": "a.png"}, "content": PNG}}
+    widgets8 = ({"name": "a.png", "content": memoryview(PNG)},)
+    assert list(iter_uploads(widgets7)) == [("a.png", PNG)]
+    assert [(name, bytes(content)) for name, content in iter_uploads(widgets8)] == [("a.png", PNG)]
+
+
+def test_spooled_parts_match_in_memory_encoding():
+    with UploadSpool() as spool:
+        image = spool.image_part(spool.add("logo.png", PNG), cid="image0", filename="logo.png")
+        attachment = spool.attachment_part(spool.add("cert.pdf", PDF))
+        assert bytes(image) == image_part(PNG, cid="image0", filename="logo.png", subtype="png")
+        assert bytes(attachment) == attachment_part(PDF, "cert.pdf", subtype="pdf")
+        # Encoded once, then reused
+        assert spool.attachment_part(spool.add("cert.pdf", PDF)) is attachment
+
+
+def test_messages_stream_spooled_parts_from_disk():
+    with UploadSpool() as spool:
+        part = spool.attachment_part(spool.add("cert.pdf", PDF))
+        skeleton = MessageSkeleton([part])
+        message = skeleton.build([("To", "a@b.org")], "<p>Hi</p>")
+        assert isinstance(message, MessageStream)
+        assert b"".join(message.chunks()) == bytes(message)
+        assert len(message) == len(bytes(message))
+        in_memory = MessageSkeleton([bytes(part)])
+        expected = in_memory.build([("To", "a@b.org")], "<p>Hi</p>")
+        assert bytes(message).replace(skeleton.boundary.encode(), b"B") == \
+            expected.replace(in_memory.boundary.encode(), b"B")
+
+
+def test_rejects_a_file_that_is_not_an_image():
+    with UploadSpool() as spool:
+        with pytest.raises(ValueError):
+            spool.image_part(spool.add("logo.png", b"not really a png"))
+
+
+def test_close_removes_the_directory():
+    spool = UploadSpool()
+    spool.attachment_part(spool.add("cert.pdf", PDF))
+    directory = spool.directory
+    assert os.listdir(directory)
+    spool.close()
+    assert not os.path.exists(directory)
+    spool.close()
+
+
+def test_directory_goes_with_the_spool():
+    spool = UploadSpool()
+    spool.add("cert.pdf", PDF)
+    directory = spool.directory
+    del spool
+    gc.collect()
+    assert not os.path.exists(directory)